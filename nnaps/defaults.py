@@ -176,3 +176,22 @@ def add_defaults_to_setup(setup):
     if not 'reduce_lr' in setup: setup['reduce_lr'] = True
 
     return setup
+
+def add_xgb_defaults_to_setup(setup):
+    """
+    Add the defaults of :func:`add_defaults_to_setup`, together with the options that are only used by the
+    XGBPredictor: the keyword arguments for all XGB models, the total number of cores, the number of targets trained
+    at once and if the matrix with the features is shared by all targets.
+
+    :param setup: the setup dictionary
+    :return: copy of the setup with the defaults added
+    """
+
+    setup = add_defaults_to_setup(setup)
+
+    if not 'xgb_kwargs' in setup: setup['xgb_kwargs'] = {}
+    if not 'n_jobs' in setup: setup['n_jobs'] = None
+    if not 'n_parallel_targets' in setup: setup['n_parallel_targets'] = None
+    if not 'xgb_shared_matrix' in setup: setup['xgb_shared_matrix'] = True
+
+    return setup
@@ -452,3 +452,157 @@ def load_model(filename):
         history = None
 
     return model, processors, features, regressors, classifiers, setup, history
+
+
+def _file_format(filename):
+    """ the format of a data file based on its extension: 'csv', 'hdf5' or 'parquet' """
+    ext = os.path.splitext(str(filename))[1].lower()
+    if ext in ['.h5', '.hdf5', '.hdf']:
+        return 'hdf5'
+    elif ext in ['.parquet', '.pq']:
+        return 'parquet'
+    else:
+        return 'csv'
+
+
+def _rechunk(frames, chunksize):
+    """ split and combine an iterable of DataFrames into DataFrames of chunksize rows, the last one can be shorter """
+    leftover = None
+    for frame in frames:
+        if leftover is not None and len(leftover) > 0:
+            frame = pd.concat([leftover, frame])
+        n_full = (len(frame) // chunksize) * chunksize
+        for start in range(0, n_full, chunksize):
+            yield frame.iloc[start:start + chunksize]
+        leftover = frame.iloc[n_full:]
+
+    if leftover is not None and len(leftover) > 0:
+        yield leftover
+
+
+def read_chunks(data, chunksize=100000, key=None):
+    """
+    Read a table in chunks of a fixed number of rows, without reading the entire table in memory when it is stored in
+    a file. The data can be given as:
+
+    - a pandas DataFrame
+    - an iterable of pandas DataFrames, which are split and combined into chunks of the requested size
+    - the path to a csv file
+    - the path to an hdf5 file written by pandas. Tables stored in 'table' format are read in chunks, tables in 'fixed'
+      format are read at once and then split.
+    - the path to a parquet file (requires pyarrow)
+
+    :param data: DataFrame, iterable of DataFrames or path to a csv, hdf5 or parquet file
+    :param chunksize: the number of rows in each chunk
+    :type chunksize: int
+    :param key: the key of the table in an hdf5 file, by default the first table in the file.
+    :type key: str
+    :return: generator yielding the chunks as pandas DataFrames
+    """
+
+    if chunksize is None or chunksize < 1:
+        raise ValueError('chunksize should be a positive integer, not: {}'.format(chunksize))
+
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, len(data), chunksize):
+            yield data.iloc[start:start + chunksize]
+
+    elif isinstance(data, (str, os.PathLike)):
+        file_format = _file_format(data)
+
+        if file_format == 'hdf5':
+            with pd.HDFStore(str(data), mode='r') as store:
+                if key is None:
+                    key = store.keys()[0]
+                storer = store.get_storer(key)
+                if storer.is_table:
+                    for start in range(0, storer.nrows, chunksize):
+                        yield store.select(key, start=start, stop=start + chunksize)
+                else:
+                    frame = store[key]
+                    for start in range(0, len(frame), chunksize):
+                        yield frame.iloc[start:start + chunksize]
+
+        elif file_format == 'parquet':
+            import pyarrow.parquet
+
+            parquet_file = pyarrow.parquet.ParquetFile(str(data))
+            frames = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize))
+            for frame in _rechunk(frames, chunksize):
+                yield frame
+
+        else:
+            for frame in pd.read_csv(str(data), chunksize=chunksize):
+                yield frame
+
+    else:
+        for frame in _rechunk(data, chunksize):
+            yield frame
+
+
+def write_chunks(chunks, filename, key='data', min_itemsize=None):
+    """
+    Write an iterable of DataFrames with the same columns to one file, one chunk at the time. The format is based on
+    the extension of the filename: hdf5 ('.h5', '.hdf5', '.hdf'), parquet ('.parquet', '.pq', requires pyarrow) or
+    csv (any other extension). An existing file is overwritten, also when there are no chunks to write, in which case
+    an empty file is created. The index of the DataFrames is replaced by the row number in the file.
+
+    :param chunks: iterable of pandas DataFrames
+    :param filename: the path of the output file
+    :type filename: str
+    :param key: the key of the table in an hdf5 file
+    :type key: str
+    :param min_itemsize: for hdf5 files, the minimum size of string columns, as an int for all columns or a dictionary
+                         by column name. Strings in later chunks can not be longer than this size or the length of the
+                         longest string in the first chunk.
+    :return: the number of rows written
+    :rtype: int
+    """
+    file_format = _file_format(filename)
+    filename = str(filename)
+
+    n_rows = 0
+    store, writer = None, None
+    try:
+        # create or truncate the output before the first chunk, so that no stale output is left when there are none
+        if file_format == 'hdf5':
+            store = pd.HDFStore(filename, mode='w')
+        elif file_format == 'csv':
+            open(filename, 'w').close()
+        elif os.path.isfile(filename):
+            os.remove(filename)
+
+        for i, chunk in enumerate(chunks):
+            chunk = chunk.set_axis(pd.RangeIndex(n_rows, n_rows + len(chunk)), axis=0)
+
+            if file_format == 'hdf5':
+                if i == 0 and isinstance(min_itemsize, int):
+                    min_itemsize = {c: min_itemsize for c in chunk.columns if chunk[c].dtype == object}
+                store.append(key, chunk, format='table', index=False, min_itemsize=min_itemsize)
+
+            elif file_format == 'parquet':
+                import pyarrow
+                import pyarrow.parquet
+
+                table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+                writer.write_table(table)
+
+            else:
+                chunk.to_csv(filename, mode='a', header=i == 0, index=False)
+
+            n_rows += len(chunk)
+
+        if file_format == 'parquet' and writer is None:
+            import pyarrow
+            import pyarrow.parquet
+
+            pyarrow.parquet.write_table(pyarrow.table({}), filename)
+    finally:
+        if store is not None:
+            store.close()
+        if writer is not None:
+            writer.close()
+
+    return n_rows
@@ -5,6 +5,28 @@ from numpy.lib.recfunctions import append_fields
 STABILITY_CRITERIA = ['Mdot', 'delta', 'J_div_Jdot_div_P', 'M_div_Mdot_div_P', 'R_div_SMA']
 CE_FORMALISMS = ['iben_tutukov1984', 'webbink1984', 'dewi_tauris2000', 'demarco2011']
 
+# history parameters used by each stability criterion
+STABILITY_PARAMETERS = {'Mdot': ['lg_mstar_dot_1'],
+                        'delta': ['mass_transfer_delta'],
+                        'J_div_Jdot_div_P': ['log10_J_div_Jdot_div_P'],
+                        'M_div_Mdot_div_P': ['log10_M_div_Mdot_div_P'],
+                        'R_div_SMA': ['star_1_radius', 'binary_separation'],
+                        }
+
+# history and profile parameters used by each CE formalism. dewi_tauris2000 can fall back to webbink1984.
+CE_PARAMETERS = {'iben_tutukov1984': ['star_1_mass', 'star_2_mass', 'he_core_mass', 'binary_separation'],
+                 'webbink1984': ['star_1_mass', 'star_2_mass', 'he_core_mass', 'binary_separation', 'rl_1'],
+                 'demarco2011': ['star_1_mass', 'star_2_mass', 'he_core_mass', 'binary_separation', 'rl_1'],
+                 'dewi_tauris2000': ['star_1_mass', 'star_2_mass', 'he_core_mass', 'binary_separation', 'rl_1'],
+                 }
+CE_PROFILE_PARAMETERS = {'iben_tutukov1984': [], 'webbink1984': [], 'demarco2011': [],
+                         'dewi_tauris2000': ['mass', 'logR', 'logP', 'logRho'],
+                         }
+
+# history parameters that are updated by apply_ce
+CE_UPDATED_PARAMETERS = ['model_number', 'period_days', 'binary_separation', 'star_1_mass', 'star_2_mass',
+                         'envelope_mass', 'he_core_mass', 'mass_ratio', 'rl_1', 'rl_2', 'CE_phase']
+
 def is_stable(data, criterion='J_div_Jdot_div_P', value=10, return_model_number=False):
     """
     Checks if a model is stable with respect to the provided stability criterion. Known criteria are:
@@ -97,13 +119,29 @@ def apply_ce(data, profiles=None, ce_formalism='iben_tutukov1984', max_profile_d
         - rl_2
 
     :param data: ndarray with model parameters
-    :param profiles: dictionary containing all available profiles for the model
+    :param profiles: dictionary containing all available profiles for the model, or the profile to use. Without
+                     profiles dewi_tauris2000 falls back to webbink1984.
     :param ce_formalism: Which CE formalism to use
     :param max_profile_distance: when using dewi_tauris2000, the maximum model_number difference between onset CE and
            the closest profile available.
     :return: same dataset as provided with on the last line the parameters after the CE phase.
     """
 
+    af, M1_final = ce_final_state(data, profiles=profiles, ce_formalism=ce_formalism,
+                                  max_profile_distance=max_profile_distance, **kwargs)
+
+    return update_after_ce(data, af, M1_final)
+
+
+def ce_final_state(data, profiles=None, ce_formalism='iben_tutukov1984', max_profile_distance=5, **kwargs):
+    """
+    Calculate the final separation and final mass of the primary after the CE phase with the requested CE formalism,
+    without updating the history. See :func:`apply_ce` for the parameters.
+
+    :return: final separation (Rsun), final primary mass (Msun)
+    :rtype: float, float
+    """
+
     if ce_formalism not in CE_FORMALISMS:
         raise ValueError('CE formalism not recognized, use one of: ' + str(CE_FORMALISMS))
 
@@ -119,15 +157,15 @@ def apply_ce(data, profiles=None, ce_formalism='iben_tutukov1984', max_profile_d
     elif ce_formalism == 'dewi_tauris2000':
         # need to find the correct profile for this
 
-        if type(profiles) is not dict:
+        if profiles is not None and type(profiles) is not dict:
             # a specific profile is provided for use in CE
             af, M1_final = dewi_tauris2000(data, profile=profiles, **kwargs)
 
         else:
             ce_mn = data['model_number'][-1]
-            profile_legend = profiles['legend']
+            profile_legend = profiles.get('legend', None) if profiles is not None else None
 
-            diff = abs(profile_legend['model_number'] - ce_mn)
+            diff = abs(profile_legend['model_number'] - ce_mn) if profile_legend is not None else np.array([np.inf])
 
             if np.min(diff) > max_profile_distance:
                 # no suitable profile, use Webbink instead
@@ -141,8 +179,56 @@ def apply_ce(data, profiles=None, ce_formalism='iben_tutukov1984', max_profile_d
 
                 af, M1_final = dewi_tauris2000(data, profile=profile, **kwargs)
 
-    M2 = data['star_2_mass'][-1]
+    return af, M1_final
+
+
+def ce_final_states(data, profiles=None, ce_formalism='iben_tutukov1984', max_profile_distance=5, **kwargs):
+    """
+    Calculate the final separation and final mass of the primary after the CE phase for many values of the CE
+    parameters at once. The CE parameters in the kwargs can be arrays, which are broadcast against each other. The
+    closed form formalisms (iben_tutukov1984, webbink1984 and demarco2011) are evaluated on the arrays at once,
+    dewi_tauris2000 integrates the profile once for every set of parameters. See :func:`apply_ce` for the parameters.
+
+    For example the final separations for 3 values of alpha and 2 values of lambda:
+
+    .. code-block:: python
+
+        af, M1_final = ce_final_states(history, ce_formalism='webbink1984', al=[[0.5], [1.0], [2.0]], lb=[0.5, 1.0])
+
+    :return: final separations (Rsun), final primary masses (Msun), both with the broadcast shape of the parameters
+    :rtype: array, array
+    """
 
+    if ce_formalism not in CE_FORMALISMS:
+        raise ValueError('CE formalism not recognized, use one of: ' + str(CE_FORMALISMS))
+
+    names = list(kwargs.keys())
+    values = np.broadcast_arrays(*[np.asarray(kwargs[name]) for name in names])
+    shape = values[0].shape if len(values) > 0 else ()
+
+    if ce_formalism == 'dewi_tauris2000':
+        af, M1_final = np.zeros(shape), np.zeros(shape)
+        for i in np.ndindex(shape):
+            pars = {name: value[i] for name, value in zip(names, values)}
+            af[i], M1_final[i] = ce_final_state(data, profiles=profiles, ce_formalism=ce_formalism,
+                                                max_profile_distance=max_profile_distance, **pars)
+    else:
+        af, M1_final = ce_final_state(data, ce_formalism=ce_formalism, **dict(zip(names, values)))
+        af = np.broadcast_to(np.asarray(af, dtype=float), shape)
+        M1_final = np.broadcast_to(np.asarray(M1_final, dtype=float), shape)
+
+    return af, M1_final
+
+
+def post_ce_orbit(M2, af, M1_final):
+    """
+    The orbit after the CE phase given the final separation and final primary mass. All parameters can be arrays.
+
+    :param M2: the mass of the companion (Msun)
+    :param af: the final separation (Rsun)
+    :param M1_final: the final mass of the primary (Msun)
+    :return: period (days), mass ratio, Roche lobe radius of the primary and of the companion (Rsun)
+    """
     G = 2944.643655  # Rsol^3/Msol/days^2
     P = np.sqrt(4 * np.pi ** 2 * af ** 3 / G * (M1_final + M2))
 
@@ -151,6 +237,22 @@ def apply_ce(data, profiles=None, ce_formalism='iben_tutukov1984', max_profile_d
     rl_1 = af * 0.49 * q ** (2.0 / 3.0) / (0.6 * q ** (2.0 / 3.0) + np.log(1 + q ** (1.0 / 3.0)))
     rl_2 = af * 0.49 * q ** (-2.0 / 3.0) / (0.6 * q ** (-2.0 / 3.0) + np.log(1 + q ** (-1.0 / 3.0)))
 
+    return P, q, rl_1, rl_2
+
+
+def update_after_ce(data, af, M1_final):
+    """
+    Add a row to the end of the history with the parameters after the CE phase, given the final separation and the
+    final mass of the primary as calculated by one of the CE formalisms. See :func:`apply_ce` for the parameters that
+    are updated.
+
+    :param data: ndarray with model parameters
+    :param af: the final separation (Rsun)
+    :param M1_final: the final mass of the primary (Msun)
+    :return: same dataset as provided with on the last line the parameters after the CE phase.
+    """
+    P, q, rl_1, rl_2 = post_ce_orbit(data['star_2_mass'][-1], af, M1_final)
+
     # copy the last row of data so that we don't overwrite the parameters at the start of the CE
     # add a flag 'CE_phase' that is set to 1 during the CE phase. For now this is maximum 1 row.
     data = np.hstack([data, data[-1]])
@@ -255,13 +357,36 @@ def demarco2011(history, al=1, lb=1):
     return af, Mc
 
 
-def dewi_tauris2000(history, profile, a_ce=1, a_th=0.5, merge_when_core_reached=True):
+# coefficients of the fit to the Roche lobe radius in units of the separation as a function of log(q), highest order
+# first for evaluation in Horner form.
+ROCHE_COEFFICIENTS = [-0.000780009, 0.00734239, -0.0253245, 0.0297013, 0.0345071, -0.122257, 0.0627232, 0.118513,
+                      -0.13918, -0.0227041, 0.0876934, -0.0169055, -0.0205853, 0.00870908, -0.00567072, -0.0438153,
+                      0.232069, -0.420297]
+
+
+def roche_lobe_fraction(q):
+    """
+    Roche lobe radius of the primary in units of the separation for mass ratio q = M1 / M2, from a 17th order
+    polynomial fit in log(q). The polynomial is evaluated in Horner form, and q can be an array.
+
+    :param q: mass ratio M1 / M2
+    :return: R_L / a
+    """
+    return 10 ** np.polyval(ROCHE_COEFFICIENTS, np.log10(q))
+
+
+def dewi_tauris2000(history, profile, a_ce=1, a_th=0.5, merge_when_core_reached=True, method='array'):
     """
     CE formalism presented in
     `Dewi and Tauris 2000, A&A, 360, 1043 <https://ui.adsabs.harvard.edu/abs/2000A%26A...360.1043D/abstract>`_
     based on the idea of obtaining the binding energy by integrating the stellar profile from
     `Han et al 1995, MNRAS, 272, 800 <https://ui.adsabs.harvard.edu/abs/1995MNRAS.272..800H/abstract>`_
 
+    The envelope is removed cell by cell from the surface inwards, until the remaining star fits within its Roche lobe.
+    With method='array' the gravitational and thermal energy of the cells and the Roche lobe size in units of the
+    separation are calculated with numpy for blocks of cells at once, after which only the update of the separation,
+    which depends on the separation itself, is done cell by cell on plain floats. method='loop' uses the original cell
+    by cell implementation on the profile rows.
 
     Required history parameters:
         - star_2_mass
@@ -279,9 +404,74 @@ def dewi_tauris2000(history, profile, a_ce=1, a_th=0.5, merge_when_core_reached=
     :param a_th: efficiency of binding energy
     :param merge_when_core_reached: if True, the system is reported as a merger when the He core is reached in the
                                     iteration before the envelope is ejected and the CE ends.
+    :param method: 'array' or 'loop'
     :return: final separation, final primary mass
     """
 
+    if method == 'loop':
+        return _dewi_tauris2000_loop(history, profile, a_ce=a_ce, a_th=a_th,
+                                     merge_when_core_reached=merge_when_core_reached)
+    elif method != 'array':
+        raise ValueError("method should be 'array' or 'loop', not: {}".format(method))
+
+    M2 = history['star_2_mass'][-1]  # Msun
+    Mc = history['he_core_mass'][-1]  # Msun
+    a = history['binary_separation'][-1]  # Rsun
+    G = 2944.643655  # Rsun^3/Msun/days^2
+
+    # the cell quantities are calculated in blocks of increasing size, as the envelope is often ejected after removing
+    # only a small part of the profile.
+    n_cells = len(profile) - 1
+    start, block_size = 0, 64
+    while start < n_cells:
+        stop = min(start + block_size, n_cells)
+
+        mass = np.asarray(profile['mass'][start:stop + 1], dtype=float)
+        R = 10**np.asarray(profile['logR'][start:stop + 1], dtype=float)  # Rsun
+
+        # cell i is between point i and i+1 of the profile, M1 and R1 are the mass and radius below the cell
+        dm = mass[:-1] - mass[1:]
+        M1 = mass[1:]  # Msun
+        R1 = R[1:]  # Rsun
+        Rmid = R1 + (R[:-1] - R1) / 2  # mid point of the cell in Rsol
+        U = (3.0 * 10**np.asarray(profile['logP'][start:stop], dtype=float)) / \
+            (2.0 * 10**np.asarray(profile['logRho'][start:stop], dtype=float))  # cm^2 / s^2
+        U = U * 1.5432035916041713e-12  # Rsun^2 / days^2
+
+        binding = (G * M1 / Rmid - a_th * U).tolist()
+        denominator = (a_ce * G * M1 * M2).tolist()
+        with np.errstate(over='ignore'):
+            # cells close to the center overflow, but are only reached when the loop would overflow as well.
+            roche = roche_lobe_fraction(M1 / M2).tolist()
+        dm, R1 = dm.tolist(), R1.tolist()
+
+        # the separation after removing a cell depends on the separation itself, so it is updated cell by cell.
+        for i in range(stop - start):
+            a = a - dm[i] * (binding[i] + a_ce * G * M2 / (2 * a)) * 2 * a**2 / denominator[i]
+
+            # if center of star reached report merger
+            if start + i + 1 >= n_cells:
+                return 0, 0
+
+            # if core is reached and merge_when_core_reached == True report merger
+            if merge_when_core_reached and M1[i] < Mc:
+                return 0, Mc
+
+            # check if still outside RL
+            if R1[i] < a * roche[i]:
+                return a, M1[i]
+
+        start, block_size = stop, block_size * 4
+
+    # profile with less than 2 points
+    return 0, 0
+
+
+def _dewi_tauris2000_loop(history, profile, a_ce=1, a_th=0.5, merge_when_core_reached=True):
+    """
+    Cell by cell implementation of :func:`dewi_tauris2000`.
+    """
+
     def fRoche1(q):
         Xi = np.log10(q)
         ResPre = -0.420297 + 0.232069 * (Xi) - 0.0438153 * (Xi ** 2) - \
@@ -1,7 +1,15 @@
+import io
 import os
+import re
+import json
+import hashlib
+import functools
+import multiprocessing
 
 from pathlib import Path
+import h5py
 import numpy as np
+import pandas as pd
 
 # repack_fields is necessary since np 1.16 as selecting columns from a recarray returns an array with padding
 # that is difficult to work with afterwards.
@@ -10,24 +18,128 @@ from numpy.lib import recfunctions as rf
 from nnaps.mesa import fileio
 from nnaps import __version__
 
-def read_mesa_output(filename=None, only_first=False):
+# matches the start of candidate column numbering lines (1, 2, 3, ...) that mark the start of a new block. The
+# pattern starts with a newline instead of using '^' in multiline mode, which is much faster to search for.
+_BLOCK_MARKER = re.compile(r'\n[ \t]*1[ \t]*(?:\n|[ \t]+2[ \t\n])')
+
+
+def _is_column_numbering(line):
+    """ check if a line is the column numbering (1, 2, 3, ...) that starts a new model block """
+    line = line.split()
+    return all([iline == str(irange) for iline, irange in zip(line, range(1, len(line) + 1))])
+
+
+def _count_tokens(text):
+    """ the number of whitespace separated values on each non-empty line of the text, counted without splitting """
+    chars = np.frombuffer(('\n' + text).encode(), dtype=np.uint8)
+    # spaces, tabs, newlines and carriage returns are all at or below the space character
+    is_space = chars <= 32
+
+    # a value starts at every non-space character that follows a space, the line of a value is found from the
+    # positions of the newlines
+    starts = np.flatnonzero(is_space[:-1] & ~is_space[1:])
+    newlines = np.flatnonzero(chars == 10)
+    counts = np.bincount(np.searchsorted(newlines, starts, side='right'), minlength=len(newlines) + 1)
+    return counts[counts > 0]
+
+
+def _parse_block(block, columns=None):
     """
-    Read star.log and .data files from MESA.
+    Parse the header and numeric data of one model block in a MESA output file using a bulk numpy parser.
+
+    Lines that don't have the same number of columns as the first data line are removed, in the same way as the
+    python engine of :func:`read_mesa_output` does. When only a selection of the columns is requested, the number of
+    values on each line is checked against the header before parsing.
+
+    :param block: the text of the block, starting with the line containing the column names
+    :type block: str
+    :param columns: names of the columns to read, if None all columns are read.
+    :type columns: list
+    :return: the data of the block
+    :rtype: rec array
+    """
+    header, _, body = block.lstrip().partition('\n')
+    header = header.split()
+
+    usecols = None
+    if columns is not None:
+        missing = [c for c in columns if c not in header]
+        if len(missing) > 0:
+            raise ValueError("Requested columns {} are not present in the MESA output file".format(missing))
+        usecols = [header.index(c) for c in columns]
+
+        # with usecols, numpy does not notice lines with too many values (e.g. two lines glued together after a
+        # restart), so lines that don't match the header are removed first.
+        counts = _count_tokens(body)
+        if np.any(counts != len(header)):
+            lines = [l for l in body.splitlines() if l.strip()]
+            indices = list(np.where(counts != len(header))[0])
+            body = '\n'.join([l for l, n in zip(lines, counts) if n == len(header)])
+            print("Found and fixed errors on following lines: ", indices)
+        header = list(columns)
 
-    This returns a record array with the global and local parameters (the latter
-    can also be a summary of the evolutionary track instead of a profile if
-    you've given a 'star.log' file.
+    try:
+        model = np.loadtxt(io.StringIO(body), dtype=float, ndmin=2, usecols=usecols)
+    except ValueError:
+        lines = [l for l in body.splitlines() if l.strip()]
+        ncols = len(lines[0].split())
+        indices = [i for i, l in enumerate(lines) if len(l.split()) != ncols]
 
-    The stellar profiles are given from surface to center.
+        for i in reversed(indices):
+            del lines[i]
+        print("Found and fixed errors on following lines: ", indices)
+        model = np.loadtxt(lines, dtype=float, ndmin=2, usecols=usecols)
 
-    Function writen by Pieter DeGroote
+    return np.rec.fromarrays(model.T, names=header)
 
-    :param filename: name of the log file
-    :type filename: str
-    :param only_first: read only the first model (or global parameters)
-    :type only_first: bool
-    :return: list of models in the data file (typically global parameters, local parameters)
-    :rtype: list of rec arrays
+
+def _read_mesa_output_fast(filename, only_first=False, columns=None):
+    """
+    Block based parser for MESA output files. The file is read in one go, the start of all model blocks is located
+    with a regular expression and the numerical data of each block is handed to a bulk numpy parser.
+
+    See :func:`read_mesa_output` for the description of the parameters.
+    """
+    with open(filename, 'r') as ff:
+        text = ff.read()
+
+    if os.path.splitext(filename)[1] == '.diff':
+        # -- skip first 5 lines when difference file, the block starts directly with the header
+        start = 0
+        for i in range(5):
+            start = text.find('\n', start) + 1
+        block_starts = [start]
+        block_ends = [len(text)]
+    else:
+        # find the start and end of all column numbering lines
+        markers = []
+        for match in _BLOCK_MARKER.finditer('\n' + text):
+            start = match.start()
+            end = text.find('\n', start)
+            end = len(text) if end < 0 else end
+            if _is_column_numbering(text[start:end]):
+                markers.append((start, end))
+
+        block_starts = [end for start, end in markers]
+        block_ends = [start for start, end in markers[1:]] + [len(text)]
+
+    if only_first:
+        block_starts, block_ends = block_starts[:1], block_ends[:1]
+
+    models = [_parse_block(text[start:end]) for start, end in zip(block_starts[:-1], block_ends[:-1])]
+    if len(block_starts) > 0:
+        # the column selection only applies to the last block that contains the actual data
+        data_columns = columns if not only_first or len(block_starts) == 1 else None
+        models.append(_parse_block(text[block_starts[-1]:block_ends[-1]], columns=data_columns))
+
+    return models
+
+
+def _read_mesa_output_python(filename, only_first=False, columns=None):
+    """
+    Line by line parser for MESA output files. Function writen by Pieter DeGroote.
+
+    See :func:`read_mesa_output` for the description of the parameters.
     """
     models = []
     new_model = False
@@ -80,138 +192,586 @@ def read_mesa_output(filename=None, only_first=False):
 
         models[-1] = np.rec.fromarrays(model, names=header)
 
+        if columns is not None:
+            models[-1] = rf.repack_fields(models[-1][list(columns)])
+
     return models
 
 
-def get_end_log_file(logfile):
-    if os.path.isfile(logfile):
-        # case for models ran locally
-        ifile = open(logfile)
-        lines = ifile.readlines()
-        ifile.close()
+def read_mesa_output(filename=None, only_first=False, columns=None, engine='fast'):
+    """
+    Read star.log and .data files from MESA.
+
+    This returns a record array with the global and local parameters (the latter
+    can also be a summary of the evolutionary track instead of a profile if
+    you've given a 'star.log' file.
+
+    The stellar profiles are given from surface to center.
+
+    Two parsing engines are available. The 'fast' engine locates the header and data blocks in the file once, and
+    parses the numerical data of each block in bulk with numpy. The 'python' engine reads the file line by line and
+    is kept for comparison. Both engines remove lines that don't have the correct number of columns from the data.
 
-        return lines[-30:-1]
+    When a list of **columns** is given, only those columns are returned for the data block (the last block in the
+    file, for history and profile files the block after the global parameters). With the 'fast' engine, the column
+    indices are resolved from the header and only the requested columns are converted to float, so that CPU time and
+    memory use scale with the number of requested columns instead of the width of the file. A ValueError is raised
+    when a requested column is not present in the file.
+
+    :param filename: name of the log file
+    :type filename: str
+    :param only_first: read only the first model (or global parameters)
+    :type only_first: bool
+    :param columns: names of the columns to read from the data block, if None all columns are read.
+    :type columns: list
+    :param engine: which parser to use: 'fast' or 'python'
+    :type engine: str
+    :return: list of models in the data file (typically global parameters, local parameters)
+    :rtype: list of rec arrays
+    """
+    if columns is not None:
+        # remove duplicate columns while keeping the requested order
+        columns = list(dict.fromkeys(columns))
+
+    if engine == 'fast':
+        return _read_mesa_output_fast(filename, only_first=only_first, columns=columns)
+    elif engine == 'python':
+        return _read_mesa_output_python(filename, only_first=only_first, columns=columns)
     else:
+        raise ValueError("Engine {} not recognized, use 'fast' or 'python'".format(engine))
+
+
+def read_column_names(filename):
+    """
+    Read the names of the data columns of a MESA history or profile file without parsing the data. These are the
+    column names of the last block in the file, which for history and profile files is the block with the model data.
+
+    :param filename: path to the mesa output file
+    :type filename: str
+    :return: the names of the data columns
+    :rtype: list
+    """
+    names = []
+    n_blocks = 0
+    with open(filename, 'r') as ff:
+        previous = None
+        for line in ff:
+            if previous is not None and previous.strip() and _is_column_numbering(previous):
+                names = line.split()
+                n_blocks += 1
+                if n_blocks == 2:
+                    break
+            previous = line
+
+    return names
+
+
+def get_end_log_file(logfile, n_lines=30, block_size=8192):
+    """
+    Read the end of a MESA log file: the last n_lines lines of the file, excluding the very last line. The file is
+    read backwards in blocks starting from the end, so the time needed doesn't depend on the size of the log file.
+
+    :param logfile: path to the log file
+    :type logfile: str
+    :param n_lines: the number of lines at the end of the file to read
+    :type n_lines: int
+    :param block_size: the number of bytes read at once
+    :type block_size: int
+    :return: the lines at the end of the file, an empty list if the log file doesn't exist
+    :rtype: list
+    """
+    if not os.path.isfile(logfile):
+        return []
+
+    with open(logfile, 'rb') as ff:
+        ff.seek(0, os.SEEK_END)
+        position = ff.tell()
+        data = b''
+        # the first line read is possibly incomplete, so one extra line break is needed
+        while position > 0 and data.count(b'\n') <= n_lines:
+            size = min(block_size, position)
+            position -= size
+            ff.seek(position)
+            data = ff.read(size) + data
+
+    # split in lines the same way as reading the file in text mode does
+    text = data.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    last_line = lines.pop()
+    lines = [line + '\n' for line in lines] + ([last_line] if last_line else [])
+    if position > 0:
+        lines = lines[1:]
+
+    return lines[-n_lines:-1]
+
+
+def get_termination_code(logfile, n_lines=30):
+    """
+    Find the termination code of a MESA run in the last lines of the log file.
+
+    :param logfile: path to the log file
+    :type logfile: str
+    :param n_lines: the number of lines at the end of the log file to search
+    :type n_lines: int
+    :return: the termination code, or 'uk' if it can't be found
+    :rtype: str
+    """
+    for line in reversed(get_end_log_file(logfile, n_lines=n_lines)):
+        if 'termination code' in line:
+            return line.split()[-1]
+
+    return 'uk'
+
+
+def _get_output_file(output_path, model_path):
+    """
+    Rather annoying way to assure that Path doesn't cut of part of the folder name when adding the .h5 suffix
+    if not this will happen: M1.080_M0.502_P192.67_Z0.01129 -> M1.080_M0.502_P192.67_Z0.h5
+    """
+    output_file = Path(output_path, model_path)
+    return output_file.with_suffix(output_file.suffix + '.h5')
+
+
+def _get_profile_paths(model_path, profile_files=None, profiles_path='', profile_pattern='*.profile'):
+    """ the paths of all profile files of a model that should be included """
+    if profile_files is None:
         return []
+    if profile_files == 'all':
+        return sorted(Path(model_path, profiles_path).glob(profile_pattern))
+    return [Path(model_path, profiles_path, p) for p in profile_files]
+
 
+def _file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as ff:
+        for block in iter(lambda: ff.read(2**20), b''):
+            md5.update(block)
+    return md5.hexdigest()
 
-def convert2hdf5(modellist, star_columns=None, binary_columns=None, profile_columns=None,
-                 add_stopping_condition=True, skip_existing=True,
+
+def _get_source_paths(model_path, star1_history_file='LOGS/history1.data', star2_history_file='LOGS/history2.data',
+                      binary_history_file='LOGS/binary_history.data', log_file='log.txt', profile_files=None,
+                      profiles_path='', profile_pattern='*.profile', add_stopping_condition=True, **kwargs):
+    """ all existing MESA output files used to compress a model, by their path relative to the model directory """
+    files = [star1_history_file, star2_history_file, binary_history_file]
+    if add_stopping_condition:
+        files.append(log_file)
+    files = [Path(model_path, f) for f in files if f is not None]
+    files += _get_profile_paths(model_path, profile_files, profiles_path, profile_pattern)
+
+    return {Path(f).relative_to(model_path).as_posix(): Path(f) for f in files if Path(f).is_file()}
+
+
+def get_source_files(model_path, **kwargs):
+    """
+    Get the size, modification time and md5 hash of all MESA output files that are used to compress a model: the
+    history files, the log file and the profiles. The keyword arguments are the compress setup parameters that
+    define the location of these files (star1_history_file, log_file, profile_files, ...), other keyword arguments
+    are ignored.
+
+    :param model_path: the directory of the MESA model
+    :type model_path: str
+    :return: dictionary with as keys the paths of the files relative to the model directory, and as values a list of
+             size, mtime and md5 hash
+    :rtype: dict
+    """
+    sources = {}
+    for name, filename in _get_source_paths(model_path, **kwargs).items():
+        stat = os.stat(filename)
+        sources[name] = [stat.st_size, stat.st_mtime, _file_md5(filename)]
+
+    return sources
+
+
+def sources_changed(model_path, stored_sources, **kwargs):
+    """
+    Check if the MESA output files of a model changed compared to the sizes, modification times and md5 hashes
+    recorded by :func:`get_source_files`. Files with the same size and modification time are considered unchanged,
+    files of which only the modification time changed are compared by their md5 hash. Adding or removing a file
+    (for example a new profile) also counts as a change. When the hash of a file matches, its new modification time
+    is written to stored_sources, so that the file does not need to be hashed again the next time.
+
+    :param model_path: the directory of the MESA model
+    :type model_path: str
+    :param stored_sources: the recorded sources
+    :type stored_sources: dict
+    :return: True if any of the source files changed
+    :rtype: bool
+    """
+    files = _get_source_paths(model_path, **kwargs)
+
+    if set(files.keys()) != set(stored_sources.keys()):
+        return True
+
+    for name, filename in files.items():
+        size, mtime, md5 = stored_sources[name]
+        stat = os.stat(filename)
+        if stat.st_size != size:
+            return True
+        if stat.st_mtime != mtime:
+            if _file_md5(filename) != md5:
+                return True
+            stored_sources[name] = [size, stat.st_mtime, md5]
+
+    return False
+
+
+def read_model(model, star_columns=None, binary_columns=None, profile_columns=None, history_columns=None,
+               add_stopping_condition=True,
+               star1_history_file='LOGS/history1.data', star2_history_file='LOGS/history2.data',
+               binary_history_file='LOGS/binary_history.data', log_file='log.txt',
+               profile_files=None, profiles_path='', profile_pattern='*.profile',
+               input_path_kw='path', input_path_prefix='', record_sources=False):
+    """
+    Read all the requested MESA output of one model and combine it in a dictionary with the structure of the
+    compressed hdf5 file. If one of the requested history files can not be read, an IOError is raised that mentions
+    which history file is the problem.
+
+    See :func:`convert2hdf5` for the description of the parameters.
+
+    :param model: the row of the model list describing this model
+    :type model: pandas Series
+    :param record_sources: if True, store the size, modification time and md5 hash of the MESA output files in the
+                           extra_info (see :func:`get_source_files`). This reads every file in full, and is only
+                           needed for incremental compression.
+    :type record_sources: bool
+    :return: the data to store in the compressed hdf5 file
+    :rtype: dict
+    """
+    model_path = Path(input_path_prefix, model[input_path_kw])
+
+    # store all columns of the input file in the hdf5 file
+    data = {}
+    extra_info = {}
+    for col in model.index:
+        extra_info[col] = model[col]
+
+    # obtain the termination code and store if requested
+    termination_code = 'uk'
+    if add_stopping_condition:
+        termination_code = get_termination_code(Path(model_path, log_file))
+
+    extra_info['termination_code'] = termination_code
+
+    # store the nnaps-version in the output data.
+    extra_info['nnaps-version'] = __version__
+
+    # store size, modification time and hash of the MESA output, to detect changes when compressing incrementally.
+    if record_sources:
+        extra_info['source_files'] = json.dumps(get_source_files(
+            model_path, star1_history_file=star1_history_file, star2_history_file=star2_history_file,
+            binary_history_file=binary_history_file, log_file=log_file, profile_files=profile_files,
+            profiles_path=profiles_path, profile_pattern=profile_pattern,
+            add_stopping_condition=add_stopping_condition))
+
+    data['extra_info'] = extra_info
+
+    if history_columns is not None:
+        history_columns = fileio._expand_columns(history_columns)
+
+    # check if all history files that are requested are available and can be read.
+    history = {}
+    for name, history_file, columns, suffix in [('star1', star1_history_file, star_columns, ''),
+                                                ('star2', star2_history_file, star_columns, '_2'),
+                                                ('binary', binary_history_file, binary_columns, '')]:
+        if history_file is None:
+            continue
+        try:
+            if columns is None and history_columns is not None:
+                # only keep the columns of this file that are used in the combined history
+                columns = [c for c in read_column_names(Path(model_path, history_file))
+                           if c == 'model_number' or c + suffix in history_columns]
+            history[name] = read_mesa_output(Path(model_path, history_file), columns=columns)[1]
+        except Exception as e:
+            raise IOError("Error in reading {}: {}".format(name, e))
+
+    data['history'] = history
+
+    # check if profiles exists and store them is requested. Also make a profile lookup table (legend)
+    profiles = {}
+    profile_legend = []
+    profile_name_length = 0 # store longest profile name to create recarray of profile_legend
+    if profile_files is not None:
+        profile_paths = _get_profile_paths(model_path, profile_files, profiles_path, profile_pattern)
+
+        for filepath in profile_paths:
+            if not filepath.is_file():
+                continue
+
+            profile_name = filepath.stem
+            header, profile_data = read_mesa_output(filename=filepath, only_first=False, columns=profile_columns)
+            profiles[profile_name] = profile_data
+
+            if len(profile_name) > profile_name_length:
+                profile_name_length = len(profile_name)
+            profile_legend.append((header['model_number'], profile_name))
+
+    if len(profiles.keys()) >= 1:
+        data['profiles'] = profiles
+        profile_legend = np.array(profile_legend, dtype=[('model_number', 'f8'),
+                                                         ('profile_name', 'a'+str(profile_name_length))])
+        data['profile_legend'] = profile_legend
+
+    return data
+
+
+def _data_size(data):
+    """ the size in bytes of all arrays in a (nested) dictionary """
+    if type(data) == dict:
+        return sum([_data_size(value) for value in data.values()])
+    return np.asarray(data).nbytes
+
+
+def _read_stored_sources(filename):
+    """ read the recorded source files of a compressed model, None if they are not recorded """
+    with h5py.File(filename, 'r') as hdf:
+        if 'extra_info/source_files' not in hdf:
+            return None
+        sources = hdf['extra_info/source_files'][()]
+
+    if isinstance(sources, bytes):
+        sources = sources.decode('UTF-8')
+    return json.loads(sources)
+
+
+def _compress_model(model, skip_existing=True, incremental=False, output_path=None, compression=None,
+                    compression_opts=None, shuffle=False, chunks=None, **kwargs):
+    """
+    Compress one model and catch any errors that occur, so that the result can be reported by the main process.
+    When incremental is True, an existing compressed model is only compressed again when its MESA output changed.
+
+    :return: path, status, message and compression ratio. The status is 'compressed', 'skipped' or 'failed'. The
+             compression ratio is the size of the data read from the MESA output divided by the size of the hdf5
+             file, and is nan if the model is not compressed.
+    :rtype: tuple
+    """
+    model_path = model[kwargs.get('input_path_kw', 'path')]
+
+    try:
+        if not os.path.isdir(Path(kwargs.get('input_path_prefix', ''), model_path)):
+            return model_path, 'failed', 'model directory does not exist', np.nan
+
+        output_file = _get_output_file(output_path, model_path)
+
+        message = ''
+        if incremental and os.path.isfile(output_file):
+            stored_sources = _read_stored_sources(output_file)
+            if stored_sources is not None:
+                recorded = json.dumps(stored_sources)
+                if not sources_changed(Path(kwargs.get('input_path_prefix', ''), model_path), stored_sources,
+                                       **kwargs):
+                    if json.dumps(stored_sources) != recorded:
+                        # only modification times changed, store them to not hash these files again
+                        fileio.write2hdf5({'extra_info': {'source_files': json.dumps(stored_sources)}}, output_file,
+                                          update=True)
+                    return model_path, 'skipped', 'unchanged', np.nan
+            message = 'changed, '
+
+        elif skip_existing and os.path.isfile(output_file):
+            return model_path, 'skipped', 'exists', np.nan
+
+        data = read_model(model, record_sources=incremental, **kwargs)
+        fileio.write2hdf5(data, output_file, update=False, compression=compression,
+                          compression_opts=compression_opts, shuffle=shuffle, chunks=chunks)
+
+        ratio = _data_size(data) / os.path.getsize(output_file)
+
+    except Exception as e:
+        return model_path, 'failed', str(e), np.nan
+
+    return model_path, 'compressed', message + 'ratio {:.2f}'.format(ratio), ratio
+
+
+def _read_grid_model(model, existing=(), **kwargs):
+    """
+    Read one model for storage in a grid file and catch any errors that occur. The data is returned to the main
+    process which writes it to the grid.
+
+    :return: path, status, message and the data of the model. The status is 'read', 'skipped' or 'failed'.
+    :rtype: tuple
+    """
+    model_path = model[kwargs.get('input_path_kw', 'path')]
+
+    try:
+        if not os.path.isdir(Path(kwargs.get('input_path_prefix', ''), model_path)):
+            return model_path, 'failed', 'model directory does not exist', None
+
+        if str(model_path) in existing:
+            return model_path, 'skipped', 'exists', None
+
+        data = read_model(model, **kwargs)
+
+    except Exception as e:
+        return model_path, 'failed', str(e), None
+
+    return model_path, 'read', '', data
+
+
+def _get_grid_file(output_path, shard):
+    return Path(output_path, 'grid_{:04d}.h5'.format(shard))
+
+
+def _open_grid_store(output_path, skip_existing=True):
+    """
+    Find the grid files in the output path. If skip_existing is True, the paths of all models that are already
+    stored are returned together with the last shard and the number of models in it, so that new models are appended.
+    Otherwise the existing grid files are removed.
+
+    :return: paths of existing models, number of the last shard, number of models in the last shard
+    :rtype: set, int, int
+    """
+    grid_files = sorted(Path(output_path).glob('grid_*.h5'))
+
+    if not skip_existing:
+        for filename in grid_files:
+            os.remove(filename)
+        return set(), 0, 0
+
+    existing, n_models = set(), 0
+    for filename in grid_files:
+        index = fileio.read_grid_index(filename)
+        existing.update(index['path'])
+        n_models = len(index)
+
+    return existing, max(len(grid_files) - 1, 0), n_models
+
+
+def convert2hdf5(modellist, star_columns=None, binary_columns=None, profile_columns=None, history_columns=None,
+                 add_stopping_condition=True, skip_existing=True, incremental=False,
                  star1_history_file='LOGS/history1.data', star2_history_file='LOGS/history2.data',
                  binary_history_file='LOGS/binary_history.data', log_file='log.txt',
                  profile_files=None, profiles_path='', profile_pattern='*.profile',
-                 input_path_kw='path', input_path_prefix='', output_path=None, verbose=False):
+                 input_path_kw='path', input_path_prefix='', output_path=None, compression='gzip', compression_opts=None,
+                 shuffle=True, chunks=None, grid=False, shard_size=None, n_jobs=1, verbose=False):
+    """
+    Compress all MESA models in the model list to hdf5 files, one file per model, stored in the output path.
+
+    With **grid** set to True, all models are instead appended to one grid file (grid_0000.h5) in the output path,
+    see :func:`~nnaps.mesa.fileio.append_to_grid`. When **shard_size** is given, a new grid file (grid_0001.h5, ...)
+    is started after every shard_size models. The models are read in parallel, but only the main process writes to
+    the grid. With skip_existing, models already present in the grid are skipped and new models are appended,
+    otherwise existing grid files in the output path are replaced.
+
+    All models are independent of each other, and they can be compressed in parallel by setting **n_jobs** to the
+    number of processes to use (-1 uses all available cores). The progress is reported in the order of the model list.
+    Errors that occur while compressing a model are caught and reported instead of stopping the compression, and a
+    summary of the compressed, skipped and failed models is printed at the end.
+
+    :param modellist: list of all models to compress, with at least the column given by input_path_kw
+    :type modellist: pandas DataFrame
+    :param history_columns: when star_columns or binary_columns are not given, only store the columns of the history
+                            files that appear in this list. The names are those of the combined history as returned
+                            by :func:`~nnaps.mesa.fileio.read_compressed_track`, and can be obtained for an
+                            extraction setup with :func:`~nnaps.mesa.extract_mesa.get_required_columns`.
+    :type history_columns: list
+    :param compression: the compression filter used for the hdf5 datasets: None, 'gzip' or 'lzf'
+    :type compression: str
+    :param compression_opts: the compression level when using gzip (0-9), None for the default level 4. Ignored by
+                             the other filters.
+    :type compression_opts: int
+    :param shuffle: if True, apply the shuffle filter before compression
+    :type shuffle: bool
+    :param chunks: the chunk shape of the datasets: None to let h5py choose, or the number of rows per chunk
+    :type chunks: int
+    :param skip_existing: if True, don't compress models of which the compressed file already exists
+    :type skip_existing: bool
+    :param incremental: if True, only compress models that are new or of which the MESA output changed since they
+                        were compressed. The size, modification time and md5 hash of the MESA output files are
+                        stored in the extra_info of each compressed model, see :func:`get_source_files`. These
+                        are only recorded when compressing with incremental. Not supported in combination with
+                        grid.
+    :type incremental: bool
+    :param grid: if True, store all models in grid files instead of one file per model
+    :type grid: bool
+    :param shard_size: the maximum number of models per grid file, None to store all models in one grid file
+    :type shard_size: int
+    :param n_jobs: the number of processes to use
+    :type n_jobs: int
+    :param verbose: if True, print the progress for each model
+    :type verbose: bool
+    :return: summary with the path, status, an error message (if any) and the compression ratio for each model
+    :rtype: pandas DataFrame
+    """
+
+    if grid and incremental:
+        raise ValueError('Incremental compression is not supported for grid files, models can not be replaced in '
+                         'a grid. Use skip_existing to only add new models to a grid.')
 
     if not os.path.isdir(output_path):
         os.mkdir(output_path)
 
-    for i, model in modellist.iterrows():
+    # empty column lists mean that all columns are kept. Only the requested columns are parsed from the MESA files.
+    star_columns = star_columns if star_columns else None
+    binary_columns = binary_columns if binary_columns else None
+    profile_columns = profile_columns if profile_columns else None
+    history_columns = history_columns if history_columns else None
+
+    read_kwargs = dict(star_columns=star_columns, binary_columns=binary_columns, profile_columns=profile_columns,
+                       history_columns=history_columns, add_stopping_condition=add_stopping_condition,
+                       star1_history_file=star1_history_file, star2_history_file=star2_history_file,
+                       binary_history_file=binary_history_file, log_file=log_file, profile_files=profile_files,
+                       profiles_path=profiles_path, profile_pattern=profile_pattern, input_path_kw=input_path_kw,
+                       input_path_prefix=input_path_prefix)
+    filter_kwargs = dict(compression=compression, compression_opts=compression_opts, shuffle=shuffle, chunks=chunks)
+
+    if grid:
+        existing, shard, n_in_shard = _open_grid_store(output_path, skip_existing=skip_existing)
+        compress_model = functools.partial(_read_grid_model, existing=existing, **read_kwargs)
+        grid_data_size = 0
+    else:
+        compress_model = functools.partial(_compress_model, skip_existing=skip_existing, incremental=incremental,
+                                           output_path=output_path, **filter_kwargs, **read_kwargs)
 
-        print(input_path_prefix, model[input_path_kw])
+    models = [model for i, model in modellist.iterrows()]
 
-        if not os.path.isdir(Path(input_path_prefix, model[input_path_kw])):
-            continue
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
 
-        if skip_existing and os.path.isfile(Path(output_path, model[input_path_kw]).with_suffix('.h5')):
+    if n_jobs == 1:
+        results = map(compress_model, models)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs)
+        results = pool.imap(compress_model, models)
+
+    summary = []
+    try:
+        # imap returns the results in the order of the model list
+        for i, result in enumerate(results):
+            if grid:
+                path, status, message, data = result
+                if status == 'read':
+                    if shard_size is not None and n_in_shard >= shard_size:
+                        shard, n_in_shard = shard + 1, 0
+                    try:
+                        fileio.append_to_grid(_get_grid_file(output_path, shard), data, path, **filter_kwargs)
+                        status, message = 'compressed', _get_grid_file(output_path, shard).name
+                        grid_data_size += _data_size(data)
+                        n_in_shard += 1
+                    except Exception as e:
+                        status, message = 'failed', str(e)
+                # the compression ratio can only be determined for the grid as a whole
+                result = path, status, message, np.nan
+            summary.append(result)
             if verbose:
-                print(i, model[input_path_kw], ': exists, skipping')
-            continue
-
-        if verbose:
-            print(i, model[input_path_kw], ': processing')
-
-        # store all columns of the input file in the hdf5 file
-        data = {}
-        extra_info = {}
-        for col in model.index:
-            extra_info[col] = model[col]
-
-        # obtain the termination code and store if requested
-        termination_code = 'uk'
-        if add_stopping_condition:
-            lines = get_end_log_file(Path(input_path_prefix, model[input_path_kw], log_file))
-            for line in lines:
-                if 'termination code' in line:
-                    termination_code = line.split()[-1]
-
-        extra_info['termination_code'] = termination_code
-
-        # store the nnaps-version in the output data.
-        extra_info['nnaps-version'] = __version__
-
-        data['extra_info'] = extra_info
-
-        # check if all history files that are requested are available and can be read. If there is an error,
-        # skip to the next model
-        history = {}
-        if star1_history_file is not None:
-            try:
-                d1 = read_mesa_output(Path(input_path_prefix, model[input_path_kw], star1_history_file))[1]
-                if star_columns is not None:
-                    d1 = rf.repack_fields(d1[star_columns])
-                history['star1'] = d1
-            except Exception as e:
-                if verbose:
-                    print("Error in reading star1: ", e)
-                continue
-
-        if star2_history_file is not None:
-            try:
-                d2 = read_mesa_output(Path(input_path_prefix, model[input_path_kw], star2_history_file))[1]
-                if star_columns is not None:
-                    d2 = rf.repack_fields(d2[star_columns])
-                history['star2'] = d2
-            except Exception as e:
-                if verbose:
-                    print("Error in reading star2: ", e)
-                continue
-
-        if binary_history_file is not None:
-            try:
-                d3 = read_mesa_output(Path(input_path_prefix, model[input_path_kw], binary_history_file))[1]
-                if star_columns is not None:
-                    d3 = rf.repack_fields(d3[binary_columns])
-                history['binary'] = d3
-            except Exception as e:
-                if verbose:
-                    print("Error in reading binary: ", e)
-                continue
-
-        data['history'] = history
-
-        # check if profiles exists and store them is requested. Also make a profile lookup table (legend)
-        profiles = {}
-        profile_legend = []
-        profile_name_length = 0 # store longest profile name to create recarray of profile_legend
-        if profile_files is not None:
-            if profile_files == 'all':
-                profile_paths = Path(input_path_prefix, model[input_path_kw], profiles_path).glob(profile_pattern)
-            else:
-                profile_paths = [Path(input_path_prefix, model[input_path_kw], profiles_path, p) for p in profile_files]
-
-            for filepath in profile_paths:
-                if not filepath.is_file():
-                    continue
-
-                profile_name = filepath.stem
-                header, profile_data = read_mesa_output(filename=filepath, only_first=False)
-
-                if profile_columns is not None:
-                    profile_data = rf.repack_fields(profile_data[profile_columns])
-                profiles[profile_name] = profile_data
-
-                if len(profile_name) > profile_name_length:
-                    profile_name_length = len(profile_name)
-                profile_legend.append((header['model_number'], profile_name))
-
-        if len(profiles.keys()) >= 1:
-            data['profiles'] = profiles
-            profile_legend = np.array(profile_legend, dtype=[('model_number', 'f8'),
-                                                             ('profile_name', 'a'+str(profile_name_length))])
-            data['profile_legend'] = profile_legend
-
-        # rather annoying way to assure that Path doesn't cut of part of the folder name when adding the .h5 suffix
-        # if not this will happen: M1.080_M0.502_P192.67_Z0.01129 -> M1.080_M0.502_P192.67_Z0.h5
-        output_file = Path(output_path, model[input_path_kw])
-        output_file = output_file.with_suffix(output_file.suffix + '.h5')
-        fileio.write2hdf5(data, output_file, update=False)
+                path, status, message, ratio = result
+                print('[{}/{}] {}: {} {}'.format(i + 1, len(models), path, status, message))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    summary = pd.DataFrame(data=summary, columns=['path', 'status', 'message', 'compression_ratio'])
+
+    counts = summary['status'].value_counts()
+    print('Compressed: {}, skipped: {}, failed: {}'.format(counts.get('compressed', 0), counts.get('skipped', 0),
+                                                           counts.get('failed', 0)))
+    if grid and grid_data_size > 0 and len(existing) == 0:
+        grid_size = sum([os.path.getsize(f) for f in Path(output_path).glob('grid_*.h5')])
+        print('Grid compression ratio: {:.2f}'.format(grid_data_size / grid_size))
+    elif counts.get('compressed', 0) > 0:
+        print('Average compression ratio: {:.2f}'.format(summary['compression_ratio'].mean()))
+    for i, model in summary[summary['status'] == 'failed'].iterrows():
+        print('  failed: {}: {}'.format(model['path'], model['message']))
+
+    return summary
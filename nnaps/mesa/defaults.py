@@ -4,6 +4,7 @@ defaults_2h5 = {
     'star_columns': None,
     'binary_columns': None,
     'profile_columns': None,
+    'history_columns': None,
     'add_stopping_condition': True,
     'input_path_kw': 'path',
     'input_path_prefix': '',
@@ -14,6 +15,12 @@ defaults_2h5 = {
     'profiles_path': '',
     'profile_pattern': '*.profile',
     'log_file': 'log.txt',
+    'compression': 'gzip',
+    'compression_opts': None,
+    'shuffle': True,
+    'chunks': None,
+    'grid': False,
+    'shard_size': None,
     }
 
 default_extract = {
@@ -1,10 +1,16 @@
 
 import numpy as np
 
-from nnaps.mesa.evolution_phases import _check_history_parameters, HeIgF
+from nnaps.mesa.evolution_phases import _check_history_parameters, _get_context
 
+# history parameters used by each error check
+ERROR_PARAMETERS = {'mass_loss_error': ['lg_mstar_dot_1', 'lg_wind_mdot_1'],
+                    'he_ignition_error': ['age', 'log_LHe', 'log_center_T', 'log_center_Rho'],
+                    'he_core_burning_error': ['c_core_mass', 'log_center_T', 'log_center_Rho'],
+                    }
 
-def mass_loss_error(history):
+
+def mass_loss_error(history, context=None):
     """
     Check if there is a possible issue with mass loss. This function checks if RLOF is still ongoing when the model
     stops. For a stable model this would be an indication that something is wrong.
@@ -15,19 +21,20 @@ def mass_loss_error(history):
 
     :param history: the evolution history of the system.
     :type history: numpy ndarray
+    :param context: PhaseContext of this history, used to share the mass loss rate with the phase detection
     :return: True if there is a mass loss error, else False
     """
 
-    required_parameters = ['lg_mstar_dot_1', 'lg_wind_mdot_1']
+    required_parameters = ERROR_PARAMETERS['mass_loss_error']
     if not _check_history_parameters(history, required_parameters, evol_phase='ML error', raise_error=False):
         return False
 
-    mass_loss = np.log10(10 ** history['lg_mstar_dot_1'] - 10 ** history['lg_wind_mdot_1'])
+    mass_loss = _get_context(history, context).mass_loss('rlof')
 
     return mass_loss[-1] > -10
 
 
-def he_ignition_error(history):
+def he_ignition_error(history, context=None):
     """
     Check if there are issues with He ignition. The function checks if there is ignition but no actual core He
     burning, and also if there is a ramp up to ignition, but the ignition itself is unsuccessful.
@@ -40,14 +47,17 @@ def he_ignition_error(history):
 
     :param history: the evolution history of the system.
     :type history: numpy ndarray
+    :param context: PhaseContext of this history, used to share the He ignition temperature with the phase detection
     :return: True if there is a He ignition error, else False
     """
-    required_parameters = ['age', 'log_LHe', 'log_center_T', 'log_center_Rho']
+    required_parameters = ERROR_PARAMETERS['he_ignition_error']
     if not _check_history_parameters(history, required_parameters, evol_phase='He ignition error', raise_error=False):
         return False
 
+    ignition_temperature = _get_context(history, context).he_ignition_temperature()
+
     # Check if there is a ramp-up to He ignition, but no actual ignition. Check the last 2000 points
-    if np.all(history['log_center_T'] < HeIgF(history['log_center_Rho'])) and np.all(history['log_LHe'] < 1):
+    if np.all(history['log_center_T'] < ignition_temperature) and np.all(history['log_LHe'] < 1):
         d = history[history['age'] > history[history['log_LHe'] > -50]['age'][0]]
         if len(d) > 5000:
             log_LHe = d['log_LHe'][-5000:]
@@ -57,13 +67,13 @@ def he_ignition_error(history):
                 return True
 
     # Check if there is He ignition but no core burning
-    if np.any(history['log_LHe'] > 1) and np.all(history['log_center_T'] < HeIgF(history['log_center_Rho'])):
+    if np.any(history['log_LHe'] > 1) and np.all(history['log_center_T'] < ignition_temperature):
         return True
 
     return False
 
 
-def he_core_burning_error(history):
+def he_core_burning_error(history, context=None):
     """
     Check if there is an issue with He core burning. The function checks if core He burning starts, but never ends
     before the end of the evolution.
@@ -75,19 +85,21 @@ def he_core_burning_error(history):
 
     :param history: the evolution history of the system.
     :type history: numpy ndarray
+    :param context: PhaseContext of this history, used to share the He ignition temperature with the phase detection
     :return: True if there is a He core burning error, else False
     """
-    required_parameters = ['c_core_mass', 'log_center_T', 'log_center_Rho']
+    required_parameters = ERROR_PARAMETERS['he_core_burning_error']
     if not _check_history_parameters(history, required_parameters, evol_phase='He ignition error', raise_error=False):
         return False
 
-    if np.any(history['log_center_T'] >= HeIgF(history['log_center_Rho'])) and np.all(history['c_core_mass'] < 0.01):
+    ignition_temperature = _get_context(history, context).he_ignition_temperature()
+    if np.any(history['log_center_T'] >= ignition_temperature) and np.all(history['c_core_mass'] < 0.01):
         return True
     else:
         return False
 
 
-def check_error_flags(history, termination_code):
+def check_error_flags(history, termination_code, context=None):
     """
     Check for some possible errors in the model and report them.
 
@@ -107,6 +119,8 @@ def check_error_flags(history, termination_code):
     :type history: numpy ndarray
     :param termination_code: the termination code of the mesa model
     :type termination_code: str
+    :param context: PhaseContext of this history, shared between the checks and with the phase detection
+    :type context: PhaseContext
     :return: list of integers with error codes
     """
 
@@ -119,15 +133,15 @@ def check_error_flags(history, termination_code):
         error_codes.append(2)
 
     # Check Mass loss error
-    if mass_loss_error(history):
+    if mass_loss_error(history, context=context):
         error_codes.append(3)
 
     # Check He ignition error
-    if he_ignition_error(history):
+    if he_ignition_error(history, context=context):
         error_codes.append(4)
 
     # check He core burning errors
-    if he_core_burning_error(history):
+    if he_core_burning_error(history, context=context):
         error_codes.append(5)
 
     return error_codes
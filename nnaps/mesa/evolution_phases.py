@@ -9,6 +9,26 @@ AGREGATE_FUNCTIONS = ['max', 'min', 'avg', 'diff', 'rate']
 EVOLUTION_PHASES = ['init', 'final', 'MS', 'RGB', 'ML', 'MLstart', 'MLend', 'CE', 'CEstart', 'CEend', 'HeIgnition',
                     'HeCoreBurning', 'HeShellBurning', 'sdA', 'sdB', 'sdO', 'He-WD']
 
+# history parameters required by each evolution phase
+PHASE_PARAMETERS = {'init': [], 'final': [],
+                    'MS': ['log_L', 'log_LH', 'center_h1', 'age'],
+                    'RGB': ['log_L', 'center_h1', 'center_he4', 'effective_T', 'age'],
+                    'HeIgnition': ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'age'],
+                    'HeCoreBurning': ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'age'],
+                    'HeShellBurning': ['log_LHe', 'c_core_mass', 'age'],
+                    'sdA': ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff', 'log_dt', 'age'],
+                    'sdB': ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff', 'log_dt', 'age'],
+                    'sdO': ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff', 'log_dt', 'age'],
+                    'He-WD': ['log_LHe', 'c_core_mass', 'log_Teff', 'log_g', 'age'],
+                    'CO-WD': ['log_LHe', 'c_core_mass', 'log_Teff', 'log_g', 'age'],
+                    'ML': ['lg_mstar_dot_1', 'lg_wind_mdot_1', 'age'],
+                    'CE': ['CE_phase'],
+                    }
+PHASE_PARAMETERS.update({'MSstart': PHASE_PARAMETERS['MS'], 'MSend': PHASE_PARAMETERS['MS'],
+                         'RGBstart': PHASE_PARAMETERS['RGB'], 'RGBend': PHASE_PARAMETERS['RGB'],
+                         'MLstart': PHASE_PARAMETERS['ML'], 'MLend': PHASE_PARAMETERS['ML'],
+                         'CEstart': PHASE_PARAMETERS['CE'], 'CEend': PHASE_PARAMETERS['CE']})
+
 #{ Load limits for core He burning
 
 base_path = Path(__file__).parent
@@ -89,6 +109,106 @@ def decompose_parameter(par):
 #{ Evolution Phases
 
 
+class PhaseContext(object):
+    """
+    Memoizes the intermediate quantities of one model that are shared between the evolution phases: the He ignition
+    temperature (HeIgF) over the entire history, the start and end ages of each phase, the ML intervals and Teff.
+
+    All phase functions take an optional context argument. When the same context is passed to several phase functions,
+    these quantities are only calculated once, so the cost of detecting many phases is roughly one pass over the
+    history. A context is only valid for the history it was created with.
+
+    If use_slices is True, phases that are a contiguous part of the history are returned as a slice instead of a
+    np.where selection. The start and end of the phase are then found with np.searchsorted on the age, and indexing
+    the history with the selection returns a view instead of a copy. This requires the age to be monotonically
+    increasing, if it is not, the normal np.where selections are returned.
+
+    :param data: numpy ndarray containing the history of the system.
+    :param use_slices: return contiguous phases as slices
+    """
+
+    def __init__(self, data, use_slices=False):
+        self.data = data
+        self.use_slices = use_slices
+        self._memo = {}
+
+    def memoize(self, key, func):
+        """
+        Return the stored value for key, calling func() to calculate it the first time.
+        """
+        if key not in self._memo:
+            self._memo[key] = func()
+        return self._memo[key]
+
+    def he_ignition_temperature(self):
+        """ log of the central temperature needed for He ignition at the central density of each model """
+        return self.memoize('he_ignition_temperature', lambda: HeIgF(self.data['log_center_Rho']))
+
+    def teff(self):
+        """ effective temperature in K """
+        return self.memoize('teff', lambda: 10 ** self.data['log_Teff'])
+
+    def ages(self, phase):
+        """ the age (or start and end age) of the phase, or None if the phase doesn't occur """
+        return self.memoize(('ages', phase), lambda: _PHASE_AGES[phase](self))
+
+    def mass_loss(self, mltype='rlof'):
+        """ the log of the mass loss rate of the given type, see :func:`get_mass_loss` """
+        return self.memoize(('mass_loss', mltype), lambda: get_mass_loss(self.data, mltype))
+
+    def ml_intervals(self, mltype='rlof'):
+        """ list of (start, end) ages of all mass loss phases, or None if there is no mass loss """
+        return self.memoize(('ml_intervals', mltype), lambda: _ml_intervals(self.data, self.mass_loss(mltype)))
+
+    def slices(self):
+        """ True if phases can be returned as slices: requested and the age is monotonically increasing """
+        return self.use_slices and self.memoize('age_sorted', lambda: bool(np.all(np.diff(self.data['age']) >= 0)))
+
+
+def _get_context(data, context):
+    """
+    Return the given context if it belongs to this history, otherwise a new context.
+    """
+    if context is None or context.data is not data:
+        return PhaseContext(data)
+    return context
+
+
+def _use_slices(data, context):
+    """
+    Return True if the phase selections for this history should be returned as slices.
+    """
+    return context is not None and context.data is data and context.slices()
+
+
+def _contiguous_slice(selection):
+    """
+    Convert a np.where selection to a slice if the selected indices are contiguous.
+    """
+    idx = selection[0]
+    if len(idx) > 0 and idx[-1] - idx[0] + 1 == len(idx):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return selection
+
+
+def _first(selection):
+    """
+    The first point of a phase selection (np.where tuple or slice).
+    """
+    if type(selection) == slice:
+        return slice(selection.start, selection.start + 1)
+    return ([selection[0][0]],)
+
+
+def _last(selection):
+    """
+    The last point of a phase selection (np.where tuple or slice).
+    """
+    if type(selection) == slice:
+        return slice(selection.stop - 1, selection.stop)
+    return ([selection[0][-1]],)
+
+
 def _check_history_parameters(history, parameters, evol_phase='UK', raise_error=True):
     """
     Check if all parameters are present in the evolution history of the model. Throws an error if this is not the case
@@ -119,7 +239,7 @@ def _check_history_parameters(history, parameters, evol_phase='UK', raise_error=
     return len(missing_parameters) == 0
 
 
-def _return_function(data, a1, a2, return_start=False, return_end=False, return_age=False):
+def _return_function(data, a1, a2, return_start=False, return_end=False, return_age=False, context=None):
     """
     Helper Function.
     Returns the entire phase, the start or the end depending on the keywords. Written as a separate function as this
@@ -130,7 +250,19 @@ def _return_function(data, a1, a2, return_start=False, return_end=False, return_
     If both return_start and return_end are false, the entire phase is returned.
 
     return_age can be combined with both return_start, return_end or for the entire phase.
+
+    If the context uses slices, the selection is returned as a slice found by np.searchsorted on the age.
     """
+    if not return_age and _use_slices(data, context):
+        if return_start:
+            i = np.searchsorted(data['age'], a1, side='left')
+            return slice(i, i + 1)
+        elif return_end:
+            i = np.searchsorted(data['age'], a2, side='right')
+            return slice(i - 1, i)
+        else:
+            return slice(np.searchsorted(data['age'], a1, side='left'), np.searchsorted(data['age'], a2, side='right'))
+
     if return_start:
         if return_age:
             return a1
@@ -150,7 +282,24 @@ def _return_function(data, a1, a2, return_start=False, return_end=False, return_
             return np.where((data['age'] >= a1) & (data['age'] <= a2))
 
 
-def MS(data, return_age=False, return_start=False, return_end=False):
+def _ms_ages(context):
+    data = context.data
+
+    if not any(10**data['log_LH'] / 10**data['log_L'] > 0.999):
+        # MS is not reached
+        return None
+
+    a1 = data['age'][(10**data['log_LH'] / 10**data['log_L'] > 0.999)][0]
+
+    if not any(data['center_h1'] < 1e-12):
+        a2 = data['age'][-1]
+    else:
+        a2 = data['age'][(data['center_h1'] < 1e-12)][0]
+
+    return a1, a2
+
+
+def MS(data, return_age=False, return_start=False, return_end=False, context=None):
     """
     The Main sequence phase is defined as the phase where hydrogen burning takes place is the core.
 
@@ -170,23 +319,19 @@ def MS(data, return_age=False, return_start=False, return_end=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the main sequence phase
     """
-    required_parameters = ['log_L', 'log_LH', 'center_h1', 'age']
+    required_parameters = PHASE_PARAMETERS['MS']
     _check_history_parameters(data, required_parameters, evol_phase='MS')
 
-    if not any(10**data['log_LH'] / 10**data['log_L'] > 0.999):
+    ages = _get_context(data, context).ages('MS')
+    if ages is None:
         # MS is not reached
         return None
+    a1, a2 = ages
 
-    a1 = data['age'][(10**data['log_LH'] / 10**data['log_L'] > 0.999)][0]
-
-    if not any(data['center_h1'] < 1e-12):
-        a2 = data['age'][-1]
-    else:
-        a2 = data['age'][(data['center_h1'] < 1e-12)][0]
-
-    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end)
+    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end,
+                            context=context)
 
-def MSstart(data, return_age=False):
+def MSstart(data, return_age=False, context=None):
     """
     The Main sequence phase is defined as the phase where hydrogen burning takes place is the core. MSstart defines
     first moment when the star enters the MS.
@@ -204,10 +349,10 @@ def MSstart(data, return_age=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the main sequence phase
     """
-    return MS(data, return_age=return_age, return_start=True)
+    return MS(data, return_age=return_age, return_start=True, context=context)
 
 
-def MSend(data, return_age=False):
+def MSend(data, return_age=False, context=None):
     """
     The Main sequence phase is defined as the phase where hydrogen burning takes place is the core. MSend defines
     last moment when the star is still considered to be on the MS.
@@ -225,10 +370,28 @@ def MSend(data, return_age=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the main sequence phase
     """
-    return MS(data, return_age=return_age, return_end=True)
+    return MS(data, return_age=return_age, return_end=True, context=context)
+
+
+def _rgb_ages(context):
+    data = context.data
 
+    if not any(data['center_h1'] < 1e-12):
+        # RGB phase never started
+        return None
+
+    a1 = data['age'][(data['center_h1'] < 1e-12)][0]
+
+    # select data between start RGB and start of He burning.
+    c_he_tams = data['center_he4'][(data['center_h1'] < 1e-12)][0]
+    drgb = data[(data['center_he4'] >= c_he_tams - 0.01) & (data['center_h1'] < 1e-12)]
+
+    a2 = drgb['age'][(drgb['effective_T'] == np.min(drgb['effective_T'])) | (drgb['log_L'] == np.max(drgb['log_L']))][0]
 
-def RGB(data, return_age=False, return_start=False, return_end=False):
+    return a1, a2
+
+
+def RGB(data, return_age=False, return_start=False, return_end=False, context=None):
     """
     The red giant phase is defined as the phase starting at the end of the MS, and continuing until either a
     minimum in Teff or a maximum in luminosity is reached (whichever comes first) before He burning stars.
@@ -250,25 +413,20 @@ def RGB(data, return_age=False, return_start=False, return_end=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the red giant phase
     """
-    required_parameters = ['log_L', 'center_h1', 'center_he4', 'effective_T', 'age']
+    required_parameters = PHASE_PARAMETERS['RGB']
     _check_history_parameters(data, required_parameters, evol_phase='RGB')
 
-    if not any(data['center_h1'] < 1e-12):
+    ages = _get_context(data, context).ages('RGB')
+    if ages is None:
         # RGB phase never started
         return None
+    a1, a2 = ages
 
-    a1 = data['age'][(data['center_h1'] < 1e-12)][0]
-
-    # select data between start RGB and start of He burning.
-    c_he_tams = data['center_he4'][(data['center_h1'] < 1e-12)][0]
-    drgb = data[(data['center_he4'] >= c_he_tams - 0.01) & (data['center_h1'] < 1e-12)]
+    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end,
+                            context=context)
 
-    a2 = drgb['age'][(drgb['effective_T'] == np.min(drgb['effective_T'])) | (drgb['log_L'] == np.max(drgb['log_L']))][0]
 
-    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end)
-
-
-def RGBstart(data, return_age=False):
+def RGBstart(data, return_age=False, context=None):
     """
     The start of the red giant phase is defined as the moment that the central hydrogen runs out. This phase is
     equivalent with the end of the MS phase:
@@ -285,10 +443,10 @@ def RGBstart(data, return_age=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the red giant phase
     """
-    return RGB(data, return_age=return_age, return_start=True)
+    return RGB(data, return_age=return_age, return_start=True, context=context)
 
 
-def RGBend(data, return_age=False):
+def RGBend(data, return_age=False, context=None):
     """
     The end of the red giant phase is defined as the moment when either a minimum in Teff or a maximum in luminosity is
     reached (whichever comes first) before He burning stars.
@@ -307,10 +465,41 @@ def RGBend(data, return_age=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the red giant phase
     """
-    return RGB(data, return_age=return_age, return_end=True)
+    return RGB(data, return_age=return_age, return_end=True, context=context)
+
+
+def _he_ignition_age(context):
+    data = context.data
+
+    # check the time of max He luminosity which indicates the flash in degenerate igniters
+    if np.all(data['log_LHe'] < 1):
+        # no He ignition
+        return None
 
+    # -- get age of core He ignition
+    ignition_temperature = context.he_ignition_temperature()
+    if np.all(data['log_center_T'] < ignition_temperature):
+        # no core ignition, set He ignition based on log_LHe
+        acore = np.inf
+    else:
+        acore = data['age'][data['log_center_T'] >= ignition_temperature][0]
+
+    # -- get the age of the LHe peak
+    a1 = data['age'][data['log_LHe'] > 1][0]
 
-def HeIgnition(data, return_age=False):
+    if np.all(data['c_core_mass'] < 0.01):
+        # model ignites He, but has problems modeling the core burning. He ignition can be returned.
+        a2 = data['age'][-1]
+    else:
+        a2 = data['age'][data['c_core_mass'] >= 0.01][0]
+
+    d = data[(data['age'] >= a1) & (data['age'] <= a2)]
+    apeak = data['age'][(data['log_LHe'] == np.max(d['log_LHe'])) & (data['age'] >= a1) & (data['age'] <= a2)][0]
+
+    return min(acore, apeak)
+
+
+def HeIgnition(data, return_age=False, context=None):
     """
     The moment of He ignition depends on the mass of the star. For stars with a degenerate core, which will ignite He
     through flashes in a shell around the core, He ignition is based on the He luminosity. For stars that have a non
@@ -339,42 +528,42 @@ def HeIgnition(data, return_age=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the moment of He ignition
     """
-    required_parameters = ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'age']
+    required_parameters = PHASE_PARAMETERS['HeIgnition']
     _check_history_parameters(data, required_parameters, evol_phase='HeIgnition')
 
-    # check the time of max He luminosity which indicates the flash in degenerate igniters
-    if np.all(data['log_LHe'] < 1):
+    aignition = _get_context(data, context).ages('HeIgnition')
+    if aignition is None:
         # no He ignition
         return None
 
-    # -- get age of core He ignition
-    if np.all(data['log_center_T'] < HeIgF(data['log_center_Rho'])):
-        # no core ignition, set He ignition based on log_LHe
-        acore = np.inf
+    if return_age:
+        return aignition
+    elif _use_slices(data, context):
+        return slice(np.searchsorted(data['age'], aignition, side='left'),
+                     np.searchsorted(data['age'], aignition, side='right'))
     else:
-        acore = data['age'][data['log_center_T'] >= HeIgF(data['log_center_Rho'])][0]
+        return np.where((data['age'] == aignition))
 
-    # -- get the age of the LHe peak
-    a1 = data['age'][data['log_LHe'] > 1][0]
 
-    if np.all(data['c_core_mass'] < 0.01):
-        # model ignites He, but has problems modeling the core burning. He ignition can be returned.
-        a2 = data['age'][-1]
-    else:
-        a2 = data['age'][data['c_core_mass'] >= 0.01][0]
+def _he_core_burning_ages(context):
+    data = context.data
 
-    d = data[(data['age'] >= a1) & (data['age'] <= a2)]
-    apeak = data['age'][(data['log_LHe'] == np.max(d['log_LHe'])) & (data['age'] >= a1) & (data['age'] <= a2)][0]
+    ignition_temperature = context.he_ignition_temperature()
+    if np.all(data['log_LHe'] < 1) or np.all(data['log_center_T'] < ignition_temperature):
+        # no He ignition or no core burning
+        return None
+    a1 = data['age'][data['log_center_T'] >= ignition_temperature][0]
 
-    aignition = min(acore, apeak)
+    if np.all(data['c_core_mass'] < 0.01):
+        # model ignites He, but has problems modeling the core burning. No core burning phase can be returned
+        return None
 
-    if return_age:
-        return aignition
-    else:
-        return np.where((data['age'] == aignition))
+    a2 = data['age'][(data['age'] >= a1) & (data['c_core_mass'] <= 0.01)][-1]
 
+    return a1, a2
 
-def HeCoreBurning(data, return_age=False, return_start=False, return_end=False):
+
+def HeCoreBurning(data, return_age=False, return_start=False, return_end=False, context=None):
     """
     He core burning is defined as the period between ignition of He and formation of CO core.
 
@@ -396,24 +585,47 @@ def HeCoreBurning(data, return_age=False, return_start=False, return_end=False):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the He core burning phase
     """
-    required_parameters = ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'age']
+    required_parameters = PHASE_PARAMETERS['HeCoreBurning']
     _check_history_parameters(data, required_parameters, evol_phase='HeCoreBurning')
 
-    if np.all(data['log_LHe'] < 1) or np.all(data['log_center_T'] < HeIgF(data['log_center_Rho'])):
-        # no He ignition or no core burning
+    ages = _get_context(data, context).ages('HeCoreBurning')
+    if ages is None:
+        # no He ignition, no core burning or no CO core formation
+        return None
+    a1, a2 = ages
+
+    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end,
+                            context=context)
+
+
+def _he_shell_burning_ages(context):
+    data = context.data
+
+    if np.all(data['log_LHe'] < 1):
+        # no He ignition
         return None
-    a1 = data['age'][data['log_center_T'] >= HeIgF(data['log_center_Rho'])][0]
 
     if np.all(data['c_core_mass'] < 0.01):
-        # model ignites He, but has problems modeling the core burning. No core burning phase can be returned
+        # no actual core He burning takes place, so no shell burning either.
         return None
 
-    a2 = data['age'][(data['age'] >= a1) & (data['c_core_mass'] <= 0.01)][-1]
+    a1 = data['age'][data['c_core_mass'] >= 0.01][0]
+    LHe_burning = data['log_LHe'][data['age'] == a1][0]
 
-    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end)
+    if len(data['age'][(data['age'] > a1) & (data['log_LHe'] < LHe_burning / 2.)]) > 0:
+        a2 = data['age'][(data['age'] > a1) & (data['log_LHe'] < LHe_burning / 2.)][0]
+    else:
+        try:
+            # end of He shell burning when carbon core gets almost its final mass
+            a2 = data['age'][data['c_core_mass'] >= 0.98 * np.max(data['c_core_mass'])][0]
+        except Exception as e:
+            print(e)
+            a2 = data['age'][-1]
 
+    return a1, a2
 
-def HeShellBurning(data, return_age=False, return_start=False, return_end=False):
+
+def HeShellBurning(data, return_age=False, return_start=False, return_end=False, context=None):
     """
     The He shell burning phase is defined as the period in time between the formation of the CO core, and the final
     drop in He luminosity indicating the end of He burning. This final drop is defined as the time when LHe drops
@@ -433,34 +645,46 @@ def HeShellBurning(data, return_age=False, return_start=False, return_end=False)
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the He shell burning phase
     """
-    required_parameters = [ 'log_LHe', 'c_core_mass', 'age']
+    required_parameters = PHASE_PARAMETERS['HeShellBurning']
     _check_history_parameters(data, required_parameters, evol_phase='HeShellBurning')
 
-    if np.all(data['log_LHe'] < 1):
-        # no He ignition
+    ages = _get_context(data, context).ages('HeShellBurning')
+    if ages is None:
+        # no He ignition or no CO core, so no shell burning either.
         return None
+    a1, a2 = ages
 
-    if np.all(data['c_core_mass'] < 0.01):
-        # no actual core He burning takes place, so no shell burning either.
-        return None
+    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end,
+                            context=context)
 
-    a1 = data['age'][data['c_core_mass'] >= 0.01][0]
-    LHe_burning = data['log_LHe'][data['age'] == a1][0]
 
-    if len(data['age'][(data['age'] > a1) & (data['log_LHe'] < LHe_burning / 2.)]) > 0:
-        a2 = data['age'][(data['age'] > a1) & (data['log_LHe'] < LHe_burning / 2.)][0]
+def _sd_selection(data, context, teff_min, teff_max):
+    """
+    Helper Function.
+    Selects the part of the He core burning phase with Teff between teff_min and teff_max, if the average Teff
+    during He core burning is in that range. Shared by sdA, sdB and sdO.
+    """
+    context = _get_context(data, context)
+
+    ages = context.ages('HeCoreBurning')
+
+    # Core He Burning phase is required
+    if ages is None:
+        return None
     else:
-        try:
-            # end of He shell burning when carbon core gets almost its final mass
-            a2 = data['age'][data['c_core_mass'] >= 0.98 * np.max(data['c_core_mass'])][0]
-        except Exception as e:
-            print(e)
-            a2 = data['age'][-1]
+        a1, a2 = ages
 
-    return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end)
+    teff = context.memoize('HeCoreBurning_teff',
+                           lambda: 10 ** avg_(data[(data['age'] > a1) & (data['age'] < a2)], 'log_Teff'))
 
+    if teff < teff_min or teff >= teff_max:
+        return None
+    else:
+        teff = context.teff()
+        return np.where((data['age'] > a1) & (data['age'] < a2) & (teff >= teff_min) & (teff < teff_max))
 
-def sdA(data):
+
+def sdA(data, context=None):
     """
     This is the evolutionary definition of the sdA phase, which is defined as a core He burning phase where the star
     looks spectroscopically as an sdA star. This is defined as Teff between 15000 and 20000 K.
@@ -481,29 +705,13 @@ def sdA(data):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the sdA phase
     """
-    required_parameters = ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff', 'age']
+    required_parameters = PHASE_PARAMETERS['sdA']
     _check_history_parameters(data, required_parameters, evol_phase='sdA')
 
-    ages = HeCoreBurning(data, return_age=True)
-
-    # Core He Burning phase is required
-    if ages is None:
-        return None
-    else:
-        a1, a2 = ages
+    return _sd_selection(data, context, 15000, 20000)
 
-    d = data[(data['age'] > a1) & (data['age'] < a2)]
 
-    teff = 10**avg_(d, 'log_Teff')
-
-    if teff < 15000 or teff >= 20000:
-        return None
-    else:
-        return np.where((data['age'] > a1) & (data['age'] < a2) &
-                    (10 ** data['log_Teff'] >= 15000) & (10 ** data['log_Teff'] < 20000))
-
-
-def sdB(data):
+def sdB(data, context=None):
     """
     This is the evolutionary definition of the sdB phase, which is defined as a core He burning phase where the star
     looks spectroscopically as an sdB star. This is defined as Teff between 20000 and 40000 K.
@@ -524,29 +732,13 @@ def sdB(data):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the sdB phase
     """
-    required_parameters = ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff', 'age']
+    required_parameters = PHASE_PARAMETERS['sdB']
     _check_history_parameters(data, required_parameters, evol_phase='sdB')
 
-    ages = HeCoreBurning(data, return_age=True)
+    return _sd_selection(data, context, 20000, 40000)
 
-    # Core He Burning phase is required
-    if ages is None:
-        return None
-    else:
-        a1, a2 = ages
-
-    d = data[(data['age'] > a1) & (data['age'] < a2)]
-
-    teff = 10 ** avg_(d, 'log_Teff')
 
-    if teff < 20000 or teff >= 40000:
-        return None
-    else:
-        return np.where((data['age'] > a1) & (data['age'] < a2) &
-                    (10**data['log_Teff'] >= 20000) & (10**data['log_Teff'] < 40000))
-
-
-def sdO(data):
+def sdO(data, context=None):
     """
     This is the evolutionary definition of the sdB phase, which is defined as a core He burning phase where the star
     looks spectroscopically as an sdO star. This is defined as Teff higher than 40000 K.
@@ -567,28 +759,25 @@ def sdO(data):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the sdO phase
     """
-    required_parameters = ['log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff', 'age']
+    required_parameters = PHASE_PARAMETERS['sdO']
     _check_history_parameters(data, required_parameters, evol_phase='sdO')
 
-    ages = HeCoreBurning(data, return_age=True)
-
-    # Core He Burning phase is required
-    if ages is None:
-        return None
-    else:
-        a1, a2 = ages
+    return _sd_selection(data, context, 40000, np.inf)
 
-    d = data[(data['age'] > a1) & (data['age'] < a2)]
 
-    teff = 10 ** avg_(d, 'log_Teff')
+def _wd_start_age(context):
+    data = context.data
 
-    if teff < 40000:
+    # select first point where teff < 10^4 and logg < 7
+    a1 = data['age'][((data['log_Teff'] < 4) & (data['log_g'] > 7)) | (data['log_g'] >= 7.5)]
+    if len(a1) == 0:
+        # WD doesn't start
         return None
     else:
-        return np.where((data['age'] > a1) & (data['age'] < a2) & (10**data['log_Teff'] >= 40000))
+        return a1[0]
 
 
-def He_WD(data):
+def He_WD(data, context=None):
     """
     Defines the He White Dwarf phase, when the star is on the WD cooling track, but still has a He core.
 
@@ -607,7 +796,7 @@ def He_WD(data):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the He-WD phase
     """
-    required_parameters = ['log_LHe', 'c_core_mass', 'log_Teff', 'log_g', 'age']
+    required_parameters = PHASE_PARAMETERS['He-WD']
     _check_history_parameters(data, required_parameters, evol_phase='He_WD')
 
     if np.max(data['log_g']) < 7.0:
@@ -618,18 +807,17 @@ def He_WD(data):
         # sign of He burning
         return None
 
-    # select first point where teff < 10^4 and logg < 7
-    a1 = data['age'][((data['log_Teff'] < 4) & (data['log_g'] > 7)) | (data['log_g'] >= 7.5)]
-    if len(a1) == 0:
+    a1 = _get_context(data, context).ages('WD')
+    if a1 is None:
         # WD doesn't start
         return None
-    else:
-        a1 = a1[0]
 
+    if _use_slices(data, context):
+        return slice(np.searchsorted(data['age'], a1, side='right'), len(data))
     return np.where(data['age'] > a1)
 
 
-def CO_WD(data):
+def CO_WD(data, context=None):
     """
     Defines the He White Dwarf phase, when the star is on the WD cooling track, and has a CO core.
 
@@ -648,7 +836,7 @@ def CO_WD(data):
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the He-WD phase
     """
-    required_parameters = ['log_LHe', 'c_core_mass', 'log_Teff', 'log_g', 'age']
+    required_parameters = PHASE_PARAMETERS['CO-WD']
     _check_history_parameters(data, required_parameters, evol_phase='He_WD')
 
     if np.max(data['log_g']) < 7.0:
@@ -659,74 +847,110 @@ def CO_WD(data):
         # No He burning, so no CO core
         return None
 
-    # select first point where teff < 10^4 and logg < 7
-    a1 = data['age'][((data['log_Teff'] < 4) & (data['log_g'] > 7)) | (data['log_g'] >= 7.5)]
-    if len(a1) == 0:
+    a1 = _get_context(data, context).ages('WD')
+    if a1 is None:
         # WD doesn't start
         return None
-    else:
-        a1 = a1[0]
 
+    if _use_slices(data, context):
+        return slice(np.searchsorted(data['age'], a1, side='right'), len(data))
     return np.where(data['age'] > a1)
 
 
-def init(data):
+def init(data, context=None):
     """
     First evolution time point, can be used to obtain the initial parameters of the run.
 
     :param data: numpy ndarray containing the history of the system.
     :return: selection of the first evolution point.
     """
+    if _use_slices(data, context):
+        return slice(0, 1)
     return ([0],)
 
 
-def final(data):
+def final(data, context=None):
     """
     Last evolution time point, can be used to obtain parameters at the very end of the run.
 
     :param data: numpy ndarray containing the history of the system.
     :return: selection of the last evolution point.
     """
+    if _use_slices(data, context):
+        return slice(data.shape[0]-1, data.shape[0])
     return ([data.shape[0]-1],)
 
 
-def ML(data, mltype='rlof', return_start=False, return_end=False, return_age=False, return_multiple=False):
+def get_mass_loss(data, mltype='rlof'):
     """
-    The first occurring mass loss phase, where the mass loss phase is defined as the period in time when the primary is
-    losing mass at a rate of at least log(Mdot) >= -10.
-    This phase only marks mass loss due to RLOF. Mass loss due to winds is not taken into account when flagging a ML
-    phase. In practice, the mass loss rate due to RLOF is defined as:
+    The log of the mass loss rate of the primary. The RLOF mass loss rate is defined as:
 
         lg_mass_loss_rate = log10( 10^lg_mstar_dot_1 - 10^lg_wind_mdot_1 )
 
-    .. note::
-        This phase only marks the first occurring mass loss phase.
-
-    Required history parameters:
-        - lg_mstar_dot_1
-        - lg_wind_mdot_1
-        - age
-
     :param data: numpy ndarray containing the history of the system.
     :param mltype: the type of mass loss to consider: 'rlof', 'wind', 'total'
-    :return: selection where the history corresponds to the first ML phase
+    :return: array with the log of the mass loss rate
     """
-    required_parameters = ['lg_mstar_dot_1', 'lg_wind_mdot_1', 'age']
-    _check_history_parameters(data, required_parameters, evol_phase='ML')
-
-    # look only at the mass lost due to RLOF, not wind mass loss.
     if mltype == 'rlof':
-        mass_loss = np.log10( 10**data['lg_mstar_dot_1'] - 10**data['lg_wind_mdot_1'] )
+        return np.log10(10**data['lg_mstar_dot_1'] - 10**data['lg_wind_mdot_1'])
     elif mltype == 'wind':
-        mass_loss = data['lg_wind_mdot_1'].copy()
+        return data['lg_wind_mdot_1']
     else:
-        mass_loss = data['lg_mstar_dot_1'].copy()
+        return data['lg_mstar_dot_1']
+
+
+def find_ml_intervals(mass_loss, limit=-10):
+    """
+    Find the start and end index of all mass loss phases in one pass over the mass loss rate.
+
+    A mass loss phase starts at the first point where mass_loss >= limit, and ends at the first point after that where
+    mass_loss < limit, or at the last point if the mass loss doesn't stop. Points where the mass loss rate is NaN
+    neither start nor end a phase. This is done by forward filling the last start/stop event over the history and
+    looking for the edges in the resulting mass loss state with np.diff.
+
+    :param mass_loss: array with the log of the mass loss rate
+    :param limit: the minimum log mass loss rate for a mass loss phase
+    :return: array of start indices, array of end indices (both inclusive)
+    """
+    event = np.zeros(len(mass_loss), dtype=np.int8)
+    event[mass_loss >= limit] = 1
+    event[mass_loss < limit] = -1
+
+    # forward fill the last event, before the first event there is no mass loss.
+    last_event = np.where(event != 0, np.arange(len(event)), 0)
+    np.maximum.accumulate(last_event, out=last_event)
+    losing_mass = event[last_event] == 1
 
-    if all(mass_loss < -10):
+    edges = np.diff(losing_mass.astype(np.int8), prepend=0)
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0]
+
+    if len(ends) < len(starts):
+        # the last mass loss phase continues until the end
+        ends = np.append(ends, len(mass_loss) - 1)
+
+    return starts, ends
+
+
+def _ml_intervals(data, mass_loss):
+    """
+    Helper Function.
+    Returns the (start, end) ages of all mass loss phases, or None if the mass loss rate is always below -10.
+    """
+
+    if np.all(mass_loss < -10):
         # no mass loss
         return None
 
-    age = data['age'].copy()
+    age = data['age']
+
+    if np.all(np.diff(age) > 0):
+        starts, ends = find_ml_intervals(mass_loss)
+        return list(zip(age[starts], age[ends]))
+
+    # if the age is not strictly increasing, phases are defined on the age instead of on the index.
+    mass_loss = mass_loss.copy()
+    age = age.copy()
 
     # run over history file, and measure all mass loss phases
     result_ages = []
@@ -748,24 +972,61 @@ def ML(data, mltype='rlof', return_start=False, return_end=False, return_age=Fal
 
         mass_loss = mass_loss[age > a2]
         age = age[age > a2]
-        # stop loop if no more history remains, or if only 1 mass loss phase is requested.
-        if len(age) == 0 or not return_multiple:
+        # stop loop if no more history remains.
+        if len(age) == 0:
             break
 
+    return result_ages
+
+
+def ML(data, mltype='rlof', return_start=False, return_end=False, return_age=False, return_multiple=False,
+       context=None):
+    """
+    The first occurring mass loss phase, where the mass loss phase is defined as the period in time when the primary is
+    losing mass at a rate of at least log(Mdot) >= -10.
+    This phase only marks mass loss due to RLOF. Mass loss due to winds is not taken into account when flagging a ML
+    phase. In practice, the mass loss rate due to RLOF is defined as:
+
+        lg_mass_loss_rate = log10( 10^lg_mstar_dot_1 - 10^lg_wind_mdot_1 )
+
+    .. note::
+        This phase only marks the first occurring mass loss phase.
+
+    Required history parameters:
+        - lg_mstar_dot_1
+        - lg_wind_mdot_1
+        - age
+
+    :param data: numpy ndarray containing the history of the system.
+    :param mltype: the type of mass loss to consider: 'rlof', 'wind', 'total'
+    :return: selection where the history corresponds to the first ML phase
+    """
+    required_parameters = PHASE_PARAMETERS['ML']
+    _check_history_parameters(data, required_parameters, evol_phase='ML')
+
+    result_ages = _get_context(data, context).ml_intervals(mltype)
+    if result_ages is None:
+        # no mass loss
+        return None
+
     if not return_multiple:
+        if len(result_ages) == 0:
+            # mass loss rate is never above -10 (only nan values)
+            return None
         a1, a2 = result_ages[0]
-        return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end)
+        return _return_function(data, a1, a2, return_age=return_age, return_start=return_start, return_end=return_end,
+                            context=context)
 
     else:
         results = []
         for ages in result_ages:
             a1, a2 = ages
             results.append(_return_function(data, a1, a2, return_age=return_age,
-                                            return_start=return_start, return_end=return_end))
+                                            return_start=return_start, return_end=return_end, context=context))
         return results
 
 
-def MLstart(data, mltype='rlof', return_age=False, return_multiple=False):
+def MLstart(data, mltype='rlof', return_age=False, return_multiple=False, context=None):
     """
     The start of the first ML phase, defined as the moment in time when the donor star first reaches
     lg_mstar_dot_1 >= 10
@@ -779,10 +1040,10 @@ def MLstart(data, mltype='rlof', return_age=False, return_multiple=False):
     :return: selection where the history corresponds to the starting point of the first ML phase
     """
     return ML(data, mltype=mltype, return_start=True, return_end=False,
-              return_age=return_age, return_multiple=return_multiple)
+              return_age=return_age, return_multiple=return_multiple, context=context)
 
 
-def MLend(data, mltype='rlof', return_age=False, return_multiple=False):
+def MLend(data, mltype='rlof', return_age=False, return_multiple=False, context=None):
     """
     The end of the first mass loss phase, defined as the moment in time when lg_mstar_dot_1 dips below -10 after
     starting mass loss.
@@ -796,48 +1057,53 @@ def MLend(data, mltype='rlof', return_age=False, return_multiple=False):
     :return: selection where the history corresponds to the end point of the first ML phase
     """
     return ML(data, mltype=mltype, return_start=False, return_end=True,
-              return_age=return_age, return_multiple=return_multiple)
+              return_age=return_age, return_multiple=return_multiple, context=context)
 
 
-def CE(data):
+def CE(data, context=None):
     """
     The CE phase as it is defined in the common_envelope settings.
 
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the CE phase
     """
-    if all(data['CE_phase'] == 0):
-        return None
+    context = _get_context(data, context)
+
+    def selection():
+        if all(data['CE_phase'] == 0):
+            return None
+        s = np.where(data['CE_phase'] == 1)
+        return _contiguous_slice(s) if context.use_slices else s
 
-    return np.where(data['CE_phase'] == 1)
+    return context.memoize('CE', selection)
 
 
-def CEstart(data):
+def CEstart(data, context=None):
     """
     start of the CE phase as defined in the common_envelope settings.
 
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the starting point of the CE phase
     """
-    s = CE(data)
+    s = CE(data, context=context)
     if s is None:
         return s
 
-    return ([s[0][0]],)
+    return _first(s)
 
 
-def CEend(data):
+def CEend(data, context=None):
     """
     the end of the CE phase as defined in the common_envelope settings.
 
     :param data: numpy ndarray containing the history of the system.
     :return: selection where the history corresponds to the end point of the CE phase
     """
-    s = CE(data)
+    s = CE(data, context=context)
     if s is None:
         return s
 
-    return ([s[0][-1]],)
+    return _last(s)
 
 
 all_phases = {'init': init, 'final': final,
@@ -848,6 +1114,10 @@ all_phases = {'init': init, 'final': final,
               'HeIgnition': HeIgnition, 'HeCoreBurning': HeCoreBurning, 'HeShellBurning': HeShellBurning,
               'sdA': sdA, 'sdB': sdB, 'sdO': sdO, 'He-WD': He_WD, 'CO-WD': CO_WD}
 
+# functions calculating the ages of the phases that are memoized in the PhaseContext
+_PHASE_AGES = {'MS': _ms_ages, 'RGB': _rgb_ages, 'HeIgnition': _he_ignition_age,
+               'HeCoreBurning': _he_core_burning_ages, 'HeShellBurning': _he_shell_burning_ages, 'WD': _wd_start_age}
+
 
 def get_custom_phase(phase, data):
     """
@@ -872,7 +1142,25 @@ def get_custom_phase(phase, data):
     return np.where(data[par] == value)
 
 
-def get_all_phases(phases, data, n_ml_phases=0):
+def get_all_phases(phases, data, n_ml_phases=0, context=None, use_slices=False):
+    """
+    Get the selections of all requested phases. All phases are derived from one :class:`PhaseContext`, so quantities
+    that are shared between phases are only calculated once.
+
+    By default each selection is a np.where tuple. With use_slices, the phases that are a contiguous part of the
+    history are returned as slices, which give a view of the history instead of a copy when used as index. The sdA,
+    sdB and sdO phases and custom phases remain np.where selections.
+
+    :param phases: list of phase names
+    :param data: numpy ndarray containing the history of the system.
+    :param n_ml_phases: the number of ML phases to return for phases based on ML
+    :param context: PhaseContext of this history, if None a new one is created
+    :param use_slices: return contiguous phases as slices, ignored if a context is given
+    :return: dictionary with the selection of each phase
+    """
+
+    if context is None or context.data is not data:
+        context = PhaseContext(data, use_slices=use_slices)
 
     phases = set(phases)
     if None in phases:
@@ -886,10 +1174,10 @@ def get_all_phases(phases, data, n_ml_phases=0):
         else:
             if 'ML' in phase and n_ml_phases > 0:
                 # deal with multiple ML phases and store those as a list
-                selection = all_phases[phase](data, return_multiple=True)
+                selection = all_phases[phase](data, return_multiple=True, context=context)
                 phase_selection[phase] = selection[0:n_ml_phases]
             else:
-                phase_selection[phase] = all_phases[phase](data)
+                phase_selection[phase] = all_phases[phase](data, context=context)
 
     return phase_selection
 
@@ -0,0 +1,126 @@
+import os
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+
+from nnaps import __version__
+
+# setup parameters that influence the stability, the CE ejection and the detected phases of a model
+CACHE_SETUP_PARAMETERS = ['stability_criterion', 'stability_limit', 'ce_formalism', 'ce_parameters',
+                          'ce_profile_name']
+
+
+def open_cache(filename):
+    """
+    Open (and create if necessary) the sqlite database used to cache the results of the expensive steps of the
+    extraction: the stability, the final state after the CE, the number of ML phases, the error flags and the detected
+    evolution phases of each model.
+
+    :param filename: path to the sqlite database
+    :type filename: str
+    :return: the connection to the database
+    :rtype: sqlite3.Connection
+    """
+    connection = sqlite3.connect(str(filename))
+    connection.execute('CREATE TABLE IF NOT EXISTS extract_cache '
+                       '(model_key TEXT, setup_key TEXT, entry TEXT, PRIMARY KEY (model_key, setup_key))')
+    connection.commit()
+    return connection
+
+
+def get_model_key(model):
+    """
+    The key identifying the compressed model: the path together with the size and modification time of the file it
+    is stored in. For models in a grid file, this is the grid file.
+
+    :param model: the row of the file list describing this model
+    :type model: pandas Series
+    :return: the model key
+    :rtype: str
+    """
+    grid_file = model['grid_file'] if 'grid_file' in model and isinstance(model['grid_file'], str) else None
+    filename = grid_file if grid_file is not None else model['path']
+
+    stat = os.stat(filename)
+    return '{}|{}|{}|{}'.format(os.path.abspath(filename), model['path'] if grid_file is not None else '',
+                                stat.st_size, stat.st_mtime)
+
+
+def get_setup_key(model, n_ml_phases=0):
+    """
+    The key identifying the part of the extraction setup that the cached results depend on: the stability criterion
+    and limit, the CE formalism, its parameters and profile, the number of ML phases and the nnaps version.
+
+    :param model: the row of the file list describing this model, including all extraction setup parameters
+    :type model: pandas Series
+    :param n_ml_phases: the number of ML phases to extract
+    :type n_ml_phases: int
+    :return: the setup key
+    :rtype: str
+    """
+    setup = {p: model[p] for p in CACHE_SETUP_PARAMETERS}
+    setup['n_ml_phases'] = n_ml_phases
+    setup['nnaps-version'] = __version__
+
+    setup = json.dumps(setup, sort_keys=True, default=str)
+    return hashlib.md5(setup.encode('UTF-8')).hexdigest()
+
+
+def load_entries(connection, keys):
+    """
+    Load the cached entries for the given (model_key, setup_key) pairs.
+
+    :param connection: the connection to the cache database
+    :param keys: list of (model_key, setup_key) tuples
+    :return: dictionary of the found entries by key
+    :rtype: dict
+    """
+    keys = set(keys)
+    setup_keys = list({setup_key for model_key, setup_key in keys})
+
+    entries = {}
+    for i in range(0, len(setup_keys), 500):
+        query = 'SELECT model_key, setup_key, entry FROM extract_cache WHERE setup_key IN ({})'.format(
+            ','.join(['?'] * len(setup_keys[i:i + 500])))
+        for model_key, setup_key, entry in connection.execute(query, setup_keys[i:i + 500]):
+            if (model_key, setup_key) in keys:
+                entries[(model_key, setup_key)] = json.loads(entry)
+
+    return entries
+
+
+def store_entries(connection, entries):
+    """
+    Store entries in the cache, replacing existing entries with the same key.
+
+    :param connection: the connection to the cache database
+    :param entries: dictionary of entries by (model_key, setup_key)
+    """
+    rows = [(model_key, setup_key, json.dumps(entry)) for (model_key, setup_key), entry in entries.items()]
+    connection.executemany('INSERT OR REPLACE INTO extract_cache (model_key, setup_key, entry) VALUES (?, ?, ?)',
+                           rows)
+    connection.commit()
+
+
+def encode_phase(selection):
+    """ convert a phase selection (np.where result, slice, list of them or None) to something json can store """
+    if selection is None:
+        return None
+    if type(selection) == list:
+        return [encode_phase(s) for s in selection]
+    if type(selection) == slice:
+        return {'slice': [int(selection.start), int(selection.stop)]}
+    return {'where': np.asarray(selection[0]).tolist()}
+
+
+def decode_phase(selection):
+    """ convert a stored phase selection back to the format returned by the evolution phase functions """
+    if selection is None:
+        return None
+    if type(selection) == list:
+        return [decode_phase(s) for s in selection]
+    if 'slice' in selection:
+        return slice(*selection['slice'])
+    return (np.array(selection['where'], dtype=int),)
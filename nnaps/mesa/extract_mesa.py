@@ -1,57 +1,277 @@
 
+import functools
+import itertools
+import multiprocessing
+
 import numpy as np
 
 import pandas as pd
 
-from nnaps.mesa import fileio, common_envelope, evolution_phases, evolution_errors
+from nnaps.mesa import fileio, common_envelope, evolution_phases, evolution_errors, extract_cache
 
 
-def extract_parameters(data, parameters=[], phase_flags=[], n_ml_phases=0):
+def plan_parameters(parameters=[]):
+    """
+    Decompose all parameters and group them by the phase they are calculated in, so that every phase only needs to be
+    selected once. The order of the phases is the order in which they first occur in the parameter list.
 
-    phases = []
-    for parameter in parameters:
+    :param parameters: list of parameter names
+    :return: dictionary with for each phase (None for the entire history) a list of (index, parameter name, function)
+             tuples, where index is the position of the parameter in the parameter list.
+    :rtype: dict
+    """
+    plan = {}
+    for i, parameter in enumerate(parameters):
         pname, phase, func = evolution_phases.decompose_parameter(parameter)
-        phases.append(phase)
-    phases = phases + phase_flags
-    phases = evolution_phases.get_all_phases(phases, data, n_ml_phases)
+        plan.setdefault(phase, []).append((i, pname, func))
+    return plan
 
-    result = []
 
-    # extract the parameters
-    for parameter in parameters:
-        pname, phase, func = evolution_phases.decompose_parameter(parameter)
+def get_phase_names(parameters=[], phase_flags=[]):
+    """
+    Get the names of all phases that are needed to extract the given parameters and phase flags.
 
-        if phase is not None:
-            if phases[phase] is None:
-                # if the phase doesn't exist in the model, return nan value
-                value = np.nan
-            elif type(phases[phase]) == list:
-                # in this case the phase returns multiple hits which need to be returned as a list
-                value = []
-                for p in phases[phase]:
-                    d_ = data[p]
-                    value_ = func(d_, pname)
-                    value.append(value_)
-            else:
-                d_ = data[phases[phase]]
-                value = func(d_, pname)
-        else:
-            d_ = data
-            value = func(d_, pname)
+    :param parameters: list of parameter names
+    :param phase_flags: list of phase flags
+    :return: list of phase names (can contain None for parameters that are not restricted to a phase)
+    :rtype: list
+    """
+    return list(plan_parameters(parameters).keys()) + phase_flags
+
+
+def aggregate_phase(data, requests):
+    """
+    Calculate all requested aggregates over one phase of the history in one step.
 
-        result.append(value)
+    The float columns that are requested are copied once into a 2D column block on which the min, max, avg, diff and
+    rate are calculated for all columns at once. The weights for the average are calculated only once. Parameters of
+    other types, or with an unknown function, are calculated one by one.
 
-    # add flags for triggered phases
-    for phase in phase_flags:
-        if phases[phase] is not None:
-            result.append(True)
+    :param data: the part of the history covering the phase
+    :param requests: list of (index, parameter name, function) tuples as returned by :func:`plan_parameters`
+    :return: dictionary of the calculated value by index
+    :rtype: dict
+    """
+    function_names = {f: name for name, f in evolution_phases.known_functions.items()}
+
+    values = {}
+    block_requests = []
+    for i, pname, func in requests:
+        if func in function_names and pname in data.dtype.names and data.dtype[pname] == np.float64:
+            block_requests.append((i, pname, function_names[func]))
         else:
-            result.append(False)
+            values[i] = func(data, pname)
+
+    if len(block_requests) == 0:
+        return values
+
+    pnames = list(dict.fromkeys([pname for i, pname, fname in block_requests]))
+    columns = {pname: j for j, pname in enumerate(pnames)}
+
+    # fortran order keeps each column contiguous, which gives the same sums as aggregating each column separately
+    block = np.empty((len(data), len(pnames)), order='F')
+    for j, pname in enumerate(pnames):
+        block[:, j] = data[pname]
+
+    fnames = set([fname for i, pname, fname in block_requests])
+    aggregates = {}
+    if 'min' in fnames:
+        aggregates['min'] = np.min(block, axis=0)
+    if 'max' in fnames:
+        aggregates['max'] = np.max(block, axis=0)
+    if 'avg' in fnames:
+        aggregates['avg'] = np.average(block, axis=0, weights=10 ** data['log_dt'])
+    if 'diff' in fnames or 'rate' in fnames:
+        aggregates['diff'] = block[-1] - block[0]
+    if 'rate' in fnames:
+        aggregates['rate'] = aggregates['diff'] / (data['age'][-1] - data['age'][0])
+
+    for i, pname, fname in block_requests:
+        values[i] = aggregates[fname][columns[pname]]
 
-    return result
+    return values
 
 
-def count_ml_phases(data, mltype='rlof'):
+def extract_parameters(data, parameters=[], phase_flags=[], n_ml_phases=0, phases=None):
+    """
+    Extract the requested parameters and phase flags from the history of a model.
+
+    The parameters are grouped by phase (see :func:`plan_parameters`), each phase is selected once and all parameters
+    in that phase are calculated together with :func:`aggregate_phase`.
+
+    :param data: the history of the model
+    :param parameters: list of parameter names
+    :param phase_flags: list of phase flags
+    :param n_ml_phases: the number of ML phases to extract
+    :param phases: dictionary of the already detected phases (see :func:`~nnaps.mesa.evolution_phases.get_all_phases`)
+                   if None, all necessary phases are detected.
+    :return: list of the parameter values followed by the phase flags
+    """
+
+    plan = plan_parameters(parameters)
+
+    if phases is None:
+        phases = evolution_phases.get_all_phases(list(plan.keys()) + phase_flags, data, n_ml_phases,
+                                                 use_slices=True)
+
+    result = [None] * len(parameters)
+
+    # extract the parameters
+    for phase, requests in plan.items():
+        selection = None if phase is None else phases[phase]
+        values = _aggregate_selection(data, phase, selection, requests)
+
+        for i, value in values.items():
+            result[i] = value
+
+    return result + _phase_flags(phases, phase_flags)
+
+
+def _aggregate_selection(data, phase, selection, requests):
+    """
+    Calculate the requested aggregates over the selection of the given phase (None is the entire history).
+    """
+    if phase is None:
+        return aggregate_phase(data, requests)
+    elif selection is None:
+        # if the phase doesn't exist in the model, return nan value
+        return {i: np.nan for i, pname, func in requests}
+    elif type(selection) == list:
+        # in this case the phase returns multiple hits which need to be returned as a list
+        values = {i: [] for i, pname, func in requests}
+        for p in selection:
+            values_ = aggregate_phase(data[p], requests)
+            for i in values:
+                values[i].append(values_[i])
+        return values
+    else:
+        return aggregate_phase(data[selection], requests)
+
+
+def _phase_flags(phases, phase_flags):
+    """
+    flags for triggered phases
+    """
+    return [phases[phase] is not None for phase in phase_flags]
+
+
+def extract_parameters_batch(histories, parameters=[], phase_flags=[], n_ml_phases=0, phases=None):
+    """
+    Extract the requested parameters and phase flags from the histories of many models at once.
+
+    The float columns that are used are concatenated over all histories into one columnar table, where each model
+    covers the rows between its offset and the offset of the next model. Phases that are a slice of the history (see
+    :func:`~nnaps.mesa.evolution_phases.get_all_phases`) become row ranges in this table, and the min, max, avg, diff
+    and rate are calculated for all models at once with segmented reductions (np.minimum.reduceat, np.add.reduceat,
+    ...). Phases that are not a slice (sdA, sdB, sdO, custom phases, multiple ML phases or a non monotonic age), empty
+    phases and columns that are not float are extracted per model as in :func:`extract_parameters`.
+
+    The result is the same as calling :func:`extract_parameters` on each history, except that averages can differ in
+    the last digits due to the different order of summation.
+
+    :param histories: list of histories (numpy ndarrays)
+    :param parameters: list of parameter names
+    :param phase_flags: list of phase flags
+    :param n_ml_phases: the number of ML phases to extract
+    :param phases: list with for each history the dictionary of the already detected phases, if None, all
+                   necessary phases are detected.
+    :return: list with for each history the list of the parameter values followed by the phase flags
+    """
+
+    plan = plan_parameters(parameters)
+
+    if phases is None:
+        phases = [evolution_phases.get_all_phases(list(plan.keys()) + phase_flags, data, n_ml_phases,
+                                                  use_slices=True) for data in histories]
+
+    results = [[None] * len(parameters) for data in histories]
+
+    # the columnar table: all float columns used in the parameters that are present in all histories
+    function_names = {f: name for name, f in evolution_phases.known_functions.items()}
+    used_columns = set([pname for requests in plan.values() for i, pname, func in requests])
+    used_columns.update(['age', 'log_dt'])
+    table_columns = [c for c in used_columns
+                     if all(c in data.dtype.names and data.dtype[c] == np.float64 for data in histories)]
+
+    offsets = np.cumsum([0] + [len(data) for data in histories])
+    # the table is padded with 1 row so that a segment can end at the last row
+    table = {c: np.concatenate([data[c] for data in histories] + [np.zeros(1)]) for c in table_columns}
+    weights = 10 ** table['log_dt'] if 'log_dt' in table else None
+
+    for phase, requests in plan.items():
+
+        batch_requests = [(i, pname, function_names.get(func, None)) for i, pname, func in requests
+                          if function_names.get(func, None) in ['min', 'max', 'diff', 'rate', 'avg']
+                          and pname in table]
+        batch_requests = [(i, pname, fname) for i, pname, fname in batch_requests
+                          if (fname != 'avg' or weights is not None) and (fname != 'rate' or 'age' in table)]
+        batch_indices = set([i for i, pname, fname in batch_requests])
+        model_requests = [r for r in requests if r[0] not in batch_indices]
+
+        # find the models for which this phase is a non empty row range in the table
+        batch_models, starts, stops = [], [], []
+        for m, data in enumerate(histories):
+            selection = slice(None) if phase is None else phases[m][phase]
+            if type(selection) == slice:
+                start, stop, step = selection.indices(len(data))
+                if stop > start and step == 1:
+                    batch_models.append(m)
+                    starts.append(offsets[m] + start)
+                    stops.append(offsets[m] + stop)
+                    if len(model_requests) > 0:
+                        values = _aggregate_selection(data, phase, selection, model_requests)
+                        for i, value in values.items():
+                            results[m][i] = value
+                    continue
+
+            values = _aggregate_selection(data, phase, None if phase is None else phases[m][phase], requests)
+            for i, value in values.items():
+                results[m][i] = value
+
+        if len(batch_models) == 0 or len(batch_requests) == 0:
+            continue
+
+        # segmented reductions: reduceat over the start, stop pairs, every other value is a segment
+        starts, stops = np.array(starts), np.array(stops)
+        segments = np.empty(2 * len(starts), dtype=int)
+        segments[0::2] = starts
+        segments[1::2] = stops
+
+        aggregates = {}
+        fnames = set([fname for i, pname, fname in batch_requests])
+        if 'avg' in fnames:
+            weight_sums = np.add.reduceat(weights, segments)[0::2]
+        for pname in set([pname for i, pname, fname in batch_requests]):
+            column = table[pname]
+            if 'min' in fnames:
+                aggregates[(pname, 'min')] = np.minimum.reduceat(column, segments)[0::2]
+            if 'max' in fnames:
+                aggregates[(pname, 'max')] = np.maximum.reduceat(column, segments)[0::2]
+            if 'avg' in fnames:
+                aggregates[(pname, 'avg')] = np.add.reduceat(column * weights, segments)[0::2] / weight_sums
+            if 'diff' in fnames or 'rate' in fnames:
+                aggregates[(pname, 'diff')] = column[stops - 1] - column[starts]
+            if 'rate' in fnames:
+                aggregates[(pname, 'rate')] = aggregates[(pname, 'diff')] / \
+                                              (table['age'][stops - 1] - table['age'][starts])
+
+        for k, m in enumerate(batch_models):
+            for i, pname, fname in batch_requests:
+                results[m][i] = aggregates[(pname, fname)][k]
+
+        if 'avg' in fnames and np.any(weight_sums == 0):
+            # np.average raises an error when the weights sum to zero, do the same.
+            for k in np.where(weight_sums == 0)[0]:
+                m = batch_models[k]
+                selection = slice(None) if phase is None else phases[m][phase]
+                _aggregate_selection(histories[m], phase, selection,
+                                     [(i, pname, evolution_phases.known_functions[fname])
+                                      for i, pname, fname in batch_requests])
+
+    return [result + _phase_flags(phases[m], phase_flags) for m, result in enumerate(results)]
+
+
+def count_ml_phases(data, mltype='rlof', context=None):
     """
     Count how many separate mass loss phases take place during the evolution of this system.
     A mass loss phase is defined as mass_loss_rate >= -10
@@ -62,49 +282,23 @@ def count_ml_phases(data, mltype='rlof'):
     You can specify if you want the rlof mass loss rate, the wind mass loss rate or the total mass loss rate using the
     'mltype' option.
 
+    The mass loss phases are found with :func:`~nnaps.mesa.evolution_phases.find_ml_intervals`, the same as for the ML
+    phase. When a :class:`~nnaps.mesa.evolution_phases.PhaseContext` is given, the mass loss rate and the mass loss
+    phases are shared with the phase detection.
+
     :param data: numpy ndarray containing the history of the system.
     :param mltype: the type of mass loss to consider: 'rlof', 'wind', 'total'
+    :param context: PhaseContext of this history
     :return: the number of mass loss phases
     """
 
-    # look only at the mass lost due to RLOF, not wind mass loss.
-    if mltype == 'rlof':
-        mass_loss = np.log10(10 ** data['lg_mstar_dot_1'] - 10 ** data['lg_wind_mdot_1'])
-    elif mltype == 'wind':
-        mass_loss = data['lg_wind_mdot_1']
-    else:
-        mass_loss = data['lg_mstar_dot_1']
+    intervals = evolution_phases._get_context(data, context).ml_intervals(mltype)
 
-    if all(mass_loss < -10):
+    if intervals is None:
         # no mass loss
         return 0
 
-    ml = mass_loss.copy()
-    age = data['age'].copy()
-
-    ml_count = 0
-    a = 0
-    while a < age.max():
-        try:
-            a1 = age[ml >= -10][0]
-        except IndexError:
-            # no more new ML phases
-            break
-        ml_count += 1
-
-        # select the first point in time that the mass loss dips below -10 after it starts up.
-        try:
-            a = age[(age > a1) & (ml < -10)][0]
-        except IndexError:
-            # No more new ML phases
-            break
-
-        ml = ml[age > a]
-        age = age[age > a]
-        if len(age) == 0:
-            break
-
-    return ml_count
+    return len(intervals)
 
 
 def process_file_list(file_list, verbose=False, **kwargs):
@@ -190,10 +384,345 @@ def _flatten_dataframe(df, max_cols):
     return df
 
 
+# history columns used by count_ml_phases and to check for mergers and contact binaries after the CE
+_STANDARD_COLUMNS = ['model_number', 'age', 'lg_mstar_dot_1', 'lg_wind_mdot_1',
+                     'star_1_radius', 'star_2_radius', 'rl_1', 'rl_2', 'binary_separation']
+
+
+def get_required_columns(parameters=[], phase_flags=[], stability_criterion='J_div_Jdot_div_P',
+                         ce_formalism='iben_tutukov1984', **kwargs):
+    """
+    Get the history and profile columns that are needed to extract the given parameters and phase flags from a
+    model with :func:`~nnaps.mesa.extract_mesa.extract_mesa`. This includes the columns used by the requested
+    evolution phases, the aggregate functions, the stability criterion, the CE formalism and the error checks.
+
+    The history columns use the names of the combined history as returned by
+    :func:`~nnaps.mesa.fileio.read_compressed_track`: parameters of the secondary end on '_2'. Derived parameters
+    are returned together with the history columns they are calculated from.
+
+    The result can be used to only read the necessary columns of a compressed model, or to only store those columns
+    when compressing the MESA models. Any other keyword arguments of an extraction setup are accepted and ignored,
+    so a setup dictionary can be passed directly:
+
+    .. code-block:: python
+
+        history_columns, profile_columns = get_required_columns(**setup)
+
+    :param parameters: the parameters to extract
+    :type parameters: list
+    :param phase_flags: the phase flags to extract
+    :type phase_flags: list
+    :param stability_criterion: the stability criterion used
+    :type stability_criterion: str
+    :param ce_formalism: the CE formalism used
+    :type ce_formalism: str
+    :return: history_columns, profile_columns
+    :rtype: list, list
+    """
+    parameters, _ = _process_parameters(parameters)
+
+    columns = set(_STANDARD_COLUMNS)
+    columns.update(common_envelope.STABILITY_PARAMETERS.get(stability_criterion, []))
+    columns.update(common_envelope.CE_PARAMETERS.get(ce_formalism, []))
+    columns.update(common_envelope.CE_UPDATED_PARAMETERS)
+    for error_columns in evolution_errors.ERROR_PARAMETERS.values():
+        columns.update(error_columns)
+
+    phases = list(phase_flags)
+    for parameter in parameters:
+        pname, phase, func = evolution_phases.decompose_parameter(parameter)
+        columns.add(pname)
+        phases.append(phase)
+        if func is evolution_phases.avg_:
+            columns.add('log_dt')
+
+    for phase in phases:
+        if phase is None:
+            continue
+        if phase in evolution_phases.PHASE_PARAMETERS:
+            columns.update(evolution_phases.PHASE_PARAMETERS[phase])
+        else:
+            # custom phase: <parameter>_<function>
+            columns.add('_'.join(phase.split('_')[0:-1]))
+            if phase.split('_')[-1] == 'avg':
+                columns.add('log_dt')
+
+    for name in list(columns):
+        columns.update(fileio.DERIVED_PARAMETERS.get(name, []))
+
+    profile_columns = common_envelope.CE_PROFILE_PARAMETERS.get(ce_formalism, [])
+
+    return sorted(columns), list(profile_columns)
+
+
+def _extract_model(model, parameters=[], phase_flags=[], extra_info_parameters=[], n_ml_phases=0,
+                   add_setup_pars_to_result=True, verbose=False, cache_entry=None):
+    """
+    Extract all requested parameters from one model.
+
+    .. note::
+        Function for internal use!
+
+    :param model: the row of the file list describing this model, including all extraction setup parameters
+    :type model: pandas Series
+    :param cache_entry: the cached stability, CE result, ML phase count, error flags and phases of this model as
+                        stored by an earlier extraction with the same setup. If None or empty, everything is computed.
+    :type cache_entry: dict
+    :return: the extracted parameters of this model and the updated cache entry, or (None, None) if the model could
+             not be read.
+    :rtype: list, dict
+    """
+    prepared = _prepare_model(model, parameters=parameters, phase_flags=phase_flags,
+                              extra_info_parameters=extra_info_parameters, n_ml_phases=n_ml_phases,
+                              verbose=verbose, cache_entry=cache_entry)
+    if prepared is None:
+        return None, None
+    data, phases, pars, error_flags, entry = prepared
+
+    # 5: extract the requested parameters & 6: add the requested phase flags.
+    pars += extract_parameters(data, parameters, phase_flags, n_ml_phases=n_ml_phases, phases=phases)
+
+    return _finish_pars(model, pars, error_flags, add_setup_pars_to_result), entry
+
+
+def _extract_batch(tasks, parameters=[], phase_flags=[], extra_info_parameters=[], n_ml_phases=0,
+                   add_setup_pars_to_result=True, verbose=False):
+    """
+    Extract all requested parameters from a batch of models. Each model is read, checked for stability and its
+    phases are detected separately, after which the parameters of all models are extracted at once with
+    :func:`extract_parameters_batch`.
+
+    .. note::
+        Function for internal use!
+
+    :param tasks: list of (model, cache entry) tuples
+    :return: list with for each model the extracted parameters and updated cache entry, or (None, None) if the model
+             could not be read.
+    :rtype: list
+    """
+    prepared = [_prepare_model(model, parameters=parameters, phase_flags=phase_flags,
+                               extra_info_parameters=extra_info_parameters, n_ml_phases=n_ml_phases,
+                               verbose=verbose, cache_entry=entry)
+                for model, entry in tasks]
+    read = [i for i, p in enumerate(prepared) if p is not None]
+
+    extracted = extract_parameters_batch([prepared[i][0] for i in read], parameters, phase_flags,
+                                         n_ml_phases=n_ml_phases, phases=[prepared[i][1] for i in read])
+
+    results = [(None, None)] * len(tasks)
+    for i, values in zip(read, extracted):
+        data, phases, pars, error_flags, entry = prepared[i]
+        results[i] = (_finish_pars(tasks[i][0], pars + values, error_flags, add_setup_pars_to_result), entry)
+
+    return results
+
+
+def _finish_pars(model, pars, error_flags, add_setup_pars_to_result=True):
+    """
+    Add the setup parameters (steps 7) and error flags (step 8) to the extracted parameters of a model.
+    """
+    # 7: Add the extraction setup parameters if requested
+    if add_setup_pars_to_result:
+        setup_pars = [model['stability_criterion'], model['stability_limit'], model['ce_profile_name'],
+                      model['ce_formalism'], model['ce_parameters']]
+        pars += setup_pars
+
+    # 8: add the error flags
+    pars.append(error_flags)
+
+    return pars
+
+
+def _read_ce_profiles(model, grid_file=None, verbose=False):
+    """
+    Read the profiles used by the dewi_tauris2000 CE formalism. When the model has a ce_profile_name (from the file
+    list, or the one given to the extraction for all models), only that profile is read. If the model doesn't have
+    that profile, all profiles are read instead, and the profile closest to the onset of the CE is used.
+
+    .. note::
+        Function for internal use!
+
+    :return: the requested profile, the dictionary with all profiles, or None if the model has no profiles. Without
+             profiles the CE falls back to webbink1984.
+    """
+    if grid_file is not None:
+        read_profiles = functools.partial(fileio.read_grid_profiles, grid_file)
+    else:
+        read_profiles = fileio.read_profiles
+
+    ce_profile_name = model['ce_profile_name'] if 'ce_profile_name' in model else None
+    if isinstance(ce_profile_name, str):
+        profiles = read_profiles(model['path'], profile_names=[ce_profile_name])
+        if profiles is not None and ce_profile_name in profiles:
+            return profiles[ce_profile_name]
+        if verbose:
+            print('CE: profile {} missing, using the profile closest to the CE'.format(ce_profile_name))
+
+    return read_profiles(model['path'])
+
+
+def _prepare_model(model, parameters=[], phase_flags=[], extra_info_parameters=[], n_ml_phases=0,
+                   verbose=False, cache_entry=None):
+    """
+    Read a model, check the stability, apply the CE, detect the phases and check for errors. Everything that is
+    needed before the parameters can be extracted.
+
+    .. note::
+        Function for internal use!
+
+    :return: the history, the phases, the standard parameters (path, stability, nr of ML phases and extra info), the
+             error flags and the updated cache entry, or None if the model could not be read.
+    :rtype: tuple
+    """
+
+    # models stored in a grid file have the grid file in a separate column
+    grid_file = model['grid_file'] if 'grid_file' in model and isinstance(model['grid_file'], str) else None
+
+    # 1: Get the data, only the history columns that are used are read. Profiles are read later only if needed.
+    columns, _ = get_required_columns(parameters, phase_flags, stability_criterion=model['stability_criterion'],
+                                      ce_formalism=model['ce_formalism'])
+    try:
+        if grid_file is not None:
+            data, extra_info = fileio.read_grid_track(grid_file, model['path'], columns=columns)
+        else:
+            data, extra_info = fileio.read_compressed_track(model['path'], columns=columns)
+    except Exception as e:
+        if verbose:
+            print(e)
+        return None
+
+    # cached results of an earlier extraction of this model with the same setup (see extract_cache)
+    cached = cache_entry is not None and len(cache_entry) > 0
+    entry = dict(cache_entry) if cached else {}
+
+    # 2: check for stability and cut data at start of CE
+    if cached:
+        stable, ce_age = entry['stable'], entry['ce_age']
+    else:
+        stable, ce_age = common_envelope.is_stable(data, criterion=model['stability_criterion'],
+                                                   value=model['stability_limit'])
+        entry['stable'], entry['ce_age'] = bool(stable), float(ce_age)
+    stability = 'stable'
+
+    if not stable:
+        # if the model is not stable, cut of the evolution at the start of the CE as anything after than
+        # is non physical anyway.
+        data = data[data['age'] <= ce_age]
+
+        if cached:
+            af, M1_final = entry['af'], entry['M1_final']
+        else:
+            # only the dewi_tauris2000 formalism uses a profile
+            profiles = None
+            if model['ce_formalism'] == 'dewi_tauris2000':
+                profiles = _read_ce_profiles(model, grid_file=grid_file, verbose=verbose)
+
+            af, M1_final = common_envelope.ce_final_state(data, profiles=profiles,
+                                                          ce_formalism=model['ce_formalism'],
+                                                          **model['ce_parameters'])
+            entry['af'], entry['M1_final'] = float(af), float(M1_final)
+
+        data = common_envelope.update_after_ce(data, af, M1_final)
+
+        # check if CE is ejected or if the system is a merger or a contact binary
+        s = np.where((data['star_2_radius'] >= 0.99 * data['rl_2']) &
+                     (data['star_1_radius'] >= 0.99 * data['rl_1']))
+
+        if data['binary_separation'][-1] <= 0:
+            stability = 'merger'
+            print('CE: Merged')
+        elif len(data['model_number'][s]) > 0:
+            stability = 'contact'
+            print('CE: Contact')
+        else:
+            stability = 'CE'
+
+    # the mass loss rate and other intermediate quantities are shared between the ML count, phases and error checks
+    context = evolution_phases.PhaseContext(data, use_slices=True)
+
+    # 3: extract some standard parameters: Path, stability and nr of ML phases.
+    if 'n_ML_phases' not in entry:
+        entry['n_ML_phases'] = int(count_ml_phases(data, context=context))
+    pars = [model['path'].split('/')[-1]]
+    pars += [stability, entry['n_ML_phases']]
+
+    # 4: add the extra info to the output
+    for p in extra_info_parameters:
+        pars.append(extra_info[p])
+
+    # 5: detect the phases needed for the parameters and phase flags. Only the phases that are not cached yet are
+    # detected.
+    cached_phases = entry.get('phases', {})
+    phases = {name: extract_cache.decode_phase(selection) for name, selection in cached_phases.items()}
+    missing = [name for name in set(get_phase_names(parameters, phase_flags))
+               if name is not None and name not in phases]
+    if len(missing) > 0:
+        new_phases = evolution_phases.get_all_phases(missing, data, n_ml_phases, context=context)
+        phases.update(new_phases)
+        cached_phases = dict(cached_phases)
+        cached_phases.update({name: extract_cache.encode_phase(selection)
+                              for name, selection in new_phases.items()})
+        entry['phases'] = cached_phases
+
+    # 8: todo: check for some possible errors and flag them
+    if 'error_flags' not in entry:
+        entry['error_flags'] = [int(f) for f in
+                                evolution_errors.check_error_flags(data, extra_info['termination_code'],
+                                                                   context=context)]
+
+    return data, phases, pars, list(entry['error_flags']), entry
+
+
+def _extract_model_star(args):
+    """ unpack the (function, model, cache entry) tuples send to the worker processes """
+    extract_model, model, entry = args
+    return extract_model(model, cache_entry=entry)
+
+
+def _extract_batch_star(args):
+    """ unpack the (function, list of (model, cache entry)) tuples send to the worker processes """
+    extract_batch, tasks = args
+    return extract_batch(tasks)
+
+
 def extract_mesa(file_list, stability_criterion='J_div_Jdot_div_P', stability_limit=10, n_ml_phases=0,
                  ce_formalism='iben_tutukov1984', ce_parameters={'al':1}, ce_profile_name=None,
                  parameters=[], phase_flags=[], extra_info_parameters=[], add_setup_pars_to_result=True, verbose=False,
-                 flatten_output=False, **kwargs):
+                 flatten_output=False, n_jobs=1, cache=None, batch_size=None, **kwargs):
+    """
+    Extract the requested parameters from all compressed models in the file list.
+
+    Every model is processed independently. When **n_jobs** is larger than 1, the file list is sharded over that
+    many worker processes (-1 uses all available cores). Each worker returns the result rows of its models, and the
+    final DataFrame is assembled in the original order of the file list. Models that can not be read are left out of
+    the result.
+
+    Models stored in grid files (see :func:`~nnaps.mesa.compress_mesa.convert2hdf5`) are given by a 'grid_file'
+    column containing the grid file, with the path of the model in the grid in the 'path' column. Each worker keeps
+    the grid files open, and models in the same grid are read one after the other from the same file.
+
+    When a **cache** file is given, the results of the expensive steps of the extraction are stored in that sqlite
+    database: the stability of each model, the final state after the CE, the number of ML phases, the error flags
+    and the detected evolution phases. They are stored per model file (path, size and modification time) and per
+    setup (stability criterion and limit, CE formalism, parameters and profile, and n_ml_phases). When the same models
+    are extracted again with the same setup, for example to extract different parameters, only the parameters
+    themselves are computed. Changing the model file or the setup invalidates the cached result.
+
+    When a **batch_size** is given, the models are processed in batches of that many models. The models in a batch
+    are read and their phases are detected one by one, after which the parameters of all models in the batch are
+    extracted at once from a columnar table (see :func:`extract_parameters_batch`). This reduces the per model
+    overhead for grids with many short tracks. Averages can differ in the last digits from the default extraction.
+
+    :param file_list: Pandas DataFrame containing at least 1 column with the path of the models to extract
+    :param n_jobs: the number of processes to use
+    :type n_jobs: int
+    :param cache: path to the sqlite file to use as cache, None to not use a cache
+    :type cache: str
+    :param batch_size: the number of models to extract together, None to extract each model separately
+    :type batch_size: int
+    :return: the extracted parameters
+    :rtype: pandas DataFrame
+    """
 
     parameters, column_names = _process_parameters(parameters)
 
@@ -203,7 +732,6 @@ def extract_mesa(file_list, stability_criterion='J_div_Jdot_div_P', stability_li
     if add_setup_pars_to_result:
         columns += ['stability_criterion', 'stability_limit', 'ce_profile_name', 'ce_formalism', 'ce_parameters']
     columns += ['error_flags']
-    results = []
 
     # check if the same extraction parameters are used for all models, or if specific parameters are already
     # provided in the files list
@@ -211,74 +739,71 @@ def extract_mesa(file_list, stability_criterion='J_div_Jdot_div_P', stability_li
                  ce_formalism=ce_formalism, ce_parameters=ce_parameters, ce_profile_name=ce_profile_name,
                  verbose=verbose)
 
-    for i, model in file_list.iterrows():
+    extract_model = functools.partial(_extract_model, parameters=parameters, phase_flags=phase_flags,
+                                      extra_info_parameters=extra_info_parameters, n_ml_phases=n_ml_phases,
+                                      add_setup_pars_to_result=add_setup_pars_to_result, verbose=verbose)
+
+    models = [model for i, model in file_list.iterrows()]
+
+    # the cache is only read and written by the main process, the workers get the cached entry of their model
+    if cache is not None:
+        connection = extract_cache.open_cache(cache)
+        keys = []
+        for model in models:
+            try:
+                keys.append((extract_cache.get_model_key(model), extract_cache.get_setup_key(model, n_ml_phases)))
+            except OSError:
+                keys.append(None)
+        cached = extract_cache.load_entries(connection, [k for k in keys if k is not None])
+        entries = [cached.get(k, None) if k is not None else None for k in keys]
+    else:
+        connection, keys = None, [None] * len(models)
+        entries = [None] * len(models)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+
+    if batch_size is not None:
+        # every task is a batch of models, the rows of all batches are returned in the order of the file list
+        extract_batch = functools.partial(_extract_batch, parameters=parameters, phase_flags=phase_flags,
+                                          extra_info_parameters=extra_info_parameters, n_ml_phases=n_ml_phases,
+                                          add_setup_pars_to_result=add_setup_pars_to_result, verbose=verbose)
+        batches = [list(zip(models[i:i + batch_size], entries[i:i + batch_size]))
+                   for i in range(0, len(models), batch_size)]
+        tasks = zip(itertools.repeat(extract_batch), batches)
+        star, chunksize = _extract_batch_star, 1
+    else:
+        tasks = zip(itertools.repeat(extract_model), models, entries)
+        star, chunksize = _extract_model_star, max(1, int(np.ceil(len(models) / (4 * n_jobs))))
 
-        if verbose:
-            print(i, model['path'])
+    if n_jobs == 1:
+        rows = map(star, tasks)
+        pool = None
+    else:
+        # shard the models in chunks over the workers, imap returns the results in the order of the file list
+        pool = multiprocessing.Pool(processes=n_jobs)
+        rows = pool.imap(star, tasks, chunksize=chunksize)
 
-        # 1: Get the data
-        try:
-            data, extra_info, profiles = fileio.read_compressed_track(model['path'], return_profiles=True)
-        except Exception as e:
-            if verbose:
-                print(e)
-            continue
+    if batch_size is not None:
+        rows = itertools.chain.from_iterable(rows)
 
-        # 2: check for stability and cut data at start of CE
-        stable, ce_age = common_envelope.is_stable(data, criterion=model['stability_criterion'],
-                                                   value=model['stability_limit'])
-        stability = 'stable'
-
-        if not stable:
-            # if the model is not stable, cut of the evolution at the start of the CE as anything after than
-            # is non physical anyway.
-            data = data[data['age'] <= ce_age]
-
-            if ce_profile_name is not None:
-                try:
-                    profiles = profiles[model['ce_profile_name']]
-                except Exception:
-                    # todo: deal correctly with the missing profile!
-                    print('CE: profile missing')
-            data = common_envelope.apply_ce(data, profiles=profiles, ce_formalism=model['ce_formalism'],
-                                            **model['ce_parameters'])
-
-            # check if CE is ejected or if the system is a merger or a contact binary
-            s = np.where((data['star_2_radius'] >= 0.99 * data['rl_2']) &
-                         (data['star_1_radius'] >= 0.99 * data['rl_1']))
-
-            if data['binary_separation'][-1] <= 0:
-                stability = 'merger'
-                print('CE: Merged')
-            elif len(data['model_number'][s]) > 0:
-                stability = 'contact'
-                print('CE: Contact')
-            else:
-                stability = 'CE'
-
-        # 3: extract some standard parameters: Path, stability and nr of ML phases.
-        pars = [model['path'].split('/')[-1]]
-        pars += [stability, count_ml_phases(data)]
-
-        # 4: add the extra info to the output
-        for p in extra_info_parameters:
-            pars.append(extra_info[p])
-
-        # 5: extract the requested parameters & 6: add the requested phase flags
-        extracted_pars = extract_parameters(data, parameters, phase_flags, n_ml_phases=n_ml_phases)
-        pars += extracted_pars
-
-        # 7: Add the extraction setup parameters if requested
-        if add_setup_pars_to_result:
-            setup_pars = [model['stability_criterion'], model['stability_limit'], model['ce_profile_name'],
-                          model['ce_formalism'], model['ce_parameters']]
-            pars += setup_pars
-
-        # 8: todo: check for some possible errors and flag them
-        error_flags = evolution_errors.check_error_flags(data, extra_info['termination_code'])
-        pars.append(error_flags)
-
-        results.append(pars)
+    results = []
+    updated = {}
+    try:
+        for i, (pars, entry) in enumerate(rows):
+            if verbose:
+                print(i, models[i]['path'])
+            if pars is not None:
+                results.append(pars)
+            if keys[i] is not None and entry is not None and entry != entries[i]:
+                updated[keys[i]] = entry
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if connection is not None:
+            extract_cache.store_entries(connection, updated)
+            connection.close()
 
     results = pd.DataFrame(results, columns=columns)
 
@@ -289,4 +814,191 @@ def extract_mesa(file_list, stability_criterion='J_div_Jdot_div_P', stability_li
     return results
 
 
+def expand_ce_settings(ce_settings):
+    """
+    Expand the CE settings of a sweep to the grid of parameter values of each CE formalism. Every setting is a
+    dictionary with the 'ce_formalism' and a value or a list of values for each CE parameter. All combinations of the
+    given values are used:
+
+    .. code-block:: python
+
+        ce_settings = [{'ce_formalism': 'iben_tutukov1984', 'al': [0.5, 1.0, 2.0]},
+                       {'ce_formalism': 'webbink1984', 'al': [0.5, 1.0], 'lb': [0.5, 1.0]}]
+
+    :param ce_settings: list of dictionaries with the CE formalism and the CE parameter values
+    :type ce_settings: list
+    :return: list of (ce_formalism, parameters) tuples, where parameters is a dictionary with an array of the values
+             of each CE parameter, one value per combination.
+    :rtype: list
+    """
+    expanded = []
+    for setting in ce_settings:
+        setting = dict(setting)
+        ce_formalism = setting.pop('ce_formalism', 'iben_tutukov1984')
+        if ce_formalism not in common_envelope.CE_FORMALISMS:
+            raise ValueError('CE formalism not recognized, use one of: ' + str(common_envelope.CE_FORMALISMS))
+
+        names = list(setting.keys())
+        grid = np.meshgrid(*[np.atleast_1d(setting[name]) for name in names], indexing='ij')
+        expanded.append((ce_formalism, {name: values.ravel() for name, values in zip(names, grid)}))
+
+    return expanded
+
+
+def _sweep_model(model, ce_settings=[], extra_info_parameters=[], verbose=False):
+    """
+    Read a model, check the stability and calculate the state after the CE for all CE settings. The history before
+    the CE and the profiles are read only once.
+
+    .. note::
+        Function for internal use!
+
+    :return: list of result rows, one for each CE setting, or None if the model could not be read.
+    :rtype: list
+    """
+
+    grid_file = model['grid_file'] if 'grid_file' in model and isinstance(model['grid_file'], str) else None
+
+    columns = set()
+    for ce_formalism, _ in ce_settings:
+        columns.update(get_required_columns(stability_criterion=model['stability_criterion'],
+                                            ce_formalism=ce_formalism)[0])
+    try:
+        if grid_file is not None:
+            data, extra_info = fileio.read_grid_track(grid_file, model['path'], columns=sorted(columns))
+        else:
+            data, extra_info = fileio.read_compressed_track(model['path'], columns=sorted(columns))
+    except Exception as e:
+        if verbose:
+            print(e)
+        return None
+
+    path = model['path'].split('/')[-1]
+    extra = [extra_info[p] for p in extra_info_parameters]
+
+    stable, ce_age = common_envelope.is_stable(data, criterion=model['stability_criterion'],
+                                               value=model['stability_limit'])
+
+    if stable:
+        # no CE, the final state does not depend on the CE setting
+        rows = []
+        for ce_formalism, parameters in ce_settings:
+            n = len(next(iter(parameters.values()))) if len(parameters) > 0 else 1
+            for i in range(n):
+                rows.append([path, 'stable'] + extra + [ce_formalism, {k: v[i].item() for k, v in parameters.items()},
+                                                        np.nan, np.nan, np.nan, np.nan])
+        return rows
+
+    data = data[data['age'] <= ce_age]
+
+    profiles = None
+    if 'dewi_tauris2000' in [ce_formalism for ce_formalism, _ in ce_settings]:
+        profiles = _read_ce_profiles(model, grid_file=grid_file, verbose=verbose)
+
+    # the history before the CE is the same for all settings, only the row after the CE differs
+    contact_before = np.any((data['star_2_radius'] >= 0.99 * data['rl_2']) &
+                            (data['star_1_radius'] >= 0.99 * data['rl_1']))
+    M2 = data['star_2_mass'][-1]
 
+    rows = []
+    for ce_formalism, parameters in ce_settings:
+        af, M1_final = common_envelope.ce_final_states(data, profiles=profiles, ce_formalism=ce_formalism,
+                                                       **parameters)
+        af, M1_final = np.atleast_1d(af), np.atleast_1d(M1_final)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            P, q, rl_1, rl_2 = common_envelope.post_ce_orbit(M2, af, M1_final)
+
+        contact = contact_before | ((data['star_2_radius'][-1] >= 0.99 * rl_2) &
+                                    (data['star_1_radius'][-1] >= 0.99 * rl_1))
+        stability = np.where(af <= 0, 'merger', np.where(contact, 'contact', 'CE'))
+
+        for i in range(len(af)):
+            rows.append([path, str(stability[i])] + extra +
+                        [ce_formalism, {k: v[i].item() for k, v in parameters.items()},
+                         float(af[i]), float(M1_final[i]), float(P[i]), float(q[i])])
+
+    return rows
+
+
+def sweep_ce(file_list, ce_settings, stability_criterion='J_div_Jdot_div_P', stability_limit=10,
+             ce_profile_name=None, extra_info_parameters=[], n_jobs=1, verbose=False, **kwargs):
+    """
+    Calculate the state after the CE phase of all models in the file list for a grid of CE formalisms and CE
+    parameters. Each model is read and checked for stability only once, after which all CE settings are applied to
+    the history at the onset of the CE. For the closed form formalisms (iben_tutukov1984, webbink1984 and
+    demarco2011) all values of the CE parameters are calculated at once.
+
+    The CE settings are given as a list of dictionaries with the CE formalism and one or more values for each of its
+    parameters, see :func:`expand_ce_settings`:
+
+    .. code-block:: python
+
+        ce_settings = [{'ce_formalism': 'iben_tutukov1984', 'al': [0.5, 1.0, 2.0]},
+                       {'ce_formalism': 'webbink1984', 'al': [0.5, 1.0], 'lb': [0.5, 1.0]}]
+        results = sweep_ce(file_list, ce_settings, stability_criterion='Mdot', stability_limit=-3)
+
+    The result is a long format table with one row per model and CE setting, containing the path, the stability
+    ('stable', 'CE', 'merger' or 'contact'), the extra info parameters, the CE formalism, the CE parameters as a
+    dictionary and as a column per parameter, and the binary_separation, star_1_mass, period_days and mass_ratio after
+    the CE. The state after the CE is NaN for stable models.
+
+    :param file_list: Pandas DataFrame containing at least 1 column with the path of the models
+    :param ce_settings: list of dictionaries with the CE formalism and the CE parameter values
+    :type ce_settings: list
+    :param stability_criterion: the stability criterion to use
+    :param stability_limit: the limit of the stability criterion
+    :param ce_profile_name: the name of the profile to use for dewi_tauris2000
+    :param extra_info_parameters: the extra info parameters to add to the result
+    :param n_jobs: the number of processes to use
+    :type n_jobs: int
+    :return: the state after the CE for each model and CE setting
+    :rtype: pandas DataFrame
+    """
+
+    ce_settings = expand_ce_settings(ce_settings)
+
+    extra_info_parameters, extra_names = _process_parameters(extra_info_parameters)
+    parameter_names = list(dict.fromkeys([name for _, parameters in ce_settings for name in parameters.keys()]))
+
+    columns = ['path', 'stability'] + extra_names + ['ce_formalism', 'ce_parameters', 'binary_separation',
+                                                     'star_1_mass', 'period_days', 'mass_ratio']
+
+    file_list = process_file_list(file_list, stability_criterion=stability_criterion,
+                                  stability_limit=stability_limit, ce_profile_name=ce_profile_name, ce_parameters={},
+                                  verbose=verbose)
+
+    sweep_model = functools.partial(_sweep_model, ce_settings=ce_settings,
+                                    extra_info_parameters=extra_info_parameters, verbose=verbose)
+
+    models = [model for i, model in file_list.iterrows()]
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs == 1:
+        rows = map(sweep_model, models)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=n_jobs)
+        rows = pool.imap(sweep_model, models, chunksize=max(1, int(np.ceil(len(models) / (4 * n_jobs)))))
+
+    results = []
+    try:
+        for i, model_rows in enumerate(rows):
+            if verbose:
+                print(i, models[i]['path'])
+            if model_rows is not None:
+                results.extend(model_rows)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = pd.DataFrame(results, columns=columns)
+
+    # one column per CE parameter, NaN for the formalisms that don't use it
+    for name in parameter_names:
+        results[name] = [p.get(name, np.nan) for p in results['ce_parameters']]
+
+    return results
@@ -1,13 +1,16 @@
 import os
+import json
 import h5py
 
 import numpy as np
-from numpy.lib.recfunctions import append_fields
+import pandas as pd
+from numpy.lib.recfunctions import structured_to_unstructured
 
 from scipy.interpolate import interp1d
 
 
-def write2hdf5(data, filename, update=False, attr_types=[]):
+def write2hdf5(data, filename, update=False, attr_types=[], compression=None, compression_opts=None, shuffle=False,
+               chunks=None):
     """
     Write the content of a dictionary to a hdf5 file. The dictionary can contain other
     nested dictionaries, this file stucture will be maintained in the saved hdf5 file.
@@ -26,6 +29,17 @@ def write2hdf5(data, filename, update=False, attr_types=[]):
     :param attr_types: the data types that you want to save as an attribute instead of
                       a dataset. (standard everything is saved as dataset.)
     :type attr_types: List of types
+    :param compression: the compression filter to use for array datasets: None, 'gzip' or 'lzf'
+    :type compression: str
+    :param compression_opts: the compression level when using gzip (0-9), None for the default level 4. Ignored by
+                             the other filters.
+    :type compression_opts: int
+    :param shuffle: if True, apply the shuffle filter before compression, which usually improves the compression of
+                    numerical data
+    :type shuffle: bool
+    :param chunks: the chunk shape of array datasets: None or True to let h5py choose, or an int giving the number of
+                   rows per chunk
+    :type chunks: None, bool or int
     """
 
     if not update and os.path.isfile(filename):
@@ -50,7 +64,8 @@ def write2hdf5(data, filename, update=False, attr_types=[]):
                     # other data is stored as datasets
                     if key in hdf:
                         del hdf[key]
-                    hdf.create_dataset(key, data=data[key])
+                    hdf.create_dataset(key, data=data[key], **_get_filter_options(data[key], compression,
+                                                                                 compression_opts, shuffle, chunks))
 
             except Exception as e:
                 print( 'Error while trying to write: {}, type: {}'.format(key, type(key)) )
@@ -61,6 +76,53 @@ def write2hdf5(data, filename, update=False, attr_types=[]):
     hdf.close()
 
 
+def _get_filter_options(value, compression=None, compression_opts=None, shuffle=False, chunks=None):
+    """
+    Get the chunking and compression options for a dataset. Filters can only be applied to chunked datasets, so
+    scalars and empty arrays are stored without them. The compression level is only used by gzip, and defaults to
+    4 there.
+    """
+    if compression is None and not shuffle and chunks is None:
+        return {}
+
+    value = np.asarray(value)
+    if value.ndim == 0 or value.size == 0 or value.dtype.kind == 'O':
+        return {}
+
+    if type(chunks) is int:
+        chunks = (min(chunks, value.shape[0]),) + value.shape[1:]
+    elif chunks is None:
+        chunks = True
+
+    if compression != 'gzip':
+        compression_opts = None
+    elif compression_opts is None:
+        compression_opts = 4
+
+    return {'compression': compression, 'compression_opts': compression_opts, 'shuffle': shuffle, 'chunks': chunks}
+
+
+def _read_rec(hdf):
+    """ recursively read the hdf5 file """
+    res = {}
+    for name, grp in hdf.items():
+        # -- read the subgroups and datasets
+        if hasattr(grp, 'items'):
+            # in case of a group, read the group into a new dictionary key
+            res[name] = _read_rec(grp)
+        else:
+            # in case of dataset, read the value
+            # this used to be grp.value, but was changes in version 3.0 of h5py
+            # H5pyDeprecationWarning: dataset.value has been deprecated. Use dataset[()] instead.
+            res[name] = grp[()]
+
+    # -- read all the attributes
+    for name, atr in hdf.attrs.items():
+        res[name] = atr
+
+    return res
+
+
 def read_hdf5(filename):
     """
     Read the filestructure of a hdf5 file to a dictionary.
@@ -79,34 +141,181 @@ def read_hdf5(filename):
         print("File does not exist")
         raise IOError
 
-    def read_rec(hdf):
-        """ recursively read the hdf5 file """
-        res = {}
-        for name, grp in hdf.items():
-            # -- read the subgroups and datasets
-            if hasattr(grp, 'items'):
-                # in case of a group, read the group into a new dictionary key
-                res[name] = read_rec(grp)
-            else:
-                # in case of dataset, read the value
-                # this used to be grp.value, but was changes in version 3.0 of h5py
-                # H5pyDeprecationWarning: dataset.value has been deprecated. Use dataset[()] instead.
-                res[name] = grp[()]
-
-        # -- read all the attributes
-        for name, atr in hdf.attrs.items():
-            res[name] = atr
-
-        return res
-
     hdf = h5py.File(filename, 'r')
-    result = read_rec(hdf)
+    result = _read_rec(hdf)
     hdf.close()
 
     return result
 
 
-def read_compressed_track(filename, return_profiles=False):
+# derived parameters added by read_compressed_track and the history columns they are calculated from
+DERIVED_PARAMETERS = {'effective_T': ['log_Teff'],
+                      'effective_T_2': ['log_Teff_2'],
+                      'rl_overflow_1': ['star_1_radius', 'rl_1'],
+                      'mass_ratio': ['star_1_mass', 'star_2_mass'],
+                      'separation_au': ['binary_separation'],
+                      'CE_phase': [],
+                      'log10_J_div_Jdot_div_P': ['J_orb', 'Jdot', 'period_days'],
+                      'log10_M_div_Mdot_div_P': ['star_1_mass', 'lg_mstar_dot_1', 'period_days'],
+                      }
+
+
+def _expand_columns(columns):
+    """
+    Add the columns needed to calculate the requested derived parameters to the requested columns, together with
+    the model_number and age which are always read.
+
+    :param columns: the requested columns of the combined history
+    :type columns: list
+    :return: all history columns that need to be read
+    :rtype: set
+    """
+    columns = set(columns) | {'model_number', 'age'}
+    for name in list(columns):
+        columns.update(DERIVED_PARAMETERS.get(name, []))
+    return columns
+
+
+def _read_history(dataset, columns=None, suffix='', rows=slice(None)):
+    """
+    Read a history dataset from an open hdf5 file. If columns are given, only the fields of the dataset that appear
+    in columns (after adding the suffix to their name) are read, together with the model_number.
+
+    :param dataset: h5py dataset containing the history
+    :param columns: the columns of the combined history to read, None to read all columns
+    :param suffix: the suffix that the fields of this history get in the combined history
+    :param rows: the rows of the dataset to read, by default all rows are read
+    :return: the history
+    :rtype: numpy ndarray
+    """
+    if columns is None:
+        return dataset[rows]
+
+    names = [name for name in dataset.dtype.names if name == 'model_number' or name + suffix in columns]
+    return dataset.fields(names)[rows]
+
+
+def _align_history(history, model_numbers, alignment='auto'):
+    """
+    Align all columns of a history to the given model numbers.
+
+    With alignment 'interpolate', all columns are linearly interpolated to the requested model numbers. With
+    alignment 'auto', the rows of the history with exactly the requested model numbers are selected with an index
+    join, and only requested model numbers that are not present in the history are interpolated. This requires the
+    model numbers of the history to be strictly increasing, if that is not the case all rows are interpolated.
+
+    In both cases model numbers outside of the range covered by the history get a value of 0.
+
+    :param history: the history to align
+    :type history: numpy ndarray
+    :param model_numbers: the model numbers to align to
+    :type model_numbers: numpy array
+    :param alignment: 'auto' or 'interpolate'
+    :type alignment: str
+    :return: 2D float array with one row per model number and one column per field of the history
+    :rtype: numpy array
+    """
+    if alignment not in ['auto', 'interpolate']:
+        raise ValueError("Alignment {} not recognized, use 'auto' or 'interpolate'".format(alignment))
+
+    y = structured_to_unstructured(history, dtype=np.float64)
+    mn = history['model_number']
+
+    if alignment == 'auto' and len(mn) > 0 and np.all(np.diff(mn) > 0):
+        ind = np.clip(np.searchsorted(mn, model_numbers), 0, len(mn) - 1)
+        exact = mn[ind] == model_numbers
+
+        result = y[ind]
+        if not np.all(exact):
+            f = interp1d(mn, y, axis=0, bounds_error=False, fill_value=0.0, assume_sorted=True)
+            result[~exact] = f(model_numbers[~exact])
+        return result
+
+    f = interp1d(mn, y, axis=0, bounds_error=False, fill_value=0.0)
+    return f(model_numbers)
+
+
+def _merge_history(db, d1, d2=None, alignment='auto'):
+    """
+    Build the combined history of the binary and both stars. The stellar histories are aligned to the model
+    numbers of the binary history (see :func:`_align_history`), and the final structured array is allocated once and filled column by column
+    directly from the interpolated data. Derived parameters are computed from the filled columns and written in
+    their place in the same array.
+
+    :param db: binary history
+    :param d1: history of the primary
+    :param d2: history of the secondary, can be None
+    :param alignment: how to align the stellar histories: 'auto' or 'interpolate'
+    :return: the combined history
+    :rtype: numpy ndarray
+    """
+    model_numbers = db['model_number']
+
+    # list of (name in merged history, dtype, interpolated data) for all stellar columns
+    star_columns = []
+    for history, suffix in [(d1, ''), (d2, '_2')]:
+        if history is None:
+            continue
+        y = _align_history(history, model_numbers, alignment=alignment)
+        for i, name in enumerate(history.dtype.names):
+            if name == 'model_number':
+                continue
+            star_columns.append((name + suffix, history.dtype[name], y[:, i]))
+
+    all_columns = list(db.dtype.names) + [c[0] for c in star_columns]
+
+    # derived parameters and the function to calculate them from the merged history
+    derived = []
+
+    if not 'effective_T' in all_columns and 'log_Teff' in all_columns:
+        derived.append(('effective_T', lambda data: 10**data['log_Teff']))
+
+    if not 'effective_T_2' in all_columns and 'log_Teff_2' in all_columns:
+        derived.append(('effective_T_2', lambda data: 10**data['log_Teff_2']))
+
+    if not 'rl_overflow_1' in all_columns and 'star_1_radius' in all_columns and 'rl_1' in all_columns:
+        derived.append(('rl_overflow_1', lambda data: data['star_1_radius'] / data['rl_1']))
+
+    if not 'mass_ratio' in all_columns and 'star_1_mass' in all_columns and 'star_2_mass' in all_columns:
+        derived.append(('mass_ratio', lambda data: data['star_1_mass'] / data['star_2_mass']))
+
+    if not 'separation_au' in all_columns and 'binary_separation' in all_columns:
+        derived.append(('separation_au', lambda data: data['binary_separation'] * 0.004649183820234682))
+
+    if not 'CE_phase' in all_columns and db is not None:
+        # only add when the model is binary
+        derived.append(('CE_phase', lambda data: 0))
+
+    if 'J_orb' in all_columns and 'Jdot' in all_columns and 'period_days' in all_columns:
+        def J_Jdot_P(data):
+            J_Jdot_P = (data['J_orb'] / np.abs(data['Jdot'])) / (data['period_days'] * 24.0 *60.0 *60.0)
+            return np.where((J_Jdot_P == 0 ), 99, np.log10(J_Jdot_P))
+        derived.append(('log10_J_div_Jdot_div_P', J_Jdot_P))
+
+    if 'star_1_mass' in all_columns and 'lg_mstar_dot_1' in all_columns and 'period_days' in all_columns:
+        def M_Mdot_P(data):
+            M_Mdot_P = (data['star_1_mass'] / 10 ** data['lg_mstar_dot_1']) / (data['period_days'] / 365)
+            return np.where((M_Mdot_P == 0), 99, np.log10(M_Mdot_P))
+        derived.append(('log10_M_div_Mdot_div_P', M_Mdot_P))
+
+    # allocate the final array once, CE_phase gets the same type as model_number.
+    dtype = [(name, db.dtype[name]) for name in db.dtype.names] + [(c[0], c[1]) for c in star_columns]
+    dtype += [(name, db.dtype['model_number'] if name == 'CE_phase' else np.float64) for name, _ in derived]
+    data = np.empty(len(db), dtype=dtype)
+
+    for name in db.dtype.names:
+        data[name] = db[name]
+
+    for name, _, values in star_columns:
+        data[name] = values
+
+    for name, func in derived:
+        data[name] = func(data)
+
+    return data
+
+
+def read_compressed_track(filename, return_profiles=False, alignment='auto', columns=None):
     """
     Function to read a compressed hdf5 model. It will automatically combine the evolution history of the stellar parts
     and the binary part in one numpy rec array, while correcting for potentially different model numbers in the
@@ -144,120 +353,309 @@ def read_compressed_track(filename, return_profiles=False):
     :type filename: str
     :param return_profiles: If True, return a dictionary containing the profiles.
     :type return_profiles: bool
+    :param alignment: How to align the stellar histories to the binary history: 'auto' or 'interpolate'
+    :type alignment: str
+    :param columns: Only read these columns of the combined history, None to read all of them. Columns of the secondary
+                    have their '_2' suffix, and requesting a derived parameter reads the columns it is calculated from.
+                    The model_number and age are always read.
+    :type columns: list
     :return: history, extra_info (, profiles): A numpy rec array containing the combined history, a dictionary with
              any extra info, and optionally a dictionary containing all profiles.
     :rtype: rec_array, dict (, dict)
     """
 
-    data_ = read_hdf5(filename)
+    if not os.path.isfile(filename):
+        print("File does not exist")
+        raise IOError
+
+    if columns is not None:
+        columns = _expand_columns(columns)
+
+    with h5py.File(filename, 'r') as hdf:
+        extra_info = _read_rec(hdf['extra_info']) if 'extra_info' in hdf else None
+
+        history = hdf['history']
+        d1 = _read_history(history['star1'], columns) if 'star1' in history else None
+        d2 = _read_history(history['star2'], columns, suffix='_2') if 'star2' in history else None
+        db = _read_history(history['binary'], columns) if 'binary' in history else None
 
-    history = data_.pop('history', None)
-    d1 = history.pop('star1', None)
-    d2 = history.pop('star2', None)
-    db = history.pop('binary', None)
+        if return_profiles:
+            profiles = _read_profiles(hdf)
 
+    data = _combine_history(db, d1, d2, alignment=alignment)
+
+    if return_profiles:
+        return data, extra_info, profiles
+
+    return data, extra_info
 
-    extra_info = data_.pop('extra_info', None)
 
+def _combine_history(db, d1, d2=None, alignment='auto'):
+    """
+    Renumber the history of the primary to start at model number 1, cut the binary history at the last model of the
+    primary and merge all histories with :func:`_merge_history`.
+    """
     # set model number for primary to start at 1 and limits to correct last model number
     d1['model_number'] = d1['model_number'] - d1['model_number'][0] + 1
     s = np.where(db['model_number'] <= d1['model_number'][-1])
     db = db[s]
 
-    # PRIMARY
-    # now interpolate primary data to match model numbers for binary history
-    dtypes = d1.dtype
-    y = d1.view(np.float64).reshape(-1, len(dtypes))
-    f = interp1d(d1['model_number'], y, axis=0, bounds_error=False, fill_value=0.0)
-    d1 = f(db['model_number'])
-
-    # reconvert from array to recarray
-    d1 = [tuple(d) for d in d1]
-    d1 = np.array(d1, dtype=dtypes)
-
-    # remove model_number as column from d1 and merge into 1 recarray
-    columns1 = list(d1.dtype.names)
-    columns1.remove('model_number')
-    column_names1 = [c for c in columns1]
-
-    # SECONDARY
-    if d2 is not None:
-        # now interpolate secondary data to match model numbers for binary history
-        dtypes = d2.dtype
-        y = d2.view(np.float64).reshape(-1, len(dtypes))
-        f = interp1d(d2['model_number'], y, axis=0, bounds_error=False, fill_value=0.0)
-        d2 = f(db['model_number'])
-
-        # reconvert from array to recarray
-        d2 = [tuple(d) for d in d2]
-        d2 = np.array(d2, dtype=dtypes)
-
-        # remove model_number as column from d1 and merge into 1 recarray
-        columns2 = list(d2.dtype.names)
-        columns2.remove('model_number')
-        column_names2 = [c+'_2' for c in columns2]
-
-    # create a new record array from the data (much faster than appending to an existing array)
-    columnsdb = list(db.dtype.names)
-
-    if d2 is not None:
-        all_data = [db[c] for c in columnsdb] + [d1[c] for c in columns1] + [d2[c] for c in columns2]
-        all_columns = columnsdb + column_names1 + column_names2
-    else:
-        all_data = [db[c] for c in columnsdb] + [d1[c] for c in columns1]
-        all_columns = columnsdb + column_names1
-
-    data = np.core.records.fromarrays(all_data, names=all_columns)
-
-    fields = []
-    fields_data = []
+    return _merge_history(db, d1, d2, alignment=alignment)
 
-    if not 'effective_T' in all_columns and 'log_Teff' in all_columns:
-        fields.append('effective_T')
-        fields_data.append(10**data['log_Teff'])
 
-    if not 'effective_T_2' in all_columns and 'log_Teff_2' in all_columns:
-        fields.append('effective_T_2')
-        fields_data.append(10**data['log_Teff_2'])
+def _read_profiles(hdf, profile_names=None):
+    """
+    Read the profiles and the profile legend from an open hdf5 file. Returns None if the file contains no profiles.
+    """
+    if 'profiles' not in hdf:
+        return None
 
-    if not 'rl_overflow_1' in all_columns and 'star_1_radius' in all_columns and 'rl_1' in all_columns:
-        fields.append('rl_overflow_1')
-        fields_data.append(data['star_1_radius'] / data['rl_1'])
+    if profile_names is None:
+        profile_names = list(hdf['profiles'].keys())
 
-    if not 'mass_ratio' in all_columns and 'star_1_mass' in all_columns and 'star_2_mass' in all_columns:
-        fields.append('mass_ratio')
-        fields_data.append(data['star_1_mass'] / data['star_2_mass'])
+    profiles = {name: hdf['profiles'][name][()] for name in profile_names if name in hdf['profiles']}
+    profiles['legend'] = hdf['profile_legend'][()] if 'profile_legend' in hdf else None
 
-    if not 'separation_au' in all_columns and 'binary_separation' in all_columns:
-        fields.append('separation_au')
-        fields_data.append(data['binary_separation'] * 0.004649183820234682)
+    return profiles
 
-    if not 'CE_phase' in all_columns and db is not None:
-        # only add when the model is binary
-        fields.append('CE_phase')
-        fields_data.append(np.zeros_like(data['model_number']))
 
-    if 'J_orb' in all_columns and 'Jdot' in all_columns and 'period_days' in all_columns:
-        J_Jdot_P = (data['J_orb'] / np.abs(data['Jdot'])) / (data['period_days'] * 24.0 *60.0 *60.0)
-        J_Jdot_P = np.where((J_Jdot_P == 0 ), 99, np.log10(J_Jdot_P))
-        fields.append('log10_J_div_Jdot_div_P')
-        fields_data.append(J_Jdot_P)
+def read_profiles(filename, profile_names=None):
+    """
+    Read only the profiles of a compressed hdf5 model, without touching the history. The profiles are returned in
+    the same format as by :func:`~nnaps.mesa.fileio.read_compressed_track`: a dictionary containing the profiles by
+    name together with the 'legend' mapping the profile names to the model number at which they were taken.
 
-    if 'star_1_mass' in all_columns and 'lg_mstar_dot_1' in all_columns and 'period_days' in all_columns:
-        M_Mdot_P = (data['star_1_mass'] / 10 ** data['lg_mstar_dot_1']) / (data['period_days'] / 365)
-        M_Mdot_P = np.where((M_Mdot_P == 0), 99, np.log10(M_Mdot_P))
-        fields.append('log10_M_div_Mdot_div_P')
-        fields_data.append(M_Mdot_P)
+    :param filename: The path to the hdf5 compressed file to read
+    :type filename: str
+    :param profile_names: the names of the profiles to read, None to read all profiles
+    :type profile_names: list
+    :return: dictionary containing the profiles, or None if the model doesn't contain any profiles
+    :rtype: dict
+    """
 
-    data = append_fields(data, fields, fields_data, usemask=False)
+    if not os.path.isfile(filename):
+        print("File does not exist")
+        raise IOError
 
-    if return_profiles:
-        if 'profiles' not in data_:
-            profiles = None
+    with h5py.File(filename, 'r') as hdf:
+        profiles = _read_profiles(hdf, profile_names=profile_names)
+
+    return profiles
+
+
+#{ Grid files
+
+GRID_HISTORIES = ['star1', 'star2', 'binary']
+GRID_CHUNK_ROWS = 512
+
+
+def _json_default(value):
+    """ convert the numpy types and paths in the extra info of a model to something json can store """
+    if isinstance(value, bytes):
+        return value.decode('UTF-8')
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _grid_index_dtype():
+    dtype = [('path', h5py.string_dtype()), ('extra_info', h5py.string_dtype())]
+    for name in GRID_HISTORIES:
+        dtype += [(name + '_start', 'i8'), (name + '_stop', 'i8')]
+    return np.dtype(dtype)
+
+
+def append_to_grid(filename, data, path, compression=None, compression_opts=None, shuffle=False, chunks=None):
+    """
+    Append one model to a grid file. A grid file stores many compressed models in one hdf5 file:
+
+    - history/star1, history/star2 and history/binary: the histories of all models concatenated in one table each.
+    - index: one row per model with the path of the model, its extra info stored as a json string, and for each
+      history the start and stop row of the model in the concatenated table.
+    - profiles/<row in index>: the profiles and profile_legend of the model, if any.
+
+    The histories of all models in a grid need to have the same columns. Models are appended at the end, the file
+    is created if it doesn't exist yet.
+
+    :param filename: the grid file
+    :type filename: str
+    :param data: the data of one model, in the format returned by :func:`~nnaps.mesa.compress_mesa.read_model`
+    :type data: dict
+    :param path: the path of the model, used to identify it in the grid
+    :type path: str
+    :param compression: the compression filter to use: None, 'gzip' or 'lzf'
+    :param compression_opts: the compression level when using gzip
+    :param shuffle: if True, apply the shuffle filter before compression
+    :param chunks: the number of rows per chunk, default is GRID_CHUNK_ROWS
+    """
+    chunks = chunks if type(chunks) is int else GRID_CHUNK_ROWS
+
+    _close_grid(filename)
+
+    with h5py.File(filename, 'a') as hdf:
+        if 'index' not in hdf:
+            hdf.create_dataset('index', shape=(0,), maxshape=(None,), dtype=_grid_index_dtype(), chunks=(64,))
+        index = hdf['index']
+
+        row = np.zeros(1, dtype=index.dtype)
+        row['path'] = str(path)
+        row['extra_info'] = json.dumps(data.get('extra_info', {}), default=_json_default)
+
+        history = data.get('history', {})
+        for name in GRID_HISTORIES:
+            key = 'history/' + name
+            if name not in history:
+                start = len(hdf[key]) if key in hdf else 0
+                row[name + '_start'], row[name + '_stop'] = start, start
+                continue
+
+            table = history[name]
+            if key not in hdf:
+                hdf.create_dataset(key, shape=(0,), maxshape=(None,), dtype=table.dtype, chunks=(chunks,),
+                                   compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+            elif hdf[key].dtype != table.dtype:
+                raise ValueError('The columns of the {} history of {} are different from the other models in the '
+                                 'grid'.format(name, path))
+
+            dataset = hdf[key]
+            start = len(dataset)
+            dataset.resize((start + len(table),))
+            dataset[start:] = table
+            row[name + '_start'], row[name + '_stop'] = start, start + len(table)
+
+        i = len(index)
+        if 'profiles' in data:
+            group = hdf.require_group('profiles').create_group(str(i))
+            for name, profile in data['profiles'].items():
+                group.create_dataset('profiles/' + name, data=profile,
+                                     **_get_filter_options(profile, compression, compression_opts, shuffle))
+            group.create_dataset('profile_legend', data=data['profile_legend'])
+
+        index.resize((i + 1,))
+        index[i] = row[0]
+
+
+def read_grid_index(filename):
+    """
+    Read the index of a grid file created with :func:`append_to_grid`.
+
+    :param filename: the grid file
+    :type filename: str
+    :return: the path, extra info (as dictionary) and the location of the histories of all models in the grid
+    :rtype: pandas DataFrame
+    """
+    if not os.path.isfile(filename):
+        print("File does not exist")
+        raise IOError
+
+    with h5py.File(filename, 'r') as hdf:
+        index = hdf['index'][()]
+
+    index = pd.DataFrame(index)
+    index['path'] = [p.decode('UTF-8') for p in index['path']]
+    index['extra_info'] = [json.loads(e) for e in index['extra_info']]
+
+    return index
+
+
+# grid files that are open in this process, with their index. They are kept open while extracting many models from
+# the same grid, and reopened when the file changed or when used in a different process.
+_open_grids = {}
+
+
+def _close_grid(filename):
+    key = (os.getpid(), os.path.abspath(filename))
+    if key in _open_grids:
+        _open_grids.pop(key)[1].close()
+
+
+def _get_grid(filename):
+    filename = os.path.abspath(filename)
+    key = (os.getpid(), filename)
+    mtime = os.path.getmtime(filename)
+
+    if key not in _open_grids or _open_grids[key][0] != mtime:
+        if key in _open_grids:
+            _open_grids[key][1].close()
+        hdf = h5py.File(filename, 'r')
+        index = hdf['index'][()]
+        rows = {p.decode('UTF-8'): i for i, p in enumerate(index['path'])}
+        _open_grids[key] = (mtime, hdf, index, rows)
+
+    return _open_grids[key][1:]
+
+
+def _get_grid_model(filename, path):
+    hdf, index, rows = _get_grid(filename)
+    if str(path) not in rows:
+        raise IOError('Model {} not found in grid {}'.format(path, filename))
+    i = rows[str(path)]
+    return hdf, i, index[i]
+
+
+def read_grid_track(filename, path, return_profiles=False, alignment='auto', columns=None):
+    """
+    Read one model from a grid file. This works the same as :func:`read_compressed_track` for a single compressed
+    model, and returns the same combined history, extra info and optionally profiles.
+
+    The grid file is kept open after reading, so that reading many models from the same grid only requires to open
+    the file once.
+
+    :param filename: the grid file
+    :type filename: str
+    :param path: the path of the model in the grid
+    :type path: str
+    :param return_profiles: If True, return a dictionary containing the profiles.
+    :type return_profiles: bool
+    :param alignment: How to align the stellar histories to the binary history: 'auto' or 'interpolate'
+    :type alignment: str
+    :param columns: Only read these columns of the combined history, None to read all of them.
+    :type columns: list
+    :return: history, extra_info (, profiles)
+    :rtype: rec_array, dict (, dict)
+    """
+    hdf, i, row = _get_grid_model(filename, path)
+
+    if columns is not None:
+        columns = _expand_columns(columns)
+
+    extra_info = json.loads(row['extra_info'])
+
+    histories = {}
+    for name, suffix in zip(GRID_HISTORIES, ['', '_2', '']):
+        key = 'history/' + name
+        if key in hdf and row[name + '_stop'] > row[name + '_start']:
+            rows = slice(row[name + '_start'], row[name + '_stop'])
+            histories[name] = _read_history(hdf[key], columns, suffix=suffix, rows=rows)
         else:
-            profiles = data_.get('profiles')
-            profiles['legend'] = data_.get('profile_legend')
+            histories[name] = None
 
-        return data, extra_info, profiles
+    data = _combine_history(histories['binary'], histories['star1'], histories['star2'], alignment=alignment)
+
+    if return_profiles:
+        return data, extra_info, read_grid_profiles(filename, path)
 
     return data, extra_info
+
+
+def read_grid_profiles(filename, path, profile_names=None):
+    """
+    Read only the profiles of one model in a grid file, in the same format as :func:`read_profiles`.
+
+    :param filename: the grid file
+    :type filename: str
+    :param path: the path of the model in the grid
+    :type path: str
+    :param profile_names: the names of the profiles to read, None to read all profiles
+    :type profile_names: list
+    :return: dictionary containing the profiles, or None if the model doesn't contain any profiles
+    :rtype: dict
+    """
+    hdf, i, row = _get_grid_model(filename, path)
+
+    if 'profiles' not in hdf or str(i) not in hdf['profiles']:
+        return None
+
+    return _read_profiles(hdf['profiles'][str(i)], profile_names=profile_names)
+
+#}
@@ -5,7 +5,17 @@ import pandas as pd
 
 from pathlib import Path
 
-from nnaps.mesa import compress_mesa, extract_mesa, defaults
+from nnaps.mesa import compress_mesa, extract_mesa, defaults, fileio
+
+
+def _get_grid_file_list(grid_files):
+    """ list all models in the given grid files, with the grid file in a separate column """
+    files = []
+    for grid_file in grid_files:
+        index = fileio.read_grid_index(grid_file)
+        files.append(pd.DataFrame(data={'path': index['path'], 'grid_file': str(grid_file)}))
+
+    return pd.concat(files, ignore_index=True)
 
 
 def get_file_list(input_list):
@@ -17,12 +27,23 @@ def get_file_list(input_list):
     path to the MESA model to process. The csv file can also contain columns with extra parameters that can be relevant
     during the model extraction.
 
-    :param input_list: list of input directories or csv files
+    Models compressed in grid files can be given as the grid files themselves (.h5), or as the directory containing
+    them. A directory is treated as a grid store when it contains files named grid_*.h5. All models in the grid
+    files are returned, with the grid file in the 'grid_file' column.
+
+    :param input_list: list of input directories, csv files or grid files
     :return: pandas dataframe containing the path to all models to process
     """
 
-    # differentiate between csv files and directories
+    # differentiate between csv files, grid files and directories
     if os.path.isdir(input_list[0]):
+        grid_files = []
+        for input_dir in input_list:
+            grid_files += sorted(glob.glob(str(Path(input_dir, 'grid_*.h5'))))
+
+        if len(grid_files) > 0:
+            return _get_grid_file_list(grid_files)
+
         files = []
         for input_dir in input_list:
             files_ = glob.glob(str(Path(input_dir, '*')))
@@ -30,6 +51,9 @@ def get_file_list(input_list):
 
         file_list = pd.DataFrame(data=files, columns=['path'])
 
+    elif os.path.splitext(input_list[0])[1] == '.h5':
+        file_list = _get_grid_file_list(input_list)
+
     else:
         # all inputs are csv files
         files = []
@@ -98,6 +122,25 @@ def _compress(args):
         else:
             setup['input_path_prefix'] = './'
 
+    if args.n_jobs is not None:
+        setup['n_jobs'] = args.n_jobs
+
+    # only store the columns that are used by the given extraction setup
+    extract_setup = setup.pop('extract_setup', None)
+    if extract_setup is not None:
+        history_columns, profile_columns = extract_mesa.get_required_columns(**defaults.read_defaults(extract_setup))
+        setup['history_columns'] = history_columns
+        if not setup.get('profile_columns', None) and len(profile_columns) > 0:
+            setup['profile_columns'] = profile_columns
+
+    if args.grid:
+        setup['grid'] = True
+    if args.shard_size is not None:
+        setup['shard_size'] = args.shard_size
+
+    if args.incremental:
+        setup['incremental'] = True
+
     compress_mesa.convert2hdf5(model_list, output_path=args.outputdir, **setup, skip_existing=args.skip, verbose=True)
 
     print("--> {}".format(args.outputdir))
@@ -142,6 +185,12 @@ def _extract(args):
     else:
         print('Found {} files'.format(len(file_list)))
 
+    if args.n_jobs is not None:
+        setup['n_jobs'] = args.n_jobs
+
+    if args.cache is not None:
+        setup['cache'] = args.cache
+
     result = extract_mesa.extract_mesa(file_list, **setup, verbose=True)
 
     result.to_csv(output, index=False, na_rep='NaN')
@@ -176,6 +225,14 @@ def main():
                               help='The setup file containing all settings for compression')
     compress_parser.add_argument('--skip', dest='skip', default=False, action='store_true',
                               help='skip models that have already been transformed to h5.')
+    compress_parser.add_argument('-j, -n_jobs', dest='n_jobs', default=None, type=int,
+                              help='The number of processes to use, -1 uses all available cores.')
+    compress_parser.add_argument('--incremental', dest='incremental', default=False, action='store_true',
+                              help='only compress models that are new or of which the MESA output changed.')
+    compress_parser.add_argument('--grid', dest='grid', default=False, action='store_true',
+                              help='store all models in one grid file instead of one file per model.')
+    compress_parser.add_argument('-shard_size', dest='shard_size', default=None, type=int,
+                              help='The maximum number of models per grid file when using --grid.')
     compress_parser.set_defaults(func=_compress)
 
     # --extract--
@@ -190,6 +247,11 @@ def main():
                                  help='The output filename for the extracted parameters')
     extract_parser.add_argument('-s, -setup', dest='setup', default=None,
                                  help='The setup file containing all settings for extraction')
+    extract_parser.add_argument('-j, -n_jobs', dest='n_jobs', default=None, type=int,
+                                 help='The number of processes to use, -1 uses all available cores.')
+    extract_parser.add_argument('-c, -cache', dest='cache', default=None,
+                                 help='sqlite file used to cache the stability, CE and phase detection of each model '
+                                      'between extractions with the same setup.')
     extract_parser.set_defaults(func=_extract)
 
     args = parser.parse_args()
@@ -1,5 +1,10 @@
+import os
+import time
+import warnings
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 
@@ -14,8 +19,43 @@ from keras.callbacks import EarlyStopping, ReduceLROnPlateau
 from nnaps import fileio, defaults
 from nnaps.reporting import html_reports, pdf_reports
 
+import xgboost
 from xgboost import XGBClassifier, XGBRegressor
 
+
+def get_affine_parameters(processor):
+    """
+    Get the parameters of a scaler that transforms one feature as: (x - offset) / divisor. Supported are the
+    StandardScaler, RobustScaler, MinMaxScaler and MaxAbsScaler of sklearn, and None for a feature without processor.
+
+    :param processor: the fitted processor of one feature
+    :return: offset, divisor, or None if the processor is not an affine scaler
+    :rtype: tuple
+    """
+
+    if processor is None:
+        return 0.0, 1.0
+
+    if processor.__class__ == preprocessing.StandardScaler:
+        offset = processor.mean_[0] if processor.mean_ is not None and processor.with_mean else 0.0
+        divisor = processor.scale_[0] if processor.scale_ is not None else 1.0
+        return offset, divisor
+
+    if processor.__class__ == preprocessing.RobustScaler:
+        offset = processor.center_[0] if processor.center_ is not None else 0.0
+        divisor = processor.scale_[0] if processor.scale_ is not None else 1.0
+        return offset, divisor
+
+    if processor.__class__ == preprocessing.MinMaxScaler and not getattr(processor, 'clip', False):
+        # x * scale_ + min_ = (x + min_ / scale_) / (1 / scale_)
+        return -processor.min_[0] / processor.scale_[0], 1.0 / processor.scale_[0]
+
+    if processor.__class__ == preprocessing.MaxAbsScaler:
+        return 0.0, processor.scale_[0]
+
+    return None
+
+
 class BasePredictor():
 
     def __init__(self):
@@ -23,6 +63,11 @@ class BasePredictor():
         self.processors = None
         self.setup = None
 
+        # the preprocessing plan of the features, see _get_feature_plan
+        self._feature_plan = None
+        # the decoding plan of the targets, see _get_target_plan
+        self._target_plan = None
+
         self.features = []
         self.regressors = []
         self.classifiers = []
@@ -36,21 +81,160 @@ class BasePredictor():
 
     # { Learning and predicting
 
-    def _process_features(self, data):
+    def _get_feature_plan(self):
+        """
+        Private method. Should NOT be called by user.
+
+        The preprocessing plan of the features: the offset and divisor of all features with an affine scaler (or
+        without processor), and the features that need to be transformed by their sklearn processor. The plan is made
+        once and remade when the processors or features change.
+
+        :return: the preprocessing plan
+        :rtype: dict
+        """
+
+        processors = [self.processors[name] for name in self.features]
+        plan = self._feature_plan
+        if plan is not None and plan['features'] == self.features and \
+                all(p is p_ for p, p_ in zip(plan['processors'], processors)):
+            return plan
+
+        offset, divisor, fallback = np.zeros(len(self.features)), np.ones(len(self.features)), []
+        for i, name in enumerate(self.features):
+            parameters = get_affine_parameters(self.processors[name])
+            if parameters is None:
+                fallback.append((i, name))
+            else:
+                offset[i], divisor[i] = parameters
+
+        self._feature_plan = {'features': list(self.features), 'processors': processors, 'offset': offset,
+                              'divisor': divisor, 'fallback': fallback}
+        return self._feature_plan
+
+    def _process_features(self, data, dtype=np.float64):
         """
         Private method. Should NOT be called by user.
 
-        Takes the features from the data frame and runs the required preprocessors on them.
-        Assumes that features are always scaled.
+        Takes the features from the data frame and runs the required preprocessors on them. The features with an
+        affine scaler (StandardScaler, RobustScaler, MinMaxScaler or MaxAbsScaler) or without processor are copied to
+        one matrix and scaled at once, other processors are applied by sklearn one feature at the time.
+
+        :param data: the features (pandas DataFrame)
+        :param dtype: the dtype of the returned features, np.float64 or np.float32
+        :return: the processed features, one column per feature
+        :rtype: 2D array
+        """
+        plan = self._get_feature_plan()
+        fallback = [i for i, name in plan['fallback']]
+
+        # the features are stored in contiguous rows, features handled by sklearn are filled in after the scaling
+        X = np.zeros((len(self.features), len(data)), dtype=dtype)
+        for i, name in enumerate(self.features):
+            if i not in fallback:
+                X[i] = data[name]
+
+        X -= plan['offset'].astype(dtype)[:, np.newaxis]
+        X /= plan['divisor'].astype(dtype)[:, np.newaxis]
+
+        for i, name in plan['fallback']:
+            X[i] = np.asarray(self.processors[name].transform(data[[name]])).reshape(len(data))
+
+        return X.T
+
+    def _get_target_plan(self):
+        """
+        Private method. Should NOT be called by user.
+
+        The decoding plan of the targets: for each target how the raw model output is converted back to the target.
+        Regressors with an affine scaler (or without processor) are scaled back with the same operations as sklearn, and
+        classifiers with a OneHotEncoder or OrdinalEncoder are looked up in their array of categories. Other
+        processors use the inverse_transform of sklearn. The plan is made once and remade when the processors or
+        targets change.
+
+        :return: the decoding plan, a list of (name, method, parameters) tuples
+        :rtype: list
+        """
+
+        names = self.regressors + self.classifiers
+        processors = [self.processors[name] for name in names]
+        plan = self._target_plan
+        if plan is not None and plan['names'] == names and \
+                all(p is p_ for p, p_ in zip(plan['processors'], processors)):
+            return plan['targets']
+
+        targets = []
+        for name, processor in zip(names, processors):
+            if processor.__class__ == preprocessing.OneHotEncoder and processor.drop_idx_ is None:
+                targets.append((name, 'onehot', np.asarray(processor.categories_[0])))
+            elif processor.__class__ == preprocessing.OrdinalEncoder:
+                targets.append((name, 'ordinal', np.asarray(processor.categories_[0])))
+            elif processor.__class__ == preprocessing.MinMaxScaler and not getattr(processor, 'clip', False):
+                targets.append((name, 'minmax', (processor.min_[0], processor.scale_[0])))
+            elif get_affine_parameters(processor) is not None:
+                targets.append((name, 'affine', get_affine_parameters(processor)))
+            else:
+                targets.append((name, 'sklearn', processor))
+
+        self._target_plan = {'names': names, 'processors': processors, 'targets': targets}
+        return targets
+
+    def _decode_targets(self, data, return_probabilities=False):
+        """
+        Private method. Should NOT be called by user.
 
-        FIXME: allow for features to be not scaled.
+        Convert the raw model output back to the targets, see :meth:`_get_target_plan`. The output of a classifier
+        can be the encoded label or a matrix with the probability of each class, in which case the class with the
+        highest probability is selected. Optionally the probabilities are added to the result as '<name>_prob_<class>'
+        columns, in the same pass.
 
-        :param data:
-        :return:
+        :param data: the model output as DataFrame, list of arrays or array (only one target)
+        :param return_probabilities: if True, add the class probabilities of classifiers with a probability output
+        :return: the targets
+        :rtype: pandas DataFrame
         """
-        X = np.array([self.processors[x].transform(data[[x]]) for x in self.features])
-        X = X.reshape(X.shape[:-1]).T
-        return X
+
+        targets = self._get_target_plan()
+
+        if isinstance(data, pd.DataFrame):
+            data = [data[name].values for name, _, _ in targets]
+        elif not isinstance(data, (list, tuple)):
+            data = [data]
+
+        columns = {}
+        for Y_, (name, method, parameters) in zip(data, targets):
+            Y_ = np.asarray(Y_)
+
+            if method == 'affine':
+                # same operations as the inverse_transform of sklearn, the parameters are float64 arrays so that
+                # the operations on float32 outputs are done in float64 as well.
+                Y_ = Y_.reshape(len(Y_), -1)[:, 0].astype(Y_.dtype if Y_.dtype.kind == 'f' else np.float64)
+                offset, divisor = parameters
+                Y_ *= np.array([divisor])
+                Y_ += np.array([offset])
+                columns[name] = Y_
+
+            elif method == 'minmax':
+                Y_ = Y_.reshape(len(Y_), -1)[:, 0].astype(Y_.dtype if Y_.dtype.kind == 'f' else np.float64)
+                min_, scale_ = parameters
+                Y_ -= np.array([min_])
+                Y_ /= np.array([scale_])
+                columns[name] = Y_
+
+            elif method in ['onehot', 'ordinal'] and (method == 'onehot' or (Y_.ndim == 2 and Y_.shape[1] > 1)):
+                # probability of each class: select the most probable one
+                Y_ = Y_.reshape(len(Y_), -1)
+                columns[name] = parameters[np.argmax(Y_, axis=1)]
+                if return_probabilities:
+                    for i, category in enumerate(parameters[:Y_.shape[1]]):
+                        columns['{}_prob_{}'.format(name, category)] = Y_[:, i]
+
+            elif method == 'ordinal':
+                columns[name] = parameters[Y_.reshape(len(Y_), -1)[:, 0].astype('int64')]
+
+            else:
+                columns[name] = parameters.inverse_transform(Y_.reshape(len(Y_), -1))[:, 0]
+
+        return pd.DataFrame(columns, copy=False)
 
     def _process_targets(self, data, inverse=False, return_df=False):
         """
@@ -81,7 +265,9 @@ class BasePredictor():
         # the processors need a 2D array even though they only deal with one feature
         # the dataframe constructor needs 1D arrays
 
-        if return_df:
+        if inverse and return_df:
+            Y = self._decode_targets(data)
+        elif return_df:
             Y = {}
             for Y_, name in zip(data, self.regressors + self.classifiers):
                 if self.processors[name] is not None:
@@ -110,10 +296,77 @@ class BasePredictor():
         raise NotImplementedError("The fit routine must be implemented "
                                   "by subclasses")
 
-    def predict(self, data=None):
+    def predict(self, data=None, return_probabilities=False):
         raise NotImplementedError("The predict routine must be implemented "
                                   "by subclasses")
 
+    def predict_iter(self, data, chunksize=100000, keep_columns=[], key=None, return_probabilities=False):
+        """
+        Make predictions for a large number of systems in chunks of a fixed size, so that only one chunk of the
+        features, raw model output and predictions is in memory at the time. The data can be a DataFrame, an iterable
+        of DataFrames or the path to a csv, hdf5 or parquet file, see :func:`~nnaps.fileio.read_chunks`.
+
+        .. code-block:: python
+
+            for prediction in predictor.predict_iter('sampled_systems.csv', chunksize=100000):
+                ...
+
+        :param data: the features as DataFrame, iterable of DataFrames or path to a csv, hdf5 or parquet file
+        :param chunksize: the number of systems to predict at once
+        :type chunksize: int
+        :param keep_columns: columns of the input data to add to the predictions, for example the features
+        :type keep_columns: list
+        :param key: the key of the table in an hdf5 input file, by default the first table in the file
+        :type key: str
+        :param return_probabilities: if True, also return the class probabilities of the classifiers
+        :type return_probabilities: bool
+        :return: generator yielding the predicted targets of each chunk as pandas DataFrame
+        """
+
+        for chunk in fileio.read_chunks(data, chunksize=chunksize, key=key):
+            res = self.predict(chunk, return_probabilities=return_probabilities)
+            res.index = chunk.index
+
+            if len(keep_columns) > 0:
+                res = pd.concat([chunk[keep_columns], res], axis=1)
+
+            yield res
+
+    def predict_to_file(self, data, filename, chunksize=100000, keep_columns=[], key=None,
+                        return_probabilities=False):
+        """
+        Make predictions for a large number of systems in chunks of a fixed size and write them to a file one chunk
+        at the time, see :meth:`predict_iter`. The output format is based on the extension of the filename: hdf5
+        ('.h5', '.hdf5', '.hdf'), parquet ('.parquet', '.pq') or csv (any other extension), see
+        :func:`~nnaps.fileio.write_chunks`.
+
+        :param data: the features as DataFrame, iterable of DataFrames or path to a csv, hdf5 or parquet file
+        :param filename: the path of the output file
+        :type filename: str
+        :param chunksize: the number of systems to predict at once
+        :type chunksize: int
+        :param keep_columns: columns of the input data to add to the predictions, for example the features
+        :type keep_columns: list
+        :param key: the key of the table in an hdf5 input file, by default the first table in the file
+        :type key: str
+        :param return_probabilities: if True, also write the class probabilities of the classifiers
+        :type return_probabilities: bool
+        :return: the number of predicted systems
+        :rtype: int
+        """
+
+        # string columns in hdf5 files need to be long enough for all classes, not only the ones in the first chunk
+        min_itemsize = {}
+        for name in self.classifiers:
+            processor = self.processors[name]
+            if processor is not None and hasattr(processor, 'categories_') and \
+                    processor.categories_[0].dtype.kind in ['O', 'U', 'S']:
+                min_itemsize[name] = max([len(str(c)) for c in processor.categories_[0]])
+
+        chunks = self.predict_iter(data, chunksize=chunksize, keep_columns=keep_columns, key=key,
+                                   return_probabilities=return_probabilities)
+        return fileio.write_chunks(chunks, filename, key='predictions', min_itemsize=min_itemsize)
+
     def score(self, data=None, regressor_metric='mean_absolute_error', classifier_metric='accuracy'):
         """
         Calculates the score of a model on the provided data.
@@ -268,11 +521,104 @@ class BasePredictor():
 
     #}
 
+def _make_xgb_matrix(model, X, ref=None):
+    """
+    Make the XGBoost matrix that the fit method of the XGB model would make from the features: a QuantileDMatrix for
+    the hist tree method, a DMatrix otherwise. When a reference QuantileDMatrix is given, its quantiles are used.
+
+    :param model: the XGBRegressor or XGBClassifier
+    :param X: the processed features
+    :param ref: the reference matrix to take the quantiles from
+    :return: the XGBoost matrix without labels
+    """
+    params = model.get_params()
+    tree_method = params.get('tree_method', None)
+
+    # the hist tree method is the default since XGBoost 2.0
+    quantile = tree_method in ['hist', 'gpu_hist'] or \
+               (tree_method in [None, 'auto'] and int(xgboost.__version__.split('.')[0]) >= 2)
+
+    kwargs = dict(missing=params.get('missing', np.nan), nthread=params.get('n_jobs', None))
+    if quantile and hasattr(xgboost, 'QuantileDMatrix'):
+        if params.get('max_bin', None) is not None:
+            kwargs['max_bin'] = params['max_bin']
+        return xgboost.QuantileDMatrix(X, ref=ref, **kwargs)
+
+    return xgboost.DMatrix(X, **kwargs)
+
+
+def _can_share_xgb_matrix(model):
+    """
+    Check if an XGB model can be trained by :func:`_fit_xgb_model`. Custom objectives, metrics and callbacks are only
+    supported by the fit method of the model.
+    """
+    params = model.get_params()
+    return not callable(params.get('objective', None)) and not callable(params.get('eval_metric', None)) and \
+           not params.get('callbacks', None)
+
+
+def _fit_xgb_model(model, dtrain, y, dval=None, y_val=None):
+    """
+    Fit an XGBRegressor or XGBClassifier on an XGBoost matrix that is already made. The booster is trained with
+    xgboost.train using the parameters of the model, and then loaded in the model. For a classifier, the classes and
+    the multi-class objective are set from the labels like its fit method does. The labels are set on the matrix.
+    When a validation matrix is given, it is used for early stopping.
+
+    :param model: the XGBRegressor or XGBClassifier to fit
+    :param dtrain: the matrix with the training features
+    :param y: the training labels
+    :param dval: the matrix with the validation features
+    :param y_val: the validation labels
+    :return: the fitted model
+    """
+    dtrain.set_label(y)
+
+    params = model.get_xgb_params()
+    n_estimators = model.get_params().get('n_estimators', None) or 100
+    early_stopping_rounds = model.get_params().get('early_stopping_rounds', None)
+
+    classes = None
+    if isinstance(model, XGBClassifier):
+        classes = np.unique(np.asarray(y))
+        if not np.array_equal(classes, np.arange(len(classes))):
+            raise ValueError("Invalid classes inferred from unique values of `y`.  "
+                             "Expected: {}, got {}".format(np.arange(len(classes)), classes))
+
+        if len(classes) > 2:
+            if params.get('objective', None) != 'multi:softmax':
+                params['objective'] = 'multi:softprob'
+            params['num_class'] = len(classes)
+
+    evals = []
+    if dval is not None:
+        dval.set_label(y_val)
+        evals = [(dval, 'validation_0')]
+
+    evals_result = {}
+    booster = xgboost.train(params, dtrain, n_estimators, evals=evals, early_stopping_rounds=early_stopping_rounds,
+                            evals_result=evals_result, verbose_eval=False)
+
+    # the booster is not saved by the sklearn interface, so it has no sklearn attributes to warn about
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model.load_model(booster.save_raw())
+
+    if classes is not None:
+        model.classes_, model.n_classes_ = classes, len(classes)
+        model.set_params(objective=params['objective'])
+    model.evals_result_ = evals_result
+
+    return model
+
+
 class XGBPredictor(BasePredictor):
 
     def __init__(self, setup=None, setup_file=None, saved_model=None, data=None):
         super().__init__()
 
+        # the time in seconds it took to fit the model of each target
+        self.fit_times = {}
+
         if not setup is None:
             self.make_from_setup(setup, data=data)
 
@@ -301,18 +647,58 @@ class XGBPredictor(BasePredictor):
         Y = self._process_targets(data, return_df=True)
         Y_val = self._process_targets(self.test_data, return_df=True)
 
-        for name in self.regressors + self.classifiers:
-            self.model[name].fit(X, Y[name].values)
-            print ("fitted model for {}".format(name))
+        targets = self.regressors + self.classifiers
+        n_parallel, _ = self._get_thread_budget()
+        early_stopping = any([getattr(self.model[name], 'early_stopping_rounds', None) for name in targets])
+
+        # by default the features are converted to an XGBoost matrix (quantized for the hist tree method) only once
+        # and that matrix is used for all targets. The labels are stored in the matrix, so every thread gets its own
+        # matrix, made with the quantiles of the first one.
+        shared = self.setup.get('xgb_shared_matrix', True) and \
+                 all([_can_share_xgb_matrix(self.model[name]) for name in targets])
+        if shared:
+            model = self.model[targets[0]]
+            dtrain = _make_xgb_matrix(model, X)
+
+        def fit_group(i):
+            if shared:
+                dtrain_ = dtrain if i == 0 else _make_xgb_matrix(model, X, ref=dtrain)
+                dval_ = _make_xgb_matrix(model, X_val, ref=dtrain) if early_stopping else None
+
+            fit_times = []
+            for name in targets[i::n_parallel]:
+                start = time.time()
+                if shared:
+                    _fit_xgb_model(self.model[name], dtrain_, Y[name].values, dval_, Y_val[name].values)
+                elif early_stopping:
+                    self.model[name].fit(X, Y[name].values, eval_set=[(X_val, Y_val[name].values)], verbose=False)
+                else:
+                    self.model[name].fit(X, Y[name].values)
+                fit_times.append((name, time.time() - start))
+            return fit_times
+
+        # XGBoost releases the GIL while training, so the models of different targets can be trained in threads
+        if n_parallel > 1:
+            with ThreadPoolExecutor(max_workers=n_parallel) as pool:
+                fit_times = dict(sum(pool.map(fit_group, range(n_parallel)), []))
+        else:
+            fit_times = dict(fit_group(0))
+        fit_times = [(name, fit_times[name]) for name in targets]
 
+        self.fit_times = {}
+        for name, fit_time in fit_times:
+            self.fit_times[name] = fit_time
+            print("fitted model for {} in {:.2f} s".format(name, fit_time))
 
         self.print_score(training_data=data)
 
-    def predict(self, data=None):
+    def predict(self, data=None, return_probabilities=False):
         """
         Make predictions based on a trained model.
 
         :param data: the features that you want to use in the prediction. (pandas DataFrame)
+        :param return_probabilities: if True, also return the probability of each class of the classifiers as
+                                     '<name>_prob_<class>' columns.
         :return: predicted targets for features
         """
 
@@ -321,12 +707,17 @@ class XGBPredictor(BasePredictor):
 
         X = self._process_features(data)
 
-        Y = {}
-        for name in self.regressors+self.classifiers:
-            Y[name] = self.model[name].predict(X)
-        Y = pd.DataFrame(Y)
+        Y = []
+        for name in self.regressors:
+            Y.append(self.model[name].predict(X))
+        for name in self.classifiers:
+            if return_probabilities:
+                # the predicted class is the most probable one, no need to predict it separately
+                Y.append(self.model[name].predict_proba(X))
+            else:
+                Y.append(self.model[name].predict(X))
 
-        res = self._process_targets(Y, inverse=True, return_df=True)
+        res = self._decode_targets(Y, return_probabilities=return_probabilities)
 
         return res
 
@@ -335,23 +726,53 @@ class XGBPredictor(BasePredictor):
 
     # { Input and output
 
+    def _get_thread_budget(self):
+        """
+        Private method. Should NOT be called by user.
+
+        Split the total number of cores given by 'n_jobs' in the setup (default all cores) over the targets: the
+        number of targets that are trained at the same time ('n_parallel_targets' in the setup, by default as many as
+        possible) and the number of threads each XGB model uses.
+
+        :return: the number of targets trained at once, the number of threads per model
+        :rtype: int, int
+        """
+        setup = self.setup if self.setup is not None else {}
+        n_targets = max(1, len(self.regressors + self.classifiers))
+
+        n_jobs = setup.get('n_jobs', None)
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+
+        n_parallel = setup.get('n_parallel_targets', None)
+        if n_parallel is None or n_parallel < 1:
+            n_parallel = n_jobs
+        n_parallel = min(n_parallel, n_targets, n_jobs)
+
+        return n_parallel, max(1, n_jobs // n_parallel)
+
     def _make_model_from_setup(self):
         """
-        Prepare the regressor and classifier models and store them in the model variable.
+        Prepare the regressor and classifier models and store them in the model variable. The 'xgb_kwargs' of the
+        setup are passed to all models, for example {'tree_method': 'hist'}.
         """
 
+        kwargs = dict(self.setup.get('xgb_kwargs', None) or {})
+        if 'n_jobs' not in kwargs:
+            kwargs['n_jobs'] = self._get_thread_budget()[1]
+
         models = {}
         for name in self.regressors:
-            models[name] = XGBRegressor()
+            models[name] = XGBRegressor(**kwargs)
 
         for name in self.classifiers:
-            models[name] = XGBClassifier()
+            models[name] = XGBClassifier(**kwargs)
 
         self.model = models
 
     def make_from_setup(self, setup, data=None):
 
-        self.setup = defaults.add_defaults_to_setup(setup)
+        self.setup = defaults.add_xgb_defaults_to_setup(setup)
 
         self.features = list(self.setup['features'].keys())
         self.regressors = list(self.setup['regressors'].keys())
@@ -506,11 +927,13 @@ class FCPredictor(BasePredictor):
 
         self.print_score(training_data=data)
 
-    def predict(self, data=None):
+    def predict(self, data=None, return_probabilities=False):
         """
         Make predictions based on a trained model.
 
         :param data: the features that you want to use in the prediction. (pandas DataFrame)
+        :param return_probabilities: if True, also return the probability of each class of the classifiers as
+                                     '<name>_prob_<class>' columns.
         :return: predicted targets for features
         """
 
@@ -521,7 +944,7 @@ class FCPredictor(BasePredictor):
 
         Y = self.model.predict(X)
 
-        res = self._process_targets(Y, inverse=True, return_df=True)
+        res = self._decode_targets(Y, return_probabilities=return_probabilities)
 
         return res
 
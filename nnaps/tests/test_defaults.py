@@ -203,4 +203,22 @@ class TestAddingDefaults:
         assert 'train_test_split' in setup_new
 
         assert 'optimizer' in setup_new
-        assert 'optimizer_kwargs' in setup_new
\ No newline at end of file
+        assert 'optimizer_kwargs' in setup_new
+        # the XGB options are only added to the setup of the XGBPredictor
+        assert 'xgb_kwargs' not in setup_new
+        assert 'n_parallel_targets' not in setup_new
+
+    def test_add_xgb_defaults_to_setup(self):
+
+        setup = {'features': ['M1', 'qinit', 'Pinit', 'FeHinit'],
+                 'regressors': ['Pfinal', 'qfinal'],
+                 'classifiers': ['product', 'binary_type'],
+                 'n_jobs': 4}
+
+        setup_new = defaults.add_xgb_defaults_to_setup(setup)
+
+        assert setup_new['features']['M1']['processor'] == defaults.default_scaler
+        assert setup_new['xgb_kwargs'] == {}
+        assert setup_new['n_jobs'] == 4
+        assert setup_new['n_parallel_targets'] is None
+        assert setup_new['xgb_shared_matrix'] is True
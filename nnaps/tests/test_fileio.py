@@ -381,3 +381,71 @@ class TestSaveLoadModel:
         np.testing.assert_array_equal(history.values, history_new.values)
 
         assert history_new.index.name == 'epoch'
+
+
+class TestChunks:
+
+    def test_read_chunks(self, tmp_path):
+
+        data = pd.DataFrame({'a': np.arange(1050), 'b': np.random.normal(size=1050)})
+
+        chunks = list(fileio.read_chunks(data, chunksize=100))
+        assert [len(c) for c in chunks] == [100] * 10 + [50]
+        pd.testing.assert_frame_equal(pd.concat(chunks), data)
+
+        stream = (data.iloc[i:i + 70] for i in range(0, len(data), 70))
+        chunks = list(fileio.read_chunks(stream, chunksize=100))
+        assert [len(c) for c in chunks] == [100] * 10 + [50]
+        pd.testing.assert_frame_equal(pd.concat(chunks), data)
+
+        data.to_csv(tmp_path / 'data.csv', index=False)
+        data.to_hdf(tmp_path / 'data_table.h5', 'data', format='table')
+        data.to_hdf(tmp_path / 'data_fixed.h5', 'data')
+        for filename in ['data.csv', 'data_table.h5', 'data_fixed.h5']:
+            chunks = list(fileio.read_chunks(str(tmp_path / filename), chunksize=100))
+            assert [len(c) for c in chunks] == [100] * 10 + [50]
+            pd.testing.assert_frame_equal(pd.concat(chunks).reset_index(drop=True), data)
+
+        with pytest.raises(ValueError):
+            list(fileio.read_chunks(data, chunksize=0))
+
+    def test_write_chunks(self, tmp_path):
+
+        data = pd.DataFrame({'a': np.arange(1050), 'b': np.random.normal(size=1050),
+                             'c': np.where(np.arange(1050) < 500, 'short', 'much longer')})
+
+        for filename in ['data.csv', 'data.h5']:
+            n = fileio.write_chunks(fileio.read_chunks(data, chunksize=100), str(tmp_path / filename),
+                                    key='data', min_itemsize={'c': 20})
+            assert n == len(data)
+
+            if filename.endswith('.csv'):
+                data_ = pd.read_csv(tmp_path / filename)
+            else:
+                data_ = pd.read_hdf(tmp_path / filename, 'data')
+            pd.testing.assert_frame_equal(data_, data)
+
+            # without chunks the output of an earlier run is still overwritten
+            assert fileio.write_chunks([], str(tmp_path / filename)) == 0
+            if filename.endswith('.csv'):
+                assert os.path.getsize(tmp_path / filename) == 0
+            else:
+                with pd.HDFStore(str(tmp_path / filename), mode='r') as store:
+                    assert store.keys() == []
+
+    def test_chunks_parquet(self, tmp_path):
+        pytest.importorskip('pyarrow')
+
+        data = pd.DataFrame({'a': np.arange(1050), 'b': np.random.normal(size=1050),
+                             'c': np.where(np.arange(1050) < 500, 'short', 'much longer')})
+
+        n = fileio.write_chunks(fileio.read_chunks(data, chunksize=100), str(tmp_path / 'data.parquet'))
+        assert n == len(data)
+
+        chunks = list(fileio.read_chunks(str(tmp_path / 'data.parquet'), chunksize=300))
+        assert [len(c) for c in chunks] == [300] * 3 + [150]
+        pd.testing.assert_frame_equal(pd.concat(chunks).reset_index(drop=True), data)
+
+        # without chunks an empty file replaces the earlier output
+        assert fileio.write_chunks([], str(tmp_path / 'data.parquet')) == 0
+        assert list(fileio.read_chunks(str(tmp_path / 'data.parquet'))) == []
@@ -1,14 +1,37 @@
 import os
+import json
 
 import pytest
+import numpy as np
 import pandas as pd
+import h5py
 
-from nnaps.mesa import compress_mesa, fileio
+from nnaps.mesa import compress_mesa, fileio, main
 
 from pathlib import Path
 base_path = Path(__file__).parent
 
 
+def write_mesa_output(filename, columns, n_rows=20):
+    """ write a small MESA like output file with a global header and a data block """
+    with open(filename, 'w') as ff:
+        ff.write('   1   2\n   model_number   initial_mass\n   {}   1.2\n\n'.format(n_rows))
+        ff.write(''.join(['   {}'.format(i + 1) for i in range(len(columns))]) + '\n')
+        ff.write(''.join(['   {}'.format(c) for c in columns]) + '\n')
+        for i in range(1, n_rows + 1):
+            ff.write(''.join(['   {:.6E}'.format(i * (j + 1)) for j in range(len(columns))]) + '\n')
+
+
+def make_mesa_model(path):
+    """ create a minimal MESA model directory """
+    os.makedirs(path / 'LOGS')
+    write_mesa_output(path / 'LOGS/history1.data', ['model_number', 'star_age', 'log_Teff'])
+    write_mesa_output(path / 'LOGS/history2.data', ['model_number', 'star_age', 'log_Teff'])
+    write_mesa_output(path / 'LOGS/binary_history.data', ['model_number', 'age', 'period_days'])
+    with open(path / 'log.txt', 'w') as ff:
+        ff.write('some output\n termination code: max_age\n\n')
+
+
 class Test2H5:
 
     def test_read_mesa_output(self):
@@ -23,6 +46,83 @@ class Test2H5:
         assert len(data.dtype.names) == 53
         assert data.shape[0] == 10263
 
+    def test_read_mesa_output_engines(self, tmp_path):
+
+        filename = tmp_path / 'history.data'
+        with open(filename, 'w') as ff:
+            ff.write('   1   2\n   version_number   initial_mass\n   10398   1.2\n\n')
+            ff.write('   1   2   3\n   model_number   star_age   log_L\n')
+            for i in range(1, 21):
+                if i == 7:
+                    # ragged line that should be removed
+                    ff.write('   {}   {:.6E}\n'.format(i, i * 1e6))
+                elif i == 12:
+                    # two lines glued together by a restart
+                    ff.write('   {}   {:.6E}   1.5   13   1.3E+07   1.6   0.4\n'.format(i, i * 1e6))
+                else:
+                    ff.write('   {}   {:.6E}   {:.6E}\n'.format(i, i * 1e6, 1.0 + i / 10.))
+
+        header_py, data_py = compress_mesa.read_mesa_output(filename=filename, engine='python')
+        header, data = compress_mesa.read_mesa_output(filename=filename, engine='fast')
+
+        assert header['initial_mass'][0] == 1.2
+        assert data.dtype.names == ('model_number', 'star_age', 'log_L')
+        assert data.shape[0] == 18
+        assert 7 not in data['model_number']
+        assert 12 not in data['model_number']
+        for name in data_py.dtype.names:
+            np.testing.assert_array_equal(data[name], data_py[name])
+
+        models = compress_mesa.read_mesa_output(filename=filename, only_first=True)
+        assert len(models) == 1
+
+        with pytest.raises(ValueError):
+            compress_mesa.read_mesa_output(filename=filename, engine='uk_engine')
+
+        # only read a selection of the columns
+        for engine in ['fast', 'python']:
+            _, data_sel = compress_mesa.read_mesa_output(filename=filename, columns=['log_L', 'model_number'],
+                                                         engine=engine)
+            assert data_sel.dtype.names == ('log_L', 'model_number')
+            np.testing.assert_array_equal(data_sel['model_number'], data['model_number'])
+            np.testing.assert_array_equal(data_sel['log_L'], data['log_L'])
+
+        with pytest.raises(ValueError):
+            compress_mesa.read_mesa_output(filename=filename, columns=['uk_column'])
+
+        # a line that is too long is also removed when only some columns are read and no line is too short
+        with open(filename, 'w') as ff:
+            ff.write('   1   2\n   version_number   initial_mass\n   10398   1.2\n\n')
+            ff.write('   1   2   3\n   model_number   star_age   log_L\n')
+            for i in range(1, 6):
+                if i == 3:
+                    ff.write('   3   3.0   3.7   4   4.0   3.8   0.4\n')
+                else:
+                    ff.write('   {}   {:.1f}   3.{}\n'.format(i, i, i))
+
+        for engine in ['fast', 'python']:
+            _, data_sel = compress_mesa.read_mesa_output(filename=filename, columns=['model_number', 'log_L'],
+                                                         engine=engine)
+            np.testing.assert_array_equal(data_sel['model_number'], [1, 2, 4, 5])
+
+    def test_get_end_log_file(self, tmp_path):
+
+        lines = ['model {} output\n'.format(i) for i in range(1000)]
+        lines[980] = ' termination code: max_model_number\n'
+        with open(tmp_path / 'log.txt', 'w') as ff:
+            ff.write(''.join(lines))
+
+        for block_size in [10, 100, 8192]:
+            assert compress_mesa.get_end_log_file(tmp_path / 'log.txt', block_size=block_size) == lines[-30:-1]
+
+        assert compress_mesa.get_termination_code(tmp_path / 'log.txt') == 'max_model_number'
+        assert compress_mesa.get_termination_code(tmp_path / 'log.txt', n_lines=10) == 'uk'
+        assert compress_mesa.get_termination_code(tmp_path / 'does_not_exist.txt') == 'uk'
+
+        with open(tmp_path / 'log.txt', 'w') as ff:
+            ff.write('one line\n termination code: max_age\n\n')
+        assert compress_mesa.get_end_log_file(tmp_path / 'log.txt') == ['one line\n', ' termination code: max_age\n']
+
     def test_convert2hdf5(self):
 
         data = [[1.013, 0.331, 32.85, 0.12, -0.8, 0.00155, 749, 986, 0, 2000, 'M1.013_M0.331_P32.85_Z0.00155']]
@@ -59,6 +159,209 @@ class Test2H5:
             os.remove(base_path / 'test_data/hdf5/M1.013_M0.331_P32.85_Z0.00155.h5')
             os.rmdir(base_path / 'test_data/hdf5/')
 
+    def test_convert2hdf5_parallel(self, tmp_path):
+
+        make_mesa_model(tmp_path / 'models' / 'model_1')
+        make_mesa_model(tmp_path / 'models' / 'model_2')
+        # a model without history files
+        os.makedirs(tmp_path / 'models' / 'model_3')
+
+        modellist = pd.DataFrame(data={'path': ['model_1', 'model_2', 'model_3']})
+
+        summary = compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                             output_path=tmp_path / 'hdf5', skip_existing=False, n_jobs=2)
+
+        assert list(summary['path']) == ['model_1', 'model_2', 'model_3']
+        assert list(summary['status']) == ['compressed', 'compressed', 'failed']
+        assert 'star1' in summary['message'][2]
+        assert summary['compression_ratio'][0] > 0
+        assert np.isnan(summary['compression_ratio'][2])
+
+        data = fileio.read_hdf5(tmp_path / 'hdf5' / 'model_2.h5')
+        assert data['extra_info']['termination_code'] == b'max_age'
+        assert len(data['history']['binary']) == 20
+        # the source files are only recorded for incremental compression
+        assert 'source_files' not in data['extra_info']
+
+        summary = compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                             output_path=tmp_path / 'hdf5', skip_existing=True, n_jobs=1)
+        assert list(summary['status']) == ['skipped', 'skipped', 'failed']
+
+    def test_convert2hdf5_history_columns(self, tmp_path):
+
+        make_mesa_model(tmp_path / 'models' / 'model_1')
+        assert compress_mesa.read_column_names(tmp_path / 'models/model_1/LOGS/history1.data') == \
+               ['model_number', 'star_age', 'log_Teff']
+
+        modellist = pd.DataFrame(data={'path': ['model_1']})
+        compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models', output_path=tmp_path / 'hdf5',
+                                   skip_existing=False, history_columns=['effective_T_2'])
+
+        data = fileio.read_hdf5(tmp_path / 'hdf5' / 'model_1.h5')
+        assert data['history']['star1'].dtype.names == ('model_number',)
+        assert data['history']['star2'].dtype.names == ('model_number', 'log_Teff')
+        assert data['history']['binary'].dtype.names == ('model_number', 'age')
+
+
+    def test_convert2hdf5_lzf(self, tmp_path):
+
+        make_mesa_model(tmp_path / 'models' / 'model_1')
+        modellist = pd.DataFrame(data={'path': ['model_1']})
+
+        # the gzip compression level is not passed on to the lzf filter
+        summary = compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                             output_path=tmp_path / 'hdf5', skip_existing=False, compression='lzf')
+        assert list(summary['status']) == ['compressed']
+
+        with h5py.File(tmp_path / 'hdf5' / 'model_1.h5', 'r') as hdf:
+            assert hdf['history/star1'].compression == 'lzf'
+
+        data = fileio.read_hdf5(tmp_path / 'hdf5' / 'model_1.h5')
+        assert len(data['history']['binary']) == 20
+
+    def test_convert2hdf5_incremental(self, tmp_path):
+
+        make_mesa_model(tmp_path / 'models' / 'model_1')
+        make_mesa_model(tmp_path / 'models' / 'model_2')
+        modellist = pd.DataFrame(data={'path': ['model_1', 'model_2']})
+
+        def compress():
+            summary = compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                                 output_path=tmp_path / 'hdf5', incremental=True)
+            return list(summary['status'])
+
+        assert compress() == ['compressed', 'compressed']
+        assert compress() == ['skipped', 'skipped']
+
+        data = fileio.read_hdf5(tmp_path / 'hdf5' / 'model_1.h5')
+        assert 'LOGS/history1.data' in data['extra_info']['source_files'].decode()
+
+        # only touching a file doesn't change the content, the new modification time is stored
+        os.utime(tmp_path / 'models/model_1/LOGS/history1.data', (0, 0))
+        assert compress() == ['skipped', 'skipped']
+        sources = json.loads(fileio.read_hdf5(tmp_path / 'hdf5' / 'model_1.h5')['extra_info']['source_files'])
+        assert sources['LOGS/history1.data'][1] == 0
+
+        write_mesa_output(tmp_path / 'models/model_2/LOGS/history1.data', ['model_number', 'star_age', 'log_Teff'],
+                          n_rows=25)
+        assert compress() == ['skipped', 'compressed']
+        assert len(fileio.read_hdf5(tmp_path / 'hdf5' / 'model_2.h5')['history']['star1']) == 25
+
+        with pytest.raises(ValueError):
+            compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                       output_path=tmp_path / 'grid', incremental=True, grid=True)
+
+    def test_convert2hdf5_grid(self, tmp_path):
+
+        for name in ['model_1', 'model_2', 'model_3']:
+            make_mesa_model(tmp_path / 'models' / name)
+        os.makedirs(tmp_path / 'models' / 'model_4')
+
+        modellist = pd.DataFrame(data={'path': ['model_1', 'model_2', 'model_4']})
+
+        compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models', output_path=tmp_path / 'hdf5',
+                                   skip_existing=False, n_jobs=1)
+        summary = compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                             output_path=tmp_path / 'grid', skip_existing=False, grid=True,
+                                             shard_size=2, n_jobs=2)
+        assert list(summary['status']) == ['compressed', 'compressed', 'failed']
+
+        index = fileio.read_grid_index(tmp_path / 'grid' / 'grid_0000.h5')
+        assert list(index['path']) == ['model_1', 'model_2']
+        assert index['extra_info'][1]['termination_code'] == 'max_age'
+
+        data, extra_info = fileio.read_grid_track(tmp_path / 'grid' / 'grid_0000.h5', 'model_2')
+        data_, extra_info_ = fileio.read_compressed_track(tmp_path / 'hdf5' / 'model_2.h5')
+        np.testing.assert_array_equal(data, data_)
+
+        # new models are appended to the grid, starting a new shard when the last one is full
+        modellist = pd.DataFrame(data={'path': ['model_1', 'model_3']})
+        summary = compress_mesa.convert2hdf5(modellist, input_path_prefix=tmp_path / 'models',
+                                             output_path=tmp_path / 'grid', skip_existing=True, grid=True,
+                                             shard_size=2)
+        assert list(summary['status']) == ['skipped', 'compressed']
+        assert list(fileio.read_grid_index(tmp_path / 'grid' / 'grid_0001.h5')['path']) == ['model_3']
+
+        file_list = main.get_file_list([tmp_path / 'grid'])
+        assert list(file_list['path']) == ['model_1', 'model_2', 'model_3']
+        assert file_list['grid_file'][2] == str(tmp_path / 'grid' / 'grid_0001.h5')
+
+        with pytest.raises(IOError):
+            fileio.read_grid_track(tmp_path / 'grid' / 'grid_0000.h5', 'model_3')
+
+    def test_write2hdf5_compression(self, tmp_path):
+
+        history = np.zeros(1000, dtype=[('model_number', 'i4'), ('star_1_mass', 'f8')])
+        history['model_number'] = np.arange(1000)
+        history['star_1_mass'] = 1.0
+        data = {'history': {'star1': history}, 'extra_info': {'termination_code': 'max_age', 'M1': 1.2}}
+
+        fileio.write2hdf5(data, tmp_path / 'raw.h5')
+        for options in [dict(compression='gzip', compression_opts=4, shuffle=True),
+                        dict(compression='lzf', chunks=100)]:
+            fileio.write2hdf5(data, tmp_path / 'compressed.h5', **options)
+            assert os.path.getsize(tmp_path / 'compressed.h5') < os.path.getsize(tmp_path / 'raw.h5')
+
+            result = fileio.read_hdf5(tmp_path / 'compressed.h5')
+            np.testing.assert_array_equal(result['history']['star1'], history)
+            assert result['extra_info']['termination_code'] == b'max_age'
+            assert result['extra_info']['M1'] == 1.2
+
+
+class TestReadCompressedTrack:
+
+    def test_align_history(self):
+
+        history = np.zeros(5, dtype=[('model_number', 'f8'), ('mass', 'f8')])
+        history['model_number'] = [1, 2, 4, 5, 7]
+        history['mass'] = [1.0, 0.9, 0.7, 0.6, 0.4]
+
+        model_numbers = np.array([1., 2., 3., 5., 7., 8.])
+
+        for alignment in ['auto', 'interpolate']:
+            result = fileio._align_history(history, model_numbers, alignment=alignment)
+            assert result.shape == (6, 2)
+            np.testing.assert_array_equal(result[:, 0], [1., 2., 3., 5., 7., 0.])
+            np.testing.assert_allclose(result[:, 1], [1.0, 0.9, 0.8, 0.6, 0.4, 0.0])
+
+        # with the exact alignment the values at matching model numbers are copied, not interpolated
+        result = fileio._align_history(history, model_numbers, alignment='auto')
+        assert result[3, 1] == history['mass'][3]
+
+        with pytest.raises(ValueError):
+            fileio._align_history(history, model_numbers, alignment='uk_alignment')
+
+    def test_read_compressed_track_columns(self):
+
+        filename = base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5'
+        data, extra_info = fileio.read_compressed_track(filename)
+
+        columns = ['star_1_mass', 'log_Teff_2', 'effective_T', 'log10_J_div_Jdot_div_P']
+        data_, extra_info_ = fileio.read_compressed_track(filename, columns=columns)
+
+        assert extra_info_['termination_code'] == extra_info['termination_code']
+        for name in columns + ['model_number', 'age', 'log_Teff']:
+            assert name in data_.dtype.names
+            np.testing.assert_array_equal(data_[name], data[name])
+
+        # columns that are not requested are not read
+        for name in ['log_g', 'log_g_2', 'period_days_2', 'mass_ratio']:
+            assert name not in data_.dtype.names
+
+    def test_read_profiles(self, tmp_path):
+
+        profile = np.zeros(5, dtype=[('mass', 'f8'), ('logR', 'f8')])
+        legend = np.array([(150, b'profile_1'), (329, b'profile_2')],
+                          dtype=[('model_number', 'i4'), ('profile_name', 'S9')])
+        data = {'history': {}, 'profile_legend': legend, 'profiles': {'profile_1': profile, 'profile_2': profile}}
+        fileio.write2hdf5(data, tmp_path / 'model.h5')
 
+        profiles = fileio.read_profiles(tmp_path / 'model.h5')
+        assert set(profiles.keys()) == {'profile_1', 'profile_2', 'legend'}
+        np.testing.assert_array_equal(profiles['legend'], legend)
 
+        profiles = fileio.read_profiles(tmp_path / 'model.h5', profile_names=['profile_2'])
+        assert set(profiles.keys()) == {'profile_2', 'legend'}
 
+        fileio.write2hdf5({'history': {}}, tmp_path / 'model.h5')
+        assert fileio.read_profiles(tmp_path / 'model.h5') is None
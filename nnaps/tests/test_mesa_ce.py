@@ -86,6 +86,23 @@ def test_apply_ce():
         data = common_envelope.apply_ce(data, ce_formalism='uk_formalism')
 
 
+def test_ce_final_states():
+    data, _ = fileio.read_compressed_track(base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5')
+
+    stable, ce_age = common_envelope.is_stable(data, criterion='Mdot', value=-5)
+    data = data[data['age'] <= ce_age]
+
+    al, lb = np.array([[0.5], [1.0], [2.0]]), np.array([0.5, 1.0])
+    af, M1_final = common_envelope.ce_final_states(data, ce_formalism='webbink1984', al=al, lb=lb)
+
+    assert af.shape == (3, 2)
+    assert M1_final.shape == (3, 2)
+    for i, j in [(0, 0), (1, 1), (2, 0)]:
+        af_ij, M1_ij = common_envelope.ce_final_state(data, ce_formalism='webbink1984', al=al[i, 0], lb=lb[j])
+        assert af[i, j] == pytest.approx(af_ij)
+        assert M1_final[i, j] == pytest.approx(M1_ij)
+
+
 def test_dewi_tauris2000(data):
     data, _, profiles = fileio.read_compressed_track(base_path / 'test_data/M1.080_M0.502_P192.67_Z0.01129.h5'
                                                   , return_profiles=True)
@@ -105,6 +122,33 @@ def test_dewi_tauris2000(data):
     assert af == pytest.approx(9.17843738836, abs=0.00001)
     assert M1_final == pytest.approx(0.39115816046997015, abs=0.00001)
 
+def test_dewi_tauris2000_array():
+    data, _ = fileio.read_compressed_track(base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5')
+
+    stable, ce_age = common_envelope.is_stable(data, criterion='Mdot', value=-5)
+    data = data[data['age'] <= ce_age]
+
+    # synthetic giant profile with a deep spiral-in, from the surface to the center
+    x = np.linspace(0, 1, 3000)
+    profile = np.zeros(len(x), dtype=[('mass', 'f8'), ('logR', 'f8'), ('logP', 'f8'), ('logRho', 'f8')])
+    profile['mass'] = 1.2 * (1 - x**4) + 1e-6
+    profile['logR'] = np.log10(data['binary_separation'][-1] * (1 - x)**0.5 + 1e-3)
+    profile['logRho'] = -8 + 12 * x
+    profile['logP'] = 2 + 17 * x
+
+    for a_th in [0, 0.5, 1.0]:
+        for merge in [True, False]:
+            af_loop, M1_loop = common_envelope.dewi_tauris2000(data, profile, a_th=a_th, method='loop',
+                                                               merge_when_core_reached=merge)
+            af, M1_final = common_envelope.dewi_tauris2000(data, profile, a_th=a_th, merge_when_core_reached=merge)
+
+            assert af == pytest.approx(af_loop, rel=1e-10)
+            assert M1_final == M1_loop
+
+    with pytest.raises(ValueError):
+        common_envelope.dewi_tauris2000(data, profile, method='uk_method')
+
+
 # def test_all(data):
 #
 #     def period(af):
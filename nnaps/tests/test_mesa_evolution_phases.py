@@ -311,3 +311,88 @@ class TestEvolutionPhases:
         assert type(phases['ML'][0][0]) == np.ndarray
         assert type(phases['ML'][1]) == tuple
         assert type(phases['ML'][1][0]) == np.ndarray
+
+    def test_phase_context(self, base_path, monkeypatch):
+        phase_names = list(evolution_phases.all_phases.keys())
+
+        data, _ = fileio.read_compressed_track(base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5')
+
+        # the phases derived from a shared context are the same as when detected independently
+        phases = evolution_phases.get_all_phases(phase_names, data)
+        for name in phase_names:
+            selection = evolution_phases.all_phases[name](data)
+            if selection is None:
+                assert phases[name] is None
+            else:
+                np.testing.assert_array_equal(phases[name][0], selection[0])
+
+        # the He ignition temperature is only calculated once for all phases
+        n_calls = []
+        he_ignition = evolution_phases.HeIgF
+
+        def counting_HeIgF(rho):
+            n_calls.append(1)
+            return he_ignition(rho)
+
+        monkeypatch.setattr(evolution_phases, 'HeIgF', counting_HeIgF)
+        context = evolution_phases.PhaseContext(data)
+        evolution_phases.get_all_phases(phase_names, data, context=context)
+        evolution_phases.HeCoreBurning(data, return_age=True, context=context)
+        assert len(n_calls) == 1
+
+        # a context of a different history is not used
+        evolution_phases.HeCoreBurning(data[:100], context=context)
+        assert len(n_calls) == 2
+
+    def test_get_all_phases_slices(self, base_path):
+        phase_names = list(evolution_phases.all_phases.keys()) + ['lg_mstar_dot_1_max']
+
+        data, _ = fileio.read_compressed_track(base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5')
+        index = np.arange(len(data))
+
+        phases = evolution_phases.get_all_phases(phase_names, data)
+        phases_slices = evolution_phases.get_all_phases(phase_names, data, use_slices=True)
+
+        assert type(phases_slices['MS']) == slice
+        assert type(phases_slices['HeCoreBurning']) == slice
+        assert type(phases_slices['final']) == slice
+        assert type(phases_slices['lg_mstar_dot_1_max']) == tuple
+
+        # the slices select the same points as the np.where selections
+        for name in phase_names:
+            if phases[name] is None:
+                assert phases_slices[name] is None
+            elif type(phases[name]) == list:
+                for s1, s2 in zip(phases[name], phases_slices[name]):
+                    np.testing.assert_array_equal(index[s1], index[s2])
+            else:
+                np.testing.assert_array_equal(index[phases[name]], index[phases_slices[name]])
+
+        # indexing with a slice returns a view of the history
+        assert np.shares_memory(data[phases_slices['MS']], data)
+
+        # if the age is not monotonic, the np.where selections are used
+        data['age'][10] = data['age'][-1]
+        phases_slices = evolution_phases.get_all_phases(['MS'], data, use_slices=True)
+        assert type(phases_slices['MS']) == tuple
+
+    def test_find_ml_intervals(self):
+
+        mass_loss = np.array([-12, -5, -5, -12, -12, np.nan, -5, np.nan, -5, -12, np.nan, -12, -8])
+        starts, ends = evolution_phases.find_ml_intervals(mass_loss)
+
+        # nan values don't start or end a phase, the last phase continues until the end
+        np.testing.assert_array_equal(starts, [1, 6, 12])
+        np.testing.assert_array_equal(ends, [3, 9, 12])
+
+        starts, ends = evolution_phases.find_ml_intervals(np.array([-12., -11, np.nan]))
+        assert len(starts) == 0 and len(ends) == 0
+
+        # ML uses the same intervals
+        data = np.zeros(len(mass_loss), dtype=[('age', float), ('lg_mstar_dot_1', float), ('lg_wind_mdot_1', float)])
+        data['age'] = np.arange(len(mass_loss)) + 1
+        data['lg_mstar_dot_1'] = mass_loss
+        data['lg_wind_mdot_1'] = -np.inf
+
+        ages = evolution_phases.ML(data, return_age=True, return_multiple=True)
+        assert ages == [(2, 4), (7, 10), (13, 13)]
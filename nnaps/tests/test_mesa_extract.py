@@ -1,10 +1,13 @@
 import os
 import copy
+import shutil
+import itertools
 import pytest
 import pandas as pd
 import numpy as np
+import h5py
 
-from nnaps.mesa import extract_mesa, fileio
+from nnaps.mesa import extract_mesa, fileio, extract_cache, common_envelope, evolution_phases
 
 
 class TestProcessFileList:
@@ -96,6 +99,56 @@ class TestExtractAux:
         assert 'ML3start_HeCoreMass' in df_new.columns.values
 
 
+    def test_get_required_columns(self):
+
+        parameters = [('star_1_mass__init', 'M1_init'), 'rl_1__HeIgnition__max', 'log_g_2__sdB',
+                      'star_1_mass__lg_mstar_dot_1_max']
+        history_columns, profile_columns = extract_mesa.get_required_columns(parameters=parameters,
+                                                                             phase_flags=['effective_T_max'],
+                                                                             stability_criterion='J_div_Jdot_div_P',
+                                                                             ce_formalism='dewi_tauris2000')
+
+        for column in ['star_1_mass', 'rl_1', 'log_g_2', 'lg_mstar_dot_1', 'log_dt', 'age', 'model_number',
+                       'log_center_T', 'log_center_Rho', 'log_LHe', 'c_core_mass', 'log_Teff',
+                       'effective_T', 'J_orb', 'Jdot', 'period_days', 'he_core_mass', 'star_2_mass']:
+            assert column in history_columns
+
+        assert 'center_h1' not in history_columns
+        assert profile_columns == ['mass', 'logR', 'logP', 'logRho']
+
+        # extra setup parameters are ignored
+        history_columns, profile_columns = extract_mesa.get_required_columns(parameters=['star_1_mass__init'],
+                                                                             stability_limit=10, n_ml_phases=1)
+        assert 'star_1_mass' in history_columns
+        assert profile_columns == []
+
+    def test_plan_parameters(self):
+
+        parameters = ['star_1_mass__init', 'rl_1__ML__max', 'star_1_mass__ML__min', 'age__ML__diff', 'rl_1__max']
+        plan = extract_mesa.plan_parameters(parameters)
+
+        assert list(plan.keys()) == ['init', 'ML', None]
+        assert [(i, p) for i, p, f in plan['ML']] == [(1, 'rl_1'), (2, 'star_1_mass'), (3, 'age')]
+        assert plan[None][0][2] is evolution_phases.max_
+
+        assert extract_mesa.get_phase_names(parameters, ['HeIgnition']) == ['init', 'ML', None, 'HeIgnition']
+
+    def test_aggregate_phase(self, base_path):
+
+        data, _ = fileio.read_compressed_track(base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5')
+        data = data[100:1000]
+
+        requests = [(i, pname, func) for i, (pname, func) in
+                    enumerate(itertools.product(['star_1_mass', 'log_L', 'model_number'],
+                                                evolution_phases.known_functions.values()))]
+        values = extract_mesa.aggregate_phase(data, requests)
+
+        # the same values and types as calculating each parameter separately
+        for i, pname, func in requests:
+            assert values[i] == func(data, pname)
+            assert type(values[i]) == type(func(data, pname))
+
+
 class TestExtract:
 
     def test_count_ml_phases(self, base_path):
@@ -224,3 +277,235 @@ class TestExtract:
 
             assert results['n_ML_phases'][0] == 1
             assert results['n_ML_phases'][3] == 2
+
+    def test_extract_mesa_parallel(self, root_dir):
+
+        models = ['test_data/M0.814_M0.512_P260.18_Z0.h5',
+                  'test_data/M1.276_M1.140_P333.11_Z0.h5',
+                  'test_data/M0.814_M0.512_P260.18_Z0.h5',
+                  'test_data/does_not_exist.h5',
+                  'test_data/M1.276_M1.140_P333.11_Z0.h5',
+                  ]
+        models = pd.DataFrame([os.path.join(root_dir, x) for x in models], columns=['path'])
+
+        parameters = ['star_1_mass__init', 'period_days__final', 'rl_1__max', 'age__ML__diff']
+        phase_flags = ['ML', 'HeCoreBurning']
+
+        results_serial = extract_mesa.extract_mesa(models.copy(), stability_criterion='J_div_Jdot_div_P',
+                                                   stability_limit=10, parameters=parameters,
+                                                   phase_flags=phase_flags, n_jobs=1)
+        results_parallel = extract_mesa.extract_mesa(models.copy(), stability_criterion='J_div_Jdot_div_P',
+                                                     stability_limit=10, parameters=parameters,
+                                                     phase_flags=phase_flags, n_jobs=2)
+
+        # the model that doesn't exist is skipped, the others are returned in the original order
+        assert len(results_parallel) == 4
+        assert list(results_parallel['path']) == ['M0.814_M0.512_P260.18_Z0.h5', 'M1.276_M1.140_P333.11_Z0.h5',
+                                                  'M0.814_M0.512_P260.18_Z0.h5', 'M1.276_M1.140_P333.11_Z0.h5']
+        pd.testing.assert_frame_equal(results_serial, results_parallel)
+
+    def test_extract_mesa_batch(self, root_dir):
+
+        models = ['test_data/M0.814_M0.512_P260.18_Z0.h5',
+                  'test_data/does_not_exist.h5',
+                  'test_data/M1.276_M1.140_P333.11_Z0.h5',
+                  'test_data/M0.814_M0.512_P260.18_Z0.h5',
+                  'test_data/M1.276_M1.140_P333.11_Z0.h5',
+                  ]
+        models = pd.DataFrame([os.path.join(root_dir, x) for x in models], columns=['path'])
+
+        parameters = ['star_1_mass__init', 'period_days__final', 'rl_1__max', 'age__ML__diff', 'log_L__MS__avg',
+                      'star_1_mass__HeCoreBurning__rate', 'model_number__final', 'log_Teff__sdB__min']
+        phase_flags = ['ML', 'HeCoreBurning', 'CE']
+
+        for stability_limit in [10, -5]:
+            setup = dict(stability_criterion='Mdot' if stability_limit < 0 else 'J_div_Jdot_div_P',
+                         stability_limit=stability_limit, parameters=parameters, phase_flags=phase_flags)
+
+            results = extract_mesa.extract_mesa(models.copy(), **setup)
+            results_batch = extract_mesa.extract_mesa(models.copy(), batch_size=3, **setup)
+            results_batch_parallel = extract_mesa.extract_mesa(models.copy(), batch_size=2, n_jobs=2, **setup)
+
+            assert len(results_batch) == 4
+            pd.testing.assert_frame_equal(results, results_batch)
+            pd.testing.assert_frame_equal(results, results_batch_parallel)
+
+    def test_extract_parameters_batch(self, base_path):
+
+        data, _ = fileio.read_compressed_track(base_path / 'test_data/M1.276_M1.140_P333.11_Z0.h5')
+        histories = [data, data[:2000], data[500:3000], common_envelope.apply_ce(data[:2000])]
+
+        parameters = ['star_1_mass__init', 'rl_1__max', 'age__ML__diff', 'log_L__MS__avg', 'log_L__RGB__min',
+                      'period_days__ML__rate', 'model_number__final']
+
+        results = extract_mesa.extract_parameters_batch(histories, parameters, phase_flags=['CE'])
+
+        for data, result in zip(histories, results):
+            expected = extract_mesa.extract_parameters(data, parameters, phase_flags=['CE'])
+            np.testing.assert_allclose(result, expected, rtol=1e-12)
+            assert type(result[-2]) == type(expected[-2])
+
+    def test_extract_mesa_cache(self, root_dir, tmp_path, monkeypatch):
+
+        models = ['test_data/M0.814_M0.512_P260.18_Z0.h5', 'test_data/M1.276_M1.140_P333.11_Z0.h5']
+        models = pd.DataFrame([os.path.join(root_dir, x) for x in models], columns=['path'])
+        cache = str(tmp_path / 'cache.sqlite')
+
+        setup = dict(stability_criterion='Mdot', stability_limit=-5, ce_formalism='iben_tutukov1984',
+                     ce_parameters={'al': 1})
+        parameters = ['star_1_mass__init', 'period_days__final', 'rl_1__max']
+        parameters_2 = ['star_1_mass__final', 'age__ML__diff', 'he_core_mass__HeCoreBurning__max']
+
+        # first run fills the cache
+        results = extract_mesa.extract_mesa(models.copy(), parameters=parameters, phase_flags=['ML'],
+                                            cache=cache, **setup)
+        pd.testing.assert_frame_equal(results, extract_mesa.extract_mesa(models.copy(), parameters=parameters,
+                                                                         phase_flags=['ML'], **setup))
+        assert list(results['stability']) == ['CE', 'CE']
+
+        connection = extract_cache.open_cache(cache)
+        assert connection.execute('SELECT COUNT(*) FROM extract_cache').fetchone()[0] == 2
+        connection.close()
+
+        # second run with other parameters doesn't need the stability check anymore, results are the same
+        results_2 = extract_mesa.extract_mesa(models.copy(), parameters=parameters_2, phase_flags=['HeCoreBurning'],
+                                              **setup)
+
+        def not_called(*args, **kwargs):
+            raise AssertionError('stability check should be cached')
+
+        monkeypatch.setattr(common_envelope, 'is_stable', not_called)
+        results_cached = extract_mesa.extract_mesa(models.copy(), parameters=parameters_2,
+                                                   phase_flags=['HeCoreBurning'], cache=cache, **setup)
+        pd.testing.assert_frame_equal(results_2, results_cached)
+        monkeypatch.undo()
+
+        # a different setup is a new entry in the cache
+        setup['stability_limit'] = -6
+        extract_mesa.extract_mesa(models.copy(), parameters=parameters, cache=cache, **setup)
+        connection = extract_cache.open_cache(cache)
+        assert connection.execute('SELECT COUNT(*) FROM extract_cache').fetchone()[0] == 4
+        connection.close()
+
+    def test_sweep_ce(self, root_dir):
+
+        models = ['test_data/M0.814_M0.512_P260.18_Z0.h5', 'test_data/M1.276_M1.140_P333.11_Z0.h5']
+        models = pd.DataFrame([os.path.join(root_dir, x) for x in models], columns=['path'])
+
+        ce_settings = [{'ce_formalism': 'iben_tutukov1984', 'al': [0.5, 1.0, 2.0]},
+                       {'ce_formalism': 'webbink1984', 'al': [0.5, 1.0], 'lb': [0.5, 1.0]}]
+        parameters = ['binary_separation__final', 'star_1_mass__final', 'period_days__final']
+
+        results = extract_mesa.sweep_ce(models.copy(), ce_settings, stability_criterion='Mdot', stability_limit=-5)
+
+        assert len(results) == 2 * 7
+        assert list(results['ce_formalism'][0:7]) == ['iben_tutukov1984'] * 3 + ['webbink1984'] * 4
+        assert np.isnan(results['lb'][0])
+        assert results['ce_parameters'][4] == {'al': 0.5, 'lb': 1.0}
+
+        # every setting gives the same result as extracting the models with that setting
+        for ce_formalism, ce_parameters in [('iben_tutukov1984', {'al': 2.0}), ('webbink1984', {'al': 1.0, 'lb': 0.5})]:
+            extracted = extract_mesa.extract_mesa(models.copy(), stability_criterion='Mdot', stability_limit=-5,
+                                                  ce_formalism=ce_formalism, ce_parameters=ce_parameters,
+                                                  parameters=parameters)
+            swept = results[(results['ce_formalism'] == ce_formalism) &
+                            (results['ce_parameters'] == ce_parameters)]
+
+            assert list(swept['stability']) == list(extracted['stability'])
+            np.testing.assert_allclose(swept['binary_separation'], extracted['binary_separation__final'])
+            np.testing.assert_allclose(swept['star_1_mass'], extracted['star_1_mass__final'])
+            np.testing.assert_allclose(swept['period_days'], extracted['period_days__final'])
+
+        # stable models have no state after the CE
+        results = extract_mesa.sweep_ce(models.copy(), ce_settings, stability_criterion='Mdot', stability_limit=-3)
+        assert list(results['stability'].unique()) == ['stable']
+        assert np.all(np.isnan(results['binary_separation']))
+
+        with pytest.raises(ValueError):
+            extract_mesa.sweep_ce(models.copy(), [{'ce_formalism': 'uk_formalism'}])
+
+    def test_read_ce_profiles(self, root_dir, tmp_path):
+
+        filename = str(tmp_path / 'model.h5')
+        shutil.copy(os.path.join(root_dir, 'test_data/M0.814_M0.512_P260.18_Z0.h5'), filename)
+        model = pd.Series({'path': filename, 'ce_profile_name': 'ce_profile'})
+
+        # a model without profiles
+        assert extract_mesa._read_ce_profiles(model) is None
+        data, _ = fileio.read_compressed_track(filename)
+        assert common_envelope.ce_final_state(data, profiles=None, ce_formalism='dewi_tauris2000') == \
+               common_envelope.webbink1984(data, al=1)
+
+        profile = np.zeros(10, dtype=[('mass', 'f8'), ('logR', 'f8'), ('logP', 'f8'), ('logRho', 'f8')])
+        with h5py.File(filename, 'a') as hdf:
+            hdf.create_dataset('profiles/ce_profile', data=profile)
+            hdf.create_dataset('profiles/other_profile', data=profile)
+            hdf.create_dataset('profile_legend', data=np.array([(100, b'ce_profile'), (200, b'other_profile')],
+                                                               dtype=[('model_number', 'f8'),
+                                                                      ('profile_name', 'a13')]))
+
+        profiles = extract_mesa._read_ce_profiles(model)
+        np.testing.assert_array_equal(profiles, profile)
+
+        # a missing profile falls back to all profiles, of which the one closest to the CE is used
+        model['ce_profile_name'] = 'missing_profile'
+        profiles = extract_mesa._read_ce_profiles(model)
+        assert sorted(profiles.keys()) == ['ce_profile', 'legend', 'other_profile']
+
+    def test_ce_profile_name_per_model(self, root_dir, tmp_path):
+
+        filename = str(tmp_path / 'model.h5')
+        shutil.copy(os.path.join(root_dir, 'test_data/M1.276_M1.140_P333.11_Z0.h5'), filename)
+
+        # two synthetic giant profiles with a different radius
+        x = np.linspace(0, 1, 1000)
+        with h5py.File(filename, 'a') as hdf:
+            for name, radius in [('p_a', 100), ('p_b', 300)]:
+                profile = np.zeros(len(x), dtype=[('mass', 'f8'), ('logR', 'f8'), ('logP', 'f8'), ('logRho', 'f8')])
+                profile['mass'] = 1.2 * (1 - x**4) + 1e-6
+                profile['logR'] = np.log10(radius * (1 - x)**0.5 + 1e-3)
+                profile['logRho'] = -8 + 12 * x
+                profile['logP'] = 2 + 17 * x
+                hdf.create_dataset('profiles/' + name, data=profile)
+
+        parameters = ['binary_separation__final']
+        setup = dict(stability_criterion='Mdot', stability_limit=-5, ce_formalism='dewi_tauris2000',
+                     ce_parameters={'a_th': 0.5}, parameters=parameters)
+
+        # the profile name in the file list is used instead of the one given for all models
+        models = pd.DataFrame({'path': [filename], 'ce_profile_name': ['p_b']})
+        result = extract_mesa.extract_mesa(models, ce_profile_name='p_a', **setup)
+
+        result_a = extract_mesa.extract_mesa(pd.DataFrame({'path': [filename]}), ce_profile_name='p_a', **setup)
+        result_b = extract_mesa.extract_mesa(pd.DataFrame({'path': [filename]}), ce_profile_name='p_b', **setup)
+
+        assert result['ce_profile_name'][0] == 'p_b'
+        assert result['binary_separation__final'][0] == result_b['binary_separation__final'][0]
+        assert result['binary_separation__final'][0] != result_a['binary_separation__final'][0]
+
+        # the same for the CE sweep
+        models = pd.DataFrame({'path': [filename], 'ce_profile_name': ['p_b']})
+        swept = extract_mesa.sweep_ce(models, [{'ce_formalism': 'dewi_tauris2000', 'a_th': 0.5}],
+                                      stability_criterion='Mdot', stability_limit=-5, ce_profile_name='p_a')
+        assert swept['binary_separation'][0] == result_b['binary_separation__final'][0]
+
+    def test_extract_mesa_grid(self, root_dir, tmp_path):
+
+        models = ['M0.814_M0.512_P260.18_Z0.h5', 'M1.276_M1.140_P333.11_Z0.h5']
+        for model in models:
+            data = fileio.read_hdf5(os.path.join(root_dir, 'test_data', model))
+            fileio.append_to_grid(tmp_path / 'grid_0000.h5', data, model)
+
+        file_list = pd.DataFrame(data={'path': models + ['does_not_exist.h5'],
+                                       'grid_file': str(tmp_path / 'grid_0000.h5')})
+
+        parameters = ['star_1_mass__init', 'period_days__final', 'rl_1__max', 'age__ML__diff']
+        results_grid = extract_mesa.extract_mesa(file_list, stability_criterion='J_div_Jdot_div_P',
+                                                 stability_limit=10, parameters=parameters, phase_flags=['ML'],
+                                                 n_jobs=2)
+
+        file_list = pd.DataFrame([os.path.join(root_dir, 'test_data', x) for x in models], columns=['path'])
+        results = extract_mesa.extract_mesa(file_list, stability_criterion='J_div_Jdot_div_P', stability_limit=10,
+                                            parameters=parameters, phase_flags=['ML'])
+
+        pd.testing.assert_frame_equal(results_grid, results)
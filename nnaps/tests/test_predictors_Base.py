@@ -132,3 +132,75 @@ class TestBasePredictorTrainingPredicting:
         data_unscaled = predictor._process_targets(data_scaled, inverse=True, return_df=True)
 
         pd.testing.assert_frame_equal(data, data_unscaled)
+
+    def test_process_features_values(self):
+
+        data = pd.DataFrame({'a': np.random.normal(10, 3, size=100), 'b': np.random.lognormal(0, 1, size=100),
+                             'c': np.random.uniform(-5, 5, size=100), 'd': np.random.normal(-1, 1, size=100),
+                             'e': np.random.randint(0, 4, size=100).astype(float),
+                             'f': np.random.normal(0, 2, size=100)})
+
+        processors = {
+            'a': preprocessing.StandardScaler().fit(data[['a']]),
+            'b': preprocessing.RobustScaler().fit(data[['b']]),
+            'c': preprocessing.MinMaxScaler().fit(data[['c']]),
+            'd': preprocessing.MaxAbsScaler().fit(data[['d']]),
+            'e': preprocessing.OrdinalEncoder().fit(data[['e']]),
+            'f': None,
+        }
+
+        predictor = predictors.BasePredictor()
+        predictor.features = ['a', 'b', 'c', 'd', 'e', 'f']
+        predictor.processors = processors
+
+        X = predictor._process_features(data)
+
+        assert X.shape == (100, 6)
+        for i, name in enumerate(predictor.features[:-1]):
+            np.testing.assert_allclose(X[:, i], processors[name].transform(data[[name]])[:, 0], rtol=1e-12)
+        np.testing.assert_array_equal(X[:, -1], data['f'])
+
+        X32 = predictor._process_features(data, dtype=np.float32)
+        assert X32.dtype == np.float32
+        np.testing.assert_allclose(X32, X, rtol=1e-5, atol=1e-6)
+
+        # the plan is remade when the processors change
+        predictor.processors = dict(processors, a=preprocessing.StandardScaler().fit(data[['a']] * 2))
+        X = predictor._process_features(data)
+        np.testing.assert_allclose(X[:, 0], predictor.processors['a'].transform(data[['a']])[:, 0], rtol=1e-12)
+
+    def test_decode_targets(self):
+
+        data = pd.DataFrame({'P': np.random.lognormal(3, 1, size=100), 'q': np.random.uniform(0, 1, size=100),
+                             'product': np.random.choice(['He-WD', 'sdB', 'CO-WD'], size=100),
+                             'binary_type': np.random.choice(['single', 'double'], size=100)})
+
+        predictor = predictors.BasePredictor()
+        predictor.regressors = ['P', 'q']
+        predictor.classifiers = ['product', 'binary_type']
+        predictor.processors = {
+            'P': preprocessing.StandardScaler().fit(data[['P']]),
+            'q': preprocessing.MinMaxScaler().fit(data[['q']]),
+            'product': preprocessing.OneHotEncoder().fit(data[['product']]),
+            'binary_type': preprocessing.OrdinalEncoder().fit(data[['binary_type']]),
+        }
+
+        # raw output of a model: scaled regressors, softmax probabilities and an encoded label
+        probabilities = np.random.uniform(0, 1, size=(100, 3)).astype(np.float32)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        Y = [predictor.processors['P'].transform(data[['P']]).astype(np.float32),
+             predictor.processors['q'].transform(data[['q']]).astype(np.float32),
+             probabilities,
+             predictor.processors['binary_type'].transform(data[['binary_type']])]
+
+        res = predictor._process_targets(Y, inverse=True, return_df=True)
+
+        assert list(res.columns) == ['P', 'q', 'product', 'binary_type']
+        for i, name in enumerate(['P', 'q', 'product', 'binary_type']):
+            np.testing.assert_array_equal(res[name], predictor.processors[name].inverse_transform(Y[i])[:, 0])
+        assert res['P'].dtype == np.float32
+
+        res = predictor._decode_targets(Y, return_probabilities=True)
+        assert list(res.columns) == ['P', 'q', 'product', 'product_prob_CO-WD', 'product_prob_He-WD',
+                                     'product_prob_sdB', 'binary_type']
+        np.testing.assert_array_equal(res['product_prob_sdB'], probabilities[:, 2])
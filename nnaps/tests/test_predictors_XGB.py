@@ -30,6 +30,22 @@ def testpredictor():
 
     return predictor
 
+@pytest.fixture(scope='module')
+def localpredictor():
+    setup = {
+        'default_encoder': 'OrdinalEncoder',
+        'features': ['M1', 'Pinit'],
+        'regressors': ['Pfinal', 'qfinal'],
+        'classifiers': ['product']
+    }
+
+    data = pd.read_csv(base_path / 'BesanconGalactic_summary.txt')
+    predictor = predictors.XGBPredictor(setup=setup, data=data)
+
+    predictor.fit()
+
+    return predictor
+
 class TestXGBPredictorSetup:
 
     def test_make_from_setup(self, testpredictor):
@@ -53,6 +69,126 @@ class TestXGBPredictorTrainingPredicting:
         assert 'qfinal' in res.columns
         assert 'product' in res.columns
 
+    def test_predict_probabilities(self, localpredictor):
+
+        data = localpredictor.test_data
+        res = localpredictor.predict(data)
+        res_prob = localpredictor.predict(data, return_probabilities=True)
+
+        categories = localpredictor.processors['product'].categories_[0]
+        columns = ['product_prob_{}'.format(c) for c in categories]
+        assert all([c in res_prob.columns for c in columns])
+        np.testing.assert_allclose(res_prob[columns].sum(axis=1), 1, rtol=1e-5)
+
+        pd.testing.assert_frame_equal(res_prob[res.columns], res)
+
+    def test_predict_iter(self, localpredictor):
+
+        data = localpredictor.test_data
+        res = localpredictor.predict(data)
+
+        chunks = list(localpredictor.predict_iter(data, chunksize=100, keep_columns=['M1']))
+        assert len(chunks) == int(np.ceil(len(data) / 100))
+        assert len(chunks[0]) == 100
+
+        res_chunks = pd.concat(chunks)
+        pd.testing.assert_index_equal(res_chunks.index, data.index)
+        pd.testing.assert_frame_equal(res_chunks[res.columns].reset_index(drop=True), res)
+        np.testing.assert_array_equal(res_chunks['M1'], data['M1'])
+
+        # a stream of dataframes of any size is predicted in chunks of the same size
+        stream = (data.iloc[i:i + 33] for i in range(0, len(data), 33))
+        res_chunks = pd.concat(localpredictor.predict_iter(stream, chunksize=100))
+        pd.testing.assert_frame_equal(res_chunks.reset_index(drop=True), res)
+
+    def test_predict_to_file(self, localpredictor, tmp_path):
+
+        data = localpredictor.test_data
+        res = localpredictor.predict(data)
+
+        data.to_csv(tmp_path / 'data.csv', index=False)
+        data[['M1', 'Pinit']].to_hdf(tmp_path / 'data.h5', 'data', format='table')
+
+        n = localpredictor.predict_to_file(str(tmp_path / 'data.csv'), str(tmp_path / 'res.csv'), chunksize=150)
+        assert n == len(data)
+        res_file = pd.read_csv(tmp_path / 'res.csv')
+        pd.testing.assert_frame_equal(res_file, res, check_dtype=False)
+
+        n = localpredictor.predict_to_file(str(tmp_path / 'data.h5'), str(tmp_path / 'res.h5'), chunksize=150,
+                                           keep_columns=['M1'])
+        assert n == len(data)
+        res_file = pd.read_hdf(tmp_path / 'res.h5', 'predictions')
+        pd.testing.assert_frame_equal(res_file[res.columns], res, check_dtype=False)
+        np.testing.assert_array_equal(res_file['M1'], data['M1'])
+
+
+    def test_train_parallel(self, localpredictor):
+
+        setup = {
+            'default_encoder': 'OrdinalEncoder',
+            'features': ['M1', 'Pinit'],
+            'regressors': ['Pfinal', 'qfinal'],
+            'classifiers': ['product'],
+            'xgb_kwargs': {'tree_method': 'hist', 'n_estimators': 20},
+            'n_jobs': 4,
+            'n_parallel_targets': 2,
+        }
+        data = pd.concat([localpredictor.train_data, localpredictor.test_data])
+
+        predictor = predictors.XGBPredictor(setup=setup, data=data)
+        assert predictor._get_thread_budget() == (2, 2)
+        assert predictor.model['Pfinal'].tree_method == 'hist'
+        assert predictor.model['product'].n_jobs == 2
+
+        predictor.fit()
+        assert sorted(predictor.fit_times.keys()) == ['Pfinal', 'product', 'qfinal']
+
+        # training the targets one by one gives the same models
+        setup['n_parallel_targets'] = 1
+        predictor_1 = predictors.XGBPredictor(setup=setup, data=data)
+        assert predictor_1._get_thread_budget() == (1, 4)
+        predictor_1.fit()
+
+        pd.testing.assert_frame_equal(predictor.predict(predictor.test_data),
+                                      predictor_1.predict(predictor.test_data))
+
+    def test_train_shared_matrix(self, localpredictor):
+
+        setup = {
+            'default_encoder': 'OrdinalEncoder',
+            'features': ['M1', 'Pinit'],
+            'regressors': ['Pfinal', 'qfinal'],
+            'classifiers': ['product'],
+            'xgb_kwargs': {'tree_method': 'hist', 'n_estimators': 20},
+            'n_parallel_targets': 2,
+        }
+        data = pd.concat([localpredictor.train_data, localpredictor.test_data])
+
+        predictor = predictors.XGBPredictor(setup=setup, data=data)
+        predictor.fit()
+
+        # the models are still the sklearn wrappers
+        assert predictor.model['Pfinal'].__class__.__name__ == 'XGBRegressor'
+        assert predictor.model['product'].__class__.__name__ == 'XGBClassifier'
+
+        # training every model with its own fit call gives the same models
+        setup['xgb_shared_matrix'] = False
+        predictor_1 = predictors.XGBPredictor(setup=setup, data=data)
+        predictor_1.fit()
+
+        pd.testing.assert_frame_equal(predictor.predict(predictor.test_data),
+                                      predictor_1.predict(predictor.test_data))
+
+        # early stopping on the test set
+        setup['xgb_shared_matrix'] = True
+        setup['xgb_kwargs'] = {'tree_method': 'hist', 'n_estimators': 200, 'early_stopping_rounds': 5}
+        predictor = predictors.XGBPredictor(setup=setup, data=data)
+        predictor.fit()
+
+        for target in ['Pfinal', 'qfinal', 'product']:
+            assert predictor.model[target].best_iteration < 200
+            assert 'validation_0' in predictor.model[target].evals_result()
+
 class TestXGBPredictorSaveLoad:
 
     def test_save_load(self, testpredictor):